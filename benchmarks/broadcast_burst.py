@@ -0,0 +1,81 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure delivery of a burst of broadcast messages to subscribers. Subscribers are connected in process with the
+adapters of idle_connections.py and subscribe to 'burst/#'. All messages are queued for broadcast at once, on a few
+topics, then the benchmark waits until every subscriber has been written all of them.
+
+Usage: python benchmarks/broadcast_burst.py [SUBSCRIBERS] [MESSAGES] [TOPICS]
+"""
+import sys
+import asyncio
+import logging
+import time
+from hbmqtt.broker import Broker
+from idle_connections import config, IdleReader, NullWriter, _packet, _string
+
+# CONNACK and SUBACK sizes
+_HANDSHAKE_BYTES = 4 + 5
+_PAYLOAD = b'0123456789abcdef'
+
+
+class CountingWriter(NullWriter):
+    def __init__(self, port):
+        super().__init__(port)
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+
+def subscriber_packets(client_id):
+    connect = _packet(0x10, b'\x00\x04MQTT\x04\x02\x00\x3c' + _string(client_id))
+    subscribe = _packet(0x82, b'\x00\x01' + _string('burst/#') + b'\x00')
+    return connect + subscribe
+
+
+@asyncio.coroutine
+def burst(broker, subscribers, count, topics):
+    writers = [CountingWriter(i) for i in range(subscribers)]
+    tasks = [asyncio.ensure_future(broker.client_connected(
+        'default', IdleReader(subscriber_packets('subscriber-%d' % i)), writer)) for i, writer in enumerate(writers)]
+    while len(broker._client_subscriptions) < subscribers:
+        yield from asyncio.sleep(0.01)
+    for writer in writers:
+        writer.writes = 0
+        writer.bytes = _HANDSHAKE_BYTES - writer.bytes
+    topic_names = ['burst/%d' % i for i in range(topics)]
+    expected = sum(len(_packet(0x30, _string(topic) + _PAYLOAD)) for topic in topic_names) * (count // topics)
+    start = time.perf_counter()
+    for i in range(count // topics * topics):
+        yield from broker._broadcast_message(None, topic_names[i % topics], _PAYLOAD)
+    while any(writer.bytes < expected for writer in writers):
+        yield from asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    return tasks, writers, elapsed
+
+
+def main(subscribers=10, count=10000, topics=5):
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker(config, loop=loop, plugin_namespace='hbmqtt.benchmark.plugins')
+    loop.run_until_complete(broker.start())
+    tasks, writers, elapsed = loop.run_until_complete(burst(broker, subscribers, count, topics))
+    for session, handler in list(broker._sessions.values()):
+        loop.run_until_complete(handler.stop())
+    loop.run_until_complete(asyncio.wait(tasks, loop=loop))
+    loop.run_until_complete(broker.shutdown())
+    # Let the cancelled broadcast loop end
+    loop.run_until_complete(asyncio.sleep(0.1, loop=loop))
+    loop.close()
+    deliveries = subscribers * (count // topics * topics)
+    print("%d messages on %d topics to %d subscribers in %.2f s: %d deliveries/s, %.2f writes per delivery" %
+          (count, topics, subscribers, elapsed, deliveries / elapsed, sum(w.writes for w in writers) / deliveries))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:4]])
@@ -0,0 +1,74 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure head-of-line blocking between topics in the broadcast queue. A burst of messages is queued on a busy topic
+followed by a single message on a quiet topic, and the benchmark reports how long the quiet topic subscriber waits
+for its message, for a number of broadcast shards.
+
+Usage: python benchmarks/broadcast_shards.py [MESSAGES] [SHARDS...]
+"""
+import sys
+import asyncio
+import logging
+import time
+from hbmqtt.broker import Broker
+from idle_connections import config, IdleReader, _packet, _string
+from broadcast_burst import CountingWriter, _PAYLOAD
+
+
+def subscriber_packets(client_id, a_filter):
+    connect = _packet(0x10, b'\x00\x04MQTT\x04\x02\x00\x3c' + _string(client_id))
+    subscribe = _packet(0x82, b'\x00\x01' + _string(a_filter) + b'\x00')
+    return connect + subscribe
+
+
+@asyncio.coroutine
+def quiet_latency(broker, count):
+    busy, quiet = CountingWriter(1), CountingWriter(2)
+    tasks = [
+        asyncio.ensure_future(broker.client_connected(
+            'default', IdleReader(subscriber_packets('busy', 'busy/#')), busy)),
+        asyncio.ensure_future(broker.client_connected(
+            'default', IdleReader(subscriber_packets('quiet', 'quiet')), quiet)),
+    ]
+    while len(broker._client_subscriptions) < 2:
+        yield from asyncio.sleep(0.01)
+    quiet.bytes = 0
+    # Queue the burst and the quiet message on different shards
+    busy_topic = next('busy/%d' % i for i in range(100) if hash('busy/%d' % i) % 2 != hash('quiet') % 2)
+    start = time.perf_counter()
+    for i in range(count):
+        yield from broker._broadcast_message(None, busy_topic, _PAYLOAD)
+    yield from broker._broadcast_message(None, 'quiet', _PAYLOAD)
+    while not quiet.bytes:
+        yield from asyncio.sleep(0)
+    return tasks, time.perf_counter() - start
+
+
+def run(count, shards):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker_config = dict(config, **{'broadcast-shards': shards})
+    broker = Broker(broker_config, loop=loop, plugin_namespace='hbmqtt.benchmark.plugins')
+    loop.run_until_complete(broker.start())
+    tasks, latency = loop.run_until_complete(quiet_latency(broker, count))
+    for session, handler in list(broker._sessions.values()):
+        loop.run_until_complete(handler.stop())
+    loop.run_until_complete(asyncio.wait(tasks, loop=loop))
+    loop.run_until_complete(broker.shutdown())
+    # Let cancelled broadcast loops end
+    loop.run_until_complete(asyncio.sleep(0.1, loop=loop))
+    loop.close()
+    print("%d shard(s): quiet topic message delivered after %.2f ms behind %d busy topic messages" %
+          (shards, latency * 1000, count))
+
+
+def main(count=20000, *shards):
+    logging.basicConfig(level=logging.ERROR)
+    for n in shards or (1, 2, 4):
+        run(count, n)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,140 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure memory used by idle connected clients. Connections are made in process with adapters which feed a CONNECT
+packet then wait forever, so no socket is needed and results only include broker structures (plus the small test
+adapters). Each client connects with a persistent session and one subscription, as an idle IoT device does.
+
+Usage: python benchmarks/idle_connections.py [CONNECTIONS] [MAX_BYTES_PER_CONNECTION]
+
+Exits with status 1 if memory per connection exceeds MAX_BYTES_PER_CONNECTION (default 17000, 0 disables the check),
+so it can be used as a regression check. Memory per connection doesn't depend much on the number of connections, so
+a few thousand connections are enough for a quick check.
+"""
+import sys
+import asyncio
+import gc
+import logging
+import struct
+import time
+import tracemalloc
+from hbmqtt.adapters import ReaderAdapter, WriterAdapter
+from hbmqtt.broker import Broker
+
+config = {
+    'listeners': {
+        'default': {
+            'type': 'tcp',
+            'bind': '127.0.0.1:18831',
+            'connect-timeout': 0,
+        },
+    },
+    'sys_interval': 0,
+    'auth': {
+        'allow-anonymous': True,
+    }
+}
+
+
+def _string(value):
+    value = value.encode('utf-8')
+    return struct.pack('!H', len(value)) + value
+
+
+def _packet(first_byte, body):
+    return bytes([first_byte, len(body)]) + body
+
+
+def client_packets(client_id):
+    # CONNECT with clean session unset and 60 seconds keep alive, then SUBSCRIBE
+    connect = _packet(0x10, b'\x00\x04MQTT\x04\x00\x00\x3c' + _string(client_id))
+    subscribe = _packet(0x82, b'\x00\x01' + _string('devices/%s/commands' % client_id) + b'\x01')
+    return connect + subscribe
+
+
+class IdleReader(ReaderAdapter):
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        if self._position >= len(self._data):
+            # Idle client: nothing more to read
+            yield from asyncio.Future()
+        end = len(self._data) if n < 0 else self._position + n
+        data = self._data[self._position:end]
+        self._position = end
+        return data
+
+
+class NullWriter(WriterAdapter):
+    def __init__(self, port):
+        self._port = port
+
+    def write(self, data):
+        pass
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+    def get_peer_info(self):
+        return '10.0.0.1', self._port
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+
+@asyncio.coroutine
+def connect_all(broker, count):
+    tasks = []
+    for i in range(count):
+        client_id = 'device-%d' % i
+        tasks.append(asyncio.ensure_future(
+            broker.client_connected('default', IdleReader(client_packets(client_id)), NullWriter(i % 65536))))
+        if i % 1000 == 999:
+            # Let connections settle so pending handshakes don't pile up
+            yield from asyncio.sleep(0)
+    while len(broker._client_subscriptions) < count:
+        yield from asyncio.sleep(0.1)
+    return tasks
+
+
+@asyncio.coroutine
+def disconnect_all(broker, tasks):
+    # Stopping handlers closes connections the way a network error does, then client_connected tasks end
+    handlers = [handler for session, handler in broker._sessions.values()]
+    yield from asyncio.wait([handler.stop() for handler in handlers])
+    yield from asyncio.wait(tasks)
+
+
+def main(count=100000, max_bytes=17000):
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker(config, loop=loop, plugin_namespace='hbmqtt.benchmark.plugins')
+    loop.run_until_complete(broker.start())
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    tasks = loop.run_until_complete(connect_all(broker, count))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_connection = size / count
+    print("%d idle connections in %.1f s: %.1f MB, %d bytes per connection" %
+          (count, elapsed, size / 1024 / 1024, per_connection))
+    loop.run_until_complete(disconnect_all(broker, tasks))
+    loop.run_until_complete(broker.shutdown())
+    loop.close()
+    if max_bytes and per_connection > max_bytes:
+        print("Regression: more than %d bytes per connection" % max_bytes)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,62 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure the rate of PUBLISH packets a broker processes from a single connection. The connection is made in process
+with the adapters of idle_connections.py, which feed a CONNECT packet followed by all PUBLISH packets at once, so the
+result only includes broker processing: packet decoding, handler flow, client loop and broadcast. The last message is
+retained on a distinct topic to detect the end of processing.
+
+Usage: python benchmarks/inbound_publish.py [MESSAGES] [QOS]
+
+QOS is 0 or 1: QoS 2 messages are only delivered once the client sends PUBREL, which this client doesn't do.
+"""
+import sys
+import asyncio
+import logging
+import time
+from hbmqtt.broker import Broker
+from idle_connections import config, IdleReader, NullWriter, _packet, _string
+
+
+def publish_packet(topic, qos, packet_id, retain=False):
+    body = _string(topic)
+    if qos:
+        body += bytes([packet_id >> 8, packet_id & 0xff])
+    return _packet(0x30 | qos << 1 | retain, body + b'0123456789abcdef')
+
+
+def client_packets(count, qos):
+    connect = _packet(0x10, b'\x00\x04MQTT\x04\x02\x00\x3c' + _string('publisher'))
+    publishes = [publish_packet('sensors/publisher/value', qos, i % 65535 + 1) for i in range(count - 1)]
+    return connect + b''.join(publishes) + publish_packet('sensors/publisher/last', qos, 65535, retain=True)
+
+
+@asyncio.coroutine
+def publish_all(broker, count, qos):
+    task = asyncio.ensure_future(broker.client_connected(
+        'default', IdleReader(client_packets(count, qos)), NullWriter(1)))
+    while 'sensors/publisher/last' not in broker._retained_messages:
+        yield from asyncio.sleep(0.001)
+    return task
+
+
+def main(count=100000, qos=0):
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker(config, loop=loop, plugin_namespace='hbmqtt.benchmark.plugins')
+    loop.run_until_complete(broker.start())
+    start = time.perf_counter()
+    task = loop.run_until_complete(publish_all(broker, count, qos))
+    elapsed = time.perf_counter() - start
+    for session, handler in list(broker._sessions.values()):
+        loop.run_until_complete(handler.stop())
+    loop.run_until_complete(task)
+    loop.run_until_complete(broker.shutdown())
+    loop.close()
+    print("%d QoS %d messages in %.2f s: %d messages/s" % (count, qos, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
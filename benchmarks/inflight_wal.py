@@ -0,0 +1,44 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure the cost of logging QoS 1 messages in the in-flight write-ahead log: one put when a message enters in
+flight and one delete when it is acknowledged, plus the periodic sync.
+
+Usage: python benchmarks/inflight_wal.py [MESSAGES] [PAYLOAD_SIZE]
+"""
+import sys
+import asyncio
+import shutil
+import tempfile
+import time
+from hbmqtt.wal import InflightLog
+from hbmqtt.session import OutgoingApplicationMessage, OUTGOING
+
+
+def main(messages=200000, payload_size=64):
+    directory = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    try:
+        log = InflightLog(directory)
+        log.open()
+        payload = b'x' * payload_size
+        inflight = [OutgoingApplicationMessage(i % 65535 + 1, 'sensors/%d/temperature' % (i % 1000), 1, payload,
+                                               False) for i in range(messages)]
+        start = time.perf_counter()
+        for message in inflight:
+            log.put('benchmark-client', message)
+            log.delete('benchmark-client', OUTGOING, message.packet_id)
+        elapsed = time.perf_counter() - start
+        print("%d messages of %d bytes: %.2f us per put+delete" % (messages, payload_size, elapsed / messages * 1e6))
+        start = time.perf_counter()
+        loop.run_until_complete(log.sync(loop=loop))
+        print("sync: %.2f ms" % ((time.perf_counter() - start) * 1000))
+        log.close()
+    finally:
+        loop.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
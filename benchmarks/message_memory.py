@@ -0,0 +1,45 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure memory used by messages queued for disconnected sessions, and by in-flight messages holding their PUBLISH
+packet. Topic and payload objects are shared between messages, as when the broker routes a publication to many
+sessions, so results show the per-message overhead.
+
+Usage: python benchmarks/message_memory.py [MESSAGES]
+"""
+import sys
+import asyncio
+import tracemalloc
+from hbmqtt.session import RetainedApplicationMessage, OutgoingApplicationMessage
+
+
+def measure(name, factory, count):
+    tracemalloc.start()
+    queue = asyncio.Queue(loop=loop)
+    for i in range(count):
+        queue.put_nowait(factory(i))
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-40s %8.1f MB, %6d bytes per message" % (name, size / 1024 / 1024, size / count))
+
+
+def inflight_message(i):
+    message = OutgoingApplicationMessage(i % 65535 + 1, topic, 1, payload, False)
+    message.publish_packet = message.build_publish_packet()
+    return message
+
+
+loop = asyncio.new_event_loop()
+topic = 'devices/sensor/temperature'
+payload = b'x' * 64
+
+
+def main(count=1000000):
+    print("%d messages" % count)
+    measure('queued (RetainedApplicationMessage)', lambda i: RetainedApplicationMessage(topic, payload, 1), count)
+    measure('in flight (with PUBLISH packet)', inflight_message, count)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,74 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure the time a client reconnecting with the client id of a still connected session waits for its CONNACK, as
+flapping mobile clients do. Each connection sends a CONNECT with clean session unset and never disconnects, so every
+new connection takes the session over from the previous one.
+
+Usage: python benchmarks/reconnect_latency.py [RECONNECTIONS]
+"""
+import sys
+import asyncio
+import logging
+import struct
+from hbmqtt.broker import Broker
+
+config = {
+    'listeners': {
+        'default': {
+            'type': 'tcp',
+            'bind': '127.0.0.1:18830',
+        },
+    },
+    'sys_interval': 0,
+    'auth': {
+        'allow-anonymous': True,
+    }
+}
+
+
+def connect_packet(client_id):
+    client_id = client_id.encode('utf-8')
+    # Protocol name and level, flags with clean session unset, keep alive
+    body = b'\x00\x04MQTT\x04\x00\x00\x3c' + struct.pack('!H', len(client_id)) + client_id
+    return bytes([0x10, len(body)]) + body
+
+
+@asyncio.coroutine
+def reconnect(loop, count):
+    packet = connect_packet('flapping-client')
+    latencies = []
+    writers = []
+    for i in range(count):
+        start = loop.time()
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', 18830, loop=loop)
+        writer.write(packet)
+        connack = yield from reader.readexactly(4)
+        latencies.append(loop.time() - start)
+        assert connack[3] == 0, "Connection refused: %d" % connack[3]
+        writers.append(writer)
+    for writer in writers:
+        writer.close()
+    return latencies
+
+
+def main(count=200):
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker(config, loop=loop)
+    loop.run_until_complete(broker.start())
+    try:
+        latencies = sorted(loop.run_until_complete(reconnect(loop, count)))
+        loop.run_until_complete(asyncio.sleep(0.1, loop=loop))
+    finally:
+        loop.run_until_complete(broker.shutdown())
+        loop.close()
+    print("%d reconnections: median %.2f ms, p99 %.2f ms, max %.2f ms" %
+          (count, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+           latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
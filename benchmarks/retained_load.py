@@ -0,0 +1,49 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure the time needed to load a retained messages store, as done at broker startup.
+
+Usage: python benchmarks/retained_load.py [TOPICS] [LOG_OPERATIONS]
+"""
+import sys
+import os
+import asyncio
+import shutil
+import tempfile
+import time
+from hbmqtt.retained import RetainedStore
+
+
+def main(topics=1000000, log_operations=100000):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'retained')
+    loop = asyncio.new_event_loop()
+    try:
+        store = RetainedStore(path)
+        store.load()
+        store.open()
+        start = time.monotonic()
+        messages = [('devices/%d/state' % i, b'{"on": true, "level": 42}', 1) for i in range(topics)]
+        loop.run_until_complete(store.compact(messages, loop=loop))
+        print("Snapshot of %d topics written in %.2f s (%d bytes)" %
+              (topics, time.monotonic() - start, store.snapshot_size))
+        for i in range(log_operations):
+            if i % 10:
+                store.retain('devices/%d/state' % i, b'{"on": false}', 1)
+            else:
+                store.clear('devices/%d/state' % i)
+        store.close()
+
+        store = RetainedStore(path)
+        start = time.monotonic()
+        loaded = store.load()
+        elapsed = time.monotonic() - start
+        print("Loaded %d topics (snapshot + %d log operations) in %.2f s" % (len(loaded), log_operations, elapsed))
+    finally:
+        loop.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
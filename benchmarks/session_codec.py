@@ -0,0 +1,77 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Compare size and encode/decode time of the binary session format with pickle.
+
+A whole Session can't be pickled (it holds an event loop, queues and a state machine), so pickle is measured on the
+same persisted state: session attributes, subscriptions and in-flight messages attributes.
+
+Usage: python benchmarks/session_codec.py [INFLIGHT] [ITERATIONS]
+"""
+import sys
+import asyncio
+import pickle
+import timeit
+from hbmqtt.session import Session, OutgoingApplicationMessage, ApplicationMessage
+
+_SESSION_ATTRIBUTES = ('client_id', 'clean_session', 'username', 'keep_alive', 'will_flag', 'will_topic',
+                       'will_message', 'will_qos', 'will_retain', '_packet_id')
+_MESSAGE_ATTRIBUTES = ('packet_id', 'topic', 'qos', 'data', 'retain', 'direction')
+
+
+def build_session(loop, inflight):
+    session = Session(loop)
+    session.client_id = 'benchmark-client-0001'
+    session.username = 'benchmark'
+    session.clean_session = False
+    session.keep_alive = 60
+    for packet_id in range(1, inflight + 1):
+        message = OutgoingApplicationMessage(packet_id, 'sensors/%d/temperature' % packet_id, 1, b'x' * 64, False)
+        message.publish_packet = message.build_publish_packet()
+        session.inflight_out[packet_id] = message
+    subscriptions = [('sensors/+/temperature', 1), ('commands/benchmark-client-0001/#', 2)]
+    return session, subscriptions
+
+
+def session_state(session, subscriptions):
+    return (tuple(getattr(session, a) for a in _SESSION_ATTRIBUTES), subscriptions,
+            [tuple(getattr(m, a) for a in _MESSAGE_ATTRIBUTES) for m in session.inflight_out.values()])
+
+
+def main(inflight=10, iterations=10000):
+    loop = asyncio.new_event_loop()
+    session, subscriptions = build_session(loop, inflight)
+
+    def codec_encode():
+        return session.to_bytes(subscriptions), [m.to_bytes() for m in session.inflight_out.values()]
+
+    def codec_decode(encoded=codec_encode()):
+        Session.from_bytes(encoded[0], loop=loop)
+        for data in encoded[1]:
+            ApplicationMessage.from_bytes(data)
+
+    def pickle_encode():
+        return pickle.dumps(session_state(session, subscriptions), pickle.HIGHEST_PROTOCOL)
+
+    def pickle_decode(encoded=pickle_encode()):
+        pickle.loads(encoded)
+
+    encoded = codec_encode()
+    codec_size = len(encoded[0]) + sum(len(d) for d in encoded[1])
+    pickle_size = len(pickle_encode())
+    print("Session with %d in-flight messages, %d iterations" % (inflight, iterations))
+    print("%-8s %10s %14s %14s" % ('format', 'bytes', 'encode (us)', 'decode (us)'))
+    for name, size, encode, decode in (('binary', codec_size, codec_encode, codec_decode),
+                                       ('pickle', pickle_size, pickle_encode, pickle_decode)):
+        encode_time = timeit.timeit(encode, number=iterations) / iterations * 1e6
+        decode_time = timeit.timeit(decode, number=iterations) / iterations * 1e6
+        print("%-8s %10d %14.2f %14.2f" % (name, size, encode_time, decode_time))
+    # Binary decoding builds a live Session and its packets, pickle only rebuilds plain tuples
+    construct_time = timeit.timeit(lambda: Session(loop), number=iterations) / iterations * 1e6
+    print("of which Session() construction: %.2f us" % construct_time)
+    loop.close()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,52 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure creation time and memory of sessions, and of their state machine alone. When the ``transitions`` package is
+installed, the state machine it used to build for each session is measured too.
+
+Usage: python benchmarks/session_states.py [SESSIONS]
+"""
+import sys
+import asyncio
+import time
+import tracemalloc
+from hbmqtt.session import Session, SessionStates
+
+
+def transitions_machine():
+    from transitions import Machine
+    machine = Machine(states=Session.states, initial='new')
+    machine.add_transition(trigger='connect', source='new', dest='connected')
+    machine.add_transition(trigger='connect', source='disconnected', dest='connected')
+    machine.add_transition(trigger='disconnect', source='connected', dest='disconnected')
+    machine.add_transition(trigger='disconnect', source='new', dest='disconnected')
+    machine.add_transition(trigger='disconnect', source='disconnected', dest='disconnected')
+    return machine
+
+
+def measure(name, factory, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objects = [factory() for i in range(count)]
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-22s %8.2f us, %8d bytes per instance" % (name, elapsed / count * 1e6, size / count))
+    del objects
+
+
+def main(count=100000):
+    loop = asyncio.new_event_loop()
+    print("%d instances" % count)
+    measure('Session', lambda: Session(loop), count)
+    measure('SessionStates', SessionStates, count)
+    try:
+        measure('transitions.Machine', transitions_machine, count)
+    except ImportError:
+        print("transitions package not installed")
+    loop.close()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
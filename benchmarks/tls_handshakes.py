@@ -0,0 +1,92 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Measure the rate of TLS connections a broker accepts up to their CONNACK, with TLS handled by the broker loop or
+offloaded to helper processes. Clients run in separate processes, each opening connections one after the other, so
+that their own handshakes don't compete with the broker for its loop.
+
+Usage: python benchmarks/tls_handshakes.py [SSL_OFFLOAD] [CLIENT_PROCESSES] [CONNECTIONS_PER_PROCESS]
+"""
+import sys
+import asyncio
+import logging
+import multiprocessing
+import os
+import ssl
+import struct
+import time
+from hbmqtt.broker import Broker
+
+cert_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests')
+cert_file = os.path.join(cert_dir, 'tls_test.crt')
+key_file = os.path.join(cert_dir, 'tls_test.key')
+
+
+def broker_config(ssl_offload):
+    return {
+        'listeners': {
+            'default': {
+                'type': 'tcp',
+                'bind': '127.0.0.1:18883',
+                'ssl': 'on',
+                'certfile': cert_file,
+                'keyfile': key_file,
+                'ssl-offload': ssl_offload,
+            },
+        },
+        'sys_interval': 0,
+        'auth': {
+            'allow-anonymous': True,
+        }
+    }
+
+
+def connect_packet(client_id):
+    client_id = client_id.encode('utf-8')
+    # Protocol name and level, flags with clean session set, keep alive
+    body = b'\x00\x04MQTT\x04\x02\x00\x3c' + struct.pack('!H', len(client_id)) + client_id
+    return bytes([0x10, len(body)]) + body
+
+
+@asyncio.coroutine
+def connect(loop, index, count):
+    sc = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cert_file)
+    for i in range(count):
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', 18883, ssl=sc, loop=loop)
+        writer.write(connect_packet('client-%d-%d' % (index, i)))
+        connack = yield from reader.readexactly(4)
+        assert connack[3] == 0, "Connection refused: %d" % connack[3]
+        writer.close()
+
+
+def run_clients(index, count):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(connect(loop, index, count))
+    loop.close()
+
+
+def main(ssl_offload=0, processes=4, count=200):
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker(broker_config(ssl_offload), loop=loop)
+    loop.run_until_complete(broker.start())
+    context = multiprocessing.get_context('spawn')
+    try:
+        start = time.time()
+        clients = [context.Process(target=run_clients, args=(index, count)) for index in range(processes)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            loop.run_until_complete(loop.run_in_executor(None, client.join))
+        duration = time.time() - start
+    finally:
+        loop.run_until_complete(broker.shutdown())
+        loop.close()
+    print("ssl-offload %d: %d connections in %.2f s, %.0f connections/s" %
+          (ssl_offload, processes * count, duration, processes * count / duration))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:4]])
@@ -53,6 +53,12 @@ class WriterAdapter:
         Return peer socket info (remote address and remote port as tuple
         """
 
+    def get_peer_cert(self):
+        """
+        Return the certificate of a peer connected through TLS, as returned by ssl.SSLSocket.getpeercert(), or None
+        """
+        return None
+
     @asyncio.coroutine
     def close(self):
         """
@@ -124,6 +130,9 @@ class WebSocketsWriter(WriterAdapter):
         extra_info = self._protocol.writer.get_extra_info('peername')
         return extra_info[0], extra_info[1]
 
+    def get_peer_cert(self):
+        return self._protocol.writer.get_extra_info('peercert')
+
     @asyncio.coroutine
     def close(self):
         yield from self._protocol.close()
@@ -145,6 +154,12 @@ class StreamReaderAdapter(ReaderAdapter):
     def feed_eof(self):
         return self._reader.feed_eof()
 
+    def buffered(self) -> bytes:
+        """
+        Return data received but not read yet, without consuming it
+        """
+        return bytes(self._reader._buffer)
+
 
 class StreamWriterAdapter(WriterAdapter):
     """
@@ -167,6 +182,13 @@ class StreamWriterAdapter(WriterAdapter):
         extra_info = self._writer.get_extra_info('peername')
         return extra_info[0], extra_info[1]
 
+    def get_peer_cert(self):
+        return self._writer.get_extra_info('peercert')
+
+    @property
+    def transport(self):
+        return self._writer.transport
+
     @asyncio.coroutine
     def close(self):
         yield from self._writer.drain()
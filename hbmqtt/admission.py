@@ -0,0 +1,132 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Admission control of incoming connections.
+
+Connections are rate limited per listener and per source IP address with token buckets, and source addresses failing
+authentication are blocked for a delay doubling on each consecutive failure.
+"""
+import time
+from collections import OrderedDict
+
+REJECT_LISTENER_RATE = 'listener_rate'
+REJECT_IP_RATE = 'ip_rate'
+REJECT_AUTH_PENALTY = 'auth_penalty'
+
+
+class TokenBucket:
+    """
+    Token bucket refilled with ``rate`` tokens per second, holding at most ``burst`` tokens
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def consume(self, now):
+        """
+        Take a token
+        :return: True if a token was available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class _Address:
+    __slots__ = ('bucket', 'failures', 'blocked_until')
+
+    def __init__(self):
+        self.bucket = None
+        self.failures = 0
+        self.blocked_until = 0
+
+
+class AdmissionControl:
+    """
+    Connection admission control of a listener.
+
+    :param rate: connections per second accepted on the listener. ``0`` disables the limit
+    :param burst: connections accepted at once on the listener. Defaults to ``rate``
+    :param ip_rate: connections per second accepted from a single IP address. ``0`` disables the limit
+    :param ip_burst: connections accepted at once from a single IP address. Defaults to ``ip_rate``
+    :param penalty: seconds a source address is blocked after an authentication failure, doubled on each consecutive
+        failure. ``0`` disables penalties
+    :param max_penalty: maximum blocking delay, in seconds
+    :param max_addresses: number of source addresses tracked, least recently seen addresses are forgotten first
+    :param clock: function returning current time, in seconds
+    """
+    def __init__(self, rate=0, burst=None, ip_rate=0, ip_burst=None, penalty=0, max_penalty=300,
+                 max_addresses=100000, clock=time.monotonic):
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst if ip_burst else max(ip_rate, 1)
+        self.penalty = penalty
+        self.max_penalty = max_penalty
+        self.max_addresses = max_addresses
+        self._clock = clock
+        if rate:
+            self._bucket = TokenBucket(rate, burst if burst else max(rate, 1), clock())
+        else:
+            self._bucket = None
+        self._addresses = OrderedDict()
+        self.admitted = 0
+        self.rejected = {REJECT_LISTENER_RATE: 0, REJECT_IP_RATE: 0, REJECT_AUTH_PENALTY: 0}
+
+    def _get_address(self, ip, create=True):
+        address = self._addresses.get(ip, None)
+        if address is not None:
+            self._addresses.move_to_end(ip)
+        elif create:
+            address = self._addresses[ip] = _Address()
+            if len(self._addresses) > self.max_addresses:
+                self._addresses.popitem(last=False)
+        return address
+
+    def admit(self, ip):
+        """
+        Check if a new connection from a source address can be accepted
+        :param ip: source IP address
+        :return: None if the connection is accepted, else the rejection reason
+        """
+        now = self._clock()
+        address = self._get_address(ip, create=bool(self.ip_rate))
+        if address is not None and address.blocked_until > now:
+            reason = REJECT_AUTH_PENALTY
+        elif self._bucket is not None and not self._bucket.consume(now):
+            reason = REJECT_LISTENER_RATE
+        elif self.ip_rate:
+            if address.bucket is None:
+                address.bucket = TokenBucket(self.ip_rate, self.ip_burst, now)
+            reason = None if address.bucket.consume(now) else REJECT_IP_RATE
+        else:
+            reason = None
+        if reason is None:
+            self.admitted += 1
+        else:
+            self.rejected[reason] += 1
+        return reason
+
+    def auth_failed(self, ip):
+        """
+        Record an authentication failure from a source address, blocking it for a while
+        """
+        if not self.penalty:
+            return
+        address = self._get_address(ip)
+        address.failures += 1
+        # The exponent is bounded so that a float penalty times a huge int can't overflow
+        delay = min(self.penalty * 2 ** min(address.failures - 1, 32), self.max_penalty)
+        address.blocked_until = self._clock() + delay
+
+    def auth_succeeded(self, ip):
+        address = self._get_address(ip, create=False)
+        if address is not None:
+            address.failures = 0
+            address.blocked_until = 0
@@ -2,22 +2,23 @@
 #
 # See the file license.txt for copying permission.
 import logging
-import ssl
 import websockets
 import asyncio
 import sys
 import re
+import heapq
 from asyncio import Queue, CancelledError
 if sys.version_info < (3, 5):
     from asyncio import async as ensure_future
 else:
     from asyncio import ensure_future
-from collections import deque
+from collections import deque, OrderedDict
 
 from functools import partial
-from transitions import Machine, MachineError
-from hbmqtt.session import Session
-from hbmqtt.mqtt.protocol.broker_handler import BrokerProtocolHandler
+from hbmqtt.session import Session, RetainedApplicationMessage, INCOMING
+from hbmqtt.states import StateMachine, MachineError
+from hbmqtt.mqtt.protocol.broker_handler import BrokerProtocolHandler, \
+    INBOX_SUBSCRIBE, INBOX_UNSUBSCRIBE, INBOX_MESSAGE, INBOX_DISCONNECT
 from hbmqtt.errors import HBMQTTException, MQTTException
 from hbmqtt.utils import format_client_message, gen_client_id
 from hbmqtt.adapters import (
@@ -27,16 +28,49 @@ from hbmqtt.adapters import (
     WriterAdapter,
     WebSocketsReader,
     WebSocketsWriter)
+from hbmqtt.capture import CaptureFile
+from hbmqtt.retained import RetainedStore
+from hbmqtt.wal import InflightLog
+from hbmqtt.admission import AdmissionControl
+from hbmqtt.cluster import Cluster
+from hbmqtt.loops import LoopGroup, LoopLink
+from hbmqtt.tls import TLSOffload, server_context
 from .plugins.manager import PluginManager, BaseContext
 
 _defaults = {
     'timeout-disconnect-delay': 2,
+    'session-expiry-interval': 0,
+    'broadcast-batch-size': 100,
+    'broadcast-shards': 1,
+    'loop-threads': 1,
     'auth': {
         'allow-anonymous': True,
         'password-file': None
     },
 }
 
+_persistence_defaults = {
+    'flush-interval': 1,
+    'flush-size': 1000,
+}
+
+_inflight_log_defaults = {
+    'segment-size': 16 * 1024 * 1024,
+    'max-segments': 8,
+    'sync-interval': 0.1,
+}
+
+_retained_store_defaults = {
+    'flush-interval': 1,
+    'fsync': False,
+    'compact-ratio': 2,
+    'compact-min-size': 1024 * 1024,
+}
+
+# Session attributes given by the CONNECT packet of each new connection
+_connect_attributes = ('username', 'password', 'keep_alive', 'will_flag', 'will_topic', 'will_message', 'will_qos',
+                       'will_retain', 'peercert')
+
 EVENT_BROKER_PRE_START = 'broker_pre_start'
 EVENT_BROKER_POST_START = 'broker_post_start'
 EVENT_BROKER_PRE_SHUTDOWN = 'broker_pre_shutdown'
@@ -52,20 +86,25 @@ class BrokerException(BaseException):
     pass
 
 
-class RetainedApplicationMessage:
-    def __init__(self, source_session, topic, data, qos=None):
-        self.source_session = source_session
-        self.topic = topic
-        self.data = data
-        self.qos = qos
-
-
 class Server:
     def __init__(self, listener_name, server_instance, max_connections=-1, loop=None):
         self.logger = logging.getLogger(__name__)
         self.instance = server_instance
         self.conn_count = 0
         self.listener_name = listener_name
+        self.capture = None
+        self.admission = None
+        # CONNECT deadline, in seconds, and maximum number of connections waiting for their CONNECT packet
+        self.connect_timeout = None
+        self.max_handshakes = 0
+        self.handshakes = 0
+        self.handshake_stats = {
+            'count': 0,
+            'duration_total': 0.0,
+            'duration_max': 0.0,
+            'timeouts': 0,
+            'rejected': 0,
+        }
         if loop is not None:
             self._loop = loop
         else:
@@ -100,11 +139,34 @@ class Server:
             self.logger.info("Listener '%s': %d connections acquired" %
                               (self.listener_name, self.conn_count))
 
+    def begin_handshake(self):
+        """
+        Account a connection waiting for its CONNECT packet
+        :return: False if too many handshakes are in progress
+        """
+        if self.max_handshakes > 0 and self.handshakes >= self.max_handshakes:
+            self.handshake_stats['rejected'] += 1
+            return False
+        self.handshakes += 1
+        return True
+
+    def end_handshake(self, duration, timed_out=False):
+        self.handshakes -= 1
+        stats = self.handshake_stats
+        if timed_out:
+            stats['timeouts'] += 1
+        else:
+            stats['count'] += 1
+            stats['duration_total'] += duration
+            stats['duration_max'] = max(stats['duration_max'], duration)
+
     @asyncio.coroutine
     def close_instance(self):
         if self.instance:
             self.instance.close()
             yield from self.instance.wait_closed()
+        if self.capture:
+            self.capture.close()
 
 
 class BrokerContext(BaseContext):
@@ -137,6 +199,23 @@ class BrokerContext(BaseContext):
     def subscriptions(self):
         return self._broker_instance._subscriptions
 
+    @property
+    def listeners(self):
+        return self._broker_instance._servers
+
+
+class BrokerStates(StateMachine):
+    states = ('new', 'starting', 'started', 'not_started', 'stopping', 'stopped', 'not_stopped')
+    initial = 'new'
+    triggers = {
+        'start': {'new': 'starting', 'stopped': 'starting'},
+        'starting_fail': {'starting': 'not_started'},
+        'starting_success': {'starting': 'started'},
+        'shutdown': {'started': 'stopping'},
+        'stopping_success': {'stopping': 'stopped'},
+        'stopping_failure': {'stopping': 'not_stopped'},
+    }
+
 
 class Broker:
     """
@@ -151,7 +230,7 @@ class Broker:
 
     def __init__(self, config=None, loop=None, plugin_namespace=None):
         self.logger = logging.getLogger(__name__)
-        self.config = _defaults
+        self.config = dict(_defaults)
         if config is not None:
             self.config.update(config)
         self._build_listeners_config(self.config)
@@ -165,10 +244,60 @@ class Broker:
         self._init_states()
         self._sessions = dict()
         self._subscriptions = dict()
+        # client_id -> {filter: qos} of the session subscriptions
+        self._client_subscriptions = dict()
         self._retained_messages = dict()
-        self._broadcast_queue = asyncio.Queue(loop=self._loop)
-
-        self._broadcast_task = None
+        # Broadcast messages are routed by shards, each with its own queue and loop, selected by topic hash so messages
+        # of a topic are routed in order, or by the shard of messages of the same session still waiting
+        self._broadcast_queues = [asyncio.Queue(loop=self._loop)
+                                  for i in range(max(1, int(self.config['broadcast-shards'])))]
+        # id(session) -> [number of messages published by the session waiting in broadcast queues, queue of these
+        # messages]
+        self._pending_broadcasts = dict()
+        # Publication tasks started by message routing
+        self._publish_tasks = deque()
+
+        self._broadcast_tasks = []
+
+        # Sessions persistence: names of plugins storing sessions and write-behind state
+        self._persistence_plugins = []
+        self._persistence_config = dict(_persistence_defaults)
+        self._persistence_config.update(self.config.get('persistence', None) or dict())
+        # client_id -> session to save, or None to delete
+        self._dirty_sessions = dict()
+        # Client ids of sessions subscribed from store at startup, whose state and messages aren't loaded yet
+        self._unloaded_sessions = set()
+        # client_id -> task loading a session of _unloaded_sessions
+        self._session_loads = dict()
+        self._flush_event = asyncio.Event(loop=self._loop)
+        self._flush_task = None
+
+        # Durable retained messages
+        self._retained_store = None
+        self._retained_store_config = None
+        self._retained_store_task = None
+
+        # Write-ahead log of in-flight messages, and messages recovered from it for sessions not reconnected yet
+        self._inflight_log = None
+        self._inflight_log_config = None
+        self._inflight_log_task = None
+        self._recovered_inflight = dict()
+
+        # Plugins authorizing topics
+        self._topic_plugins = []
+
+        # Links with the brokers of other workers: processes of a cluster or event loop threads
+        self._links = None
+
+        # Handlers of connections replaced by a new connection with the same client id
+        self._taken_over = set()
+
+        # Expiry of disconnected persistent sessions: client_id -> deadline, and heap of (deadline, client_id) which
+        # may hold outdated entries of sessions which reconnected since
+        self._session_expiry = dict()
+        self._expiry_heap = []
+        self._expiry_event = asyncio.Event(loop=self._loop)
+        self._expiry_task = None
 
         # Init plugins manager
         context = BrokerContext(self)
@@ -177,6 +306,7 @@ class Broker:
             namespace = plugin_namespace
         else:
             namespace = 'hbmqtt.broker.plugins'
+        self._plugin_namespace = namespace
         self.plugins_manager = PluginManager(namespace, context, self._loop)
 
     def _build_listeners_config(self, broker_config):
@@ -191,15 +321,22 @@ class Broker:
         except KeyError as ke:
             raise BrokerException("Listener config not found invalid: %s" % ke)
 
+    @staticmethod
+    def _build_admission_control(listener):
+        rate = float(listener.get('connection-rate', 0))
+        ip_rate = float(listener.get('ip-connection-rate', 0))
+        penalty = float(listener.get('auth-failure-penalty', 0))
+        if not (rate or ip_rate or penalty):
+            return None
+        return AdmissionControl(rate=rate,
+                                burst=float(listener.get('connection-burst', 0)),
+                                ip_rate=ip_rate,
+                                ip_burst=float(listener.get('ip-connection-burst', 0)),
+                                penalty=penalty,
+                                max_penalty=float(listener.get('auth-failure-penalty-max', 300)))
+
     def _init_states(self):
-        self.transitions = Machine(states=Broker.states, initial='new')
-        self.transitions.add_transition(trigger='start', source='new', dest='starting')
-        self.transitions.add_transition(trigger='starting_fail', source='starting', dest='not_started')
-        self.transitions.add_transition(trigger='starting_success', source='starting', dest='started')
-        self.transitions.add_transition(trigger='shutdown', source='started', dest='stopping')
-        self.transitions.add_transition(trigger='stopping_success', source='stopping', dest='stopped')
-        self.transitions.add_transition(trigger='stopping_failure', source='stopping', dest='not_stopped')
-        self.transitions.add_transition(trigger='start', source='stopped', dest='starting')
+        self.transitions = BrokerStates()
 
     @asyncio.coroutine
     def start(self):
@@ -213,7 +350,13 @@ class Broker:
         try:
             self._sessions = dict()
             self._subscriptions = dict()
+            self._client_subscriptions = dict()
             self._retained_messages = dict()
+            self._dirty_sessions = dict()
+            self._unloaded_sessions = set()
+            self._taken_over = set()
+            self._session_expiry = dict()
+            self._expiry_heap = []
             self.transitions.start()
             self.logger.debug("Broker starting")
         except MachineError as me:
@@ -222,6 +365,25 @@ class Broker:
 
         yield from self.plugins_manager.fire_event(EVENT_BROKER_PRE_START)
         try:
+            if self.config.get('retained-store', None):
+                yield from self._load_retained_store()
+            if self.config.get('inflight-log', None):
+                yield from self._open_inflight_log()
+            if self.config.get('cluster', None):
+                self._links = Cluster(self, self.config['cluster'], loop=self._loop)
+                yield from self._links.start()
+            elif int(self.config['loop-threads']) > 1:
+                self._links = LoopGroup(self, int(self.config['loop-threads'])).links[0]
+                yield from self._links.start()
+
+            # Stored sessions are only subscribed here, so that messages published before their client connects are
+            # queued. Their state and messages are loaded when needed, so startup time doesn't depend on the store size
+            if 'persistence' in self.config:
+                self._persistence_plugins = [p.name for p in self.plugins_manager.plugins
+                                             if hasattr(p.object, 'find_session')]
+            if self._persistence_plugins:
+                yield from self._load_stored_subscriptions()
+
             # Start network listeners
             for listener_name in self.listeners_config:
                 listener = self.listeners_config[listener_name]
@@ -245,15 +407,16 @@ class Broker:
 
                     if ssl_active:
                         try:
-                            sc = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                            sc.load_cert_chain(listener['certfile'], listener['keyfile'])
-                            sc.verify_mode = ssl.CERT_OPTIONAL
+                            sc = server_context(listener)
                         except KeyError as ke:
                             raise BrokerException("'certfile' or 'keyfile' configuration parameter missing: %s" % ke)
                         except FileNotFoundError as fnfe:
                             raise BrokerException("Can't read cert files '%s' or '%s' : %s" %
                                                   (listener['certfile'], listener['keyfile'], fnfe))
 
+                    connect_timeout = listener.get('connect-timeout', 10)
+                    connect_timeout = float(connect_timeout) if connect_timeout else None
+
                     address, s_port = listener['bind'].split(':')
                     port = 0
                     try:
@@ -263,26 +426,72 @@ class Broker:
 
                     if listener['type'] == 'tcp':
                         cb_partial = partial(self.stream_connected, listener_name=listener_name)
-                        instance = yield from asyncio.start_server(cb_partial,
-                                                                   address,
-                                                                   port,
-                                                                   ssl=sc,
-                                                                   loop=self._loop)
+                        server_kwargs = dict()
+                        if sc and connect_timeout and sys.version_info >= (3, 7):
+                            server_kwargs['ssl_handshake_timeout'] = connect_timeout
+                        if listener.get('reuse-port', False):
+                            server_kwargs['reuse_port'] = True
+                        ssl_offload = int(listener.get('ssl-offload', 0))
+                        if sc and ssl_offload > 0:
+                            if isinstance(self._links, LoopLink) and self._links.index:
+                                # Relayed connections are served by the first loop of the group
+                                instance = None
+                            else:
+                                # TLS is handled by helper processes relaying plaintext to the broker
+                                instance = TLSOffload(self, listener_name, listener, address, port, ssl_offload,
+                                                      loop=self._loop)
+                                yield from instance.start()
+                        elif isinstance(self._links, LoopLink):
+                            # Connections are accepted by the first loop of the group and served by the loop they
+                            # are assigned to
+                            instance = self._links.listen(listener_name, address, port, sc, server_kwargs)
+                        else:
+                            instance = yield from asyncio.start_server(cb_partial,
+                                                                       address,
+                                                                       port,
+                                                                       ssl=sc,
+                                                                       loop=self._loop,
+                                                                       **server_kwargs)
                         self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop)
                     elif listener['type'] == 'ws':
                         cb_partial = partial(self.ws_connected, listener_name=listener_name)
-                        instance = yield from websockets.serve(cb_partial, address, port, ssl=sc, loop=self._loop,
-                                                               subprotocols=['mqtt'])
+                        server_kwargs = dict()
+                        if listener.get('reuse-port', False):
+                            server_kwargs['reuse_port'] = True
+                        if isinstance(self._links, LoopLink) and self._links.index:
+                            # Websocket connections are served by the first loop of the group
+                            instance = None
+                        else:
+                            instance = yield from websockets.serve(cb_partial, address, port, ssl=sc, loop=self._loop,
+                                                                   subprotocols=['mqtt'], **server_kwargs)
                         self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop)
 
+                    if listener.get('capture', None):
+                        self._servers[listener_name].capture = CaptureFile(listener['capture'])
+                        self.logger.info("Listener '%s' traffic captured to '%s'" % (listener_name, listener['capture']))
+                    self._servers[listener_name].admission = self._build_admission_control(listener)
+                    self._servers[listener_name].connect_timeout = connect_timeout
+                    self._servers[listener_name].max_handshakes = int(listener.get('max-handshakes', 0))
+
                     self.logger.info("Listener '%s' bind to %s (max_connections=%d)" %
                                      (listener_name, listener['bind'], max_connections))
 
             self.transitions.starting_success()
             yield from self.plugins_manager.fire_event(EVENT_BROKER_POST_START)
 
-            #Start broadcast loop
-            self._broadcast_task = ensure_future(self._broadcast_loop(), loop=self._loop)
+            #Start broadcast loops
+            self._broadcast_tasks = [ensure_future(self._broadcast_loop(queue), loop=self._loop)
+                                     for queue in self._broadcast_queues]
+
+            self._topic_plugins = self._get_topic_plugins()
+            if self._persistence_plugins:
+                self._flush_task = ensure_future(self._session_flush_loop(), loop=self._loop)
+            if self._retained_store:
+                self._retained_store_task = ensure_future(self._retained_store_loop(), loop=self._loop)
+            if self._inflight_log:
+                self._inflight_log_task = ensure_future(self._inflight_log_loop(), loop=self._loop)
+            if float(self.config['session-expiry-interval']) > 0:
+                self._expiry_task = ensure_future(self._session_expiry_loop(), loop=self._loop)
 
             self.logger.debug("Broker started")
         except Exception as e:
@@ -298,26 +507,61 @@ class Broker:
             Closes all connected session, stop listening on network socket and free resources.
         """
         try:
-            self._sessions = dict()
-            self._subscriptions = dict()
-            self._retained_messages = dict()
             self.transitions.shutdown()
         except MachineError as me:
             self.logger.debug("Invalid method call at this moment: %s" % me)
             raise BrokerException("Broker instance can't be stopped: %s" % me)
 
+        if self._expiry_task:
+            self._expiry_task.cancel()
+            yield from asyncio.wait([self._expiry_task], loop=self._loop)
+            self._expiry_task = None
+        # Write pending session changes while persistence plugins are still running
+        if self._session_loads:
+            yield from asyncio.wait(list(self._session_loads.values()), loop=self._loop)
+        if self._flush_task:
+            self._flush_task.cancel()
+            yield from asyncio.wait([self._flush_task], loop=self._loop)
+            self._flush_task = None
+        if self._dirty_sessions:
+            yield from self._flush_sessions()
+        if self._retained_store:
+            if self._retained_store_task:
+                self._retained_store_task.cancel()
+                yield from asyncio.wait([self._retained_store_task], loop=self._loop)
+                self._retained_store_task = None
+            self._retained_store.close()
+            self._retained_store = None
+        if self._inflight_log:
+            if self._inflight_log_task:
+                self._inflight_log_task.cancel()
+                yield from asyncio.wait([self._inflight_log_task], loop=self._loop)
+                self._inflight_log_task = None
+            self._inflight_log.close()
+            self._inflight_log = None
+            self._recovered_inflight = dict()
+        self._sessions = dict()
+        self._subscriptions = dict()
+        self._client_subscriptions = dict()
+        self._retained_messages = dict()
+
         # Fire broker_shutdown event to plugins
         yield from self.plugins_manager.fire_event(EVENT_BROKER_PRE_SHUTDOWN)
 
         # Stop broadcast loop
-        if self._broadcast_task:
-            self._broadcast_task.cancel()
-        if self._broadcast_queue.qsize() > 0:
-            self.logger.warning("%d messages not broadcasted" % self._broadcast_queue.qsize())
+        for task in self._broadcast_tasks:
+            task.cancel()
+        self._broadcast_tasks = []
+        pending = sum(queue.qsize() for queue in self._broadcast_queues)
+        if pending > 0:
+            self.logger.warning("%d messages not broadcasted" % pending)
 
         for listener_name in self._servers:
             server = self._servers[listener_name]
             yield from server.close_instance()
+        if self._links:
+            yield from self._links.close()
+            self._links = None
         self.logger.debug("Broker closing")
         self.logger.info("Broker closed")
         yield from self.plugins_manager.fire_event(EVENT_BROKER_POST_SHUTDOWN)
@@ -336,19 +580,49 @@ class Broker:
         yield from self.client_connected(listener_name, StreamReaderAdapter(reader), StreamWriterAdapter(writer))
 
     @asyncio.coroutine
-    def client_connected(self, listener_name, reader: ReaderAdapter, writer: WriterAdapter):
+    def client_connected(self, listener_name, reader: ReaderAdapter, writer: WriterAdapter, admitted=False):
+        """
+        Serve a client connection
+        :param admitted: True for connections already admitted by the broker which accepted them and passed them to
+            this one
+        """
         # Wait for connection available on listener
         server = self._servers.get(listener_name, None)
         if not server:
             raise BrokerException("Invalid listener name '%s'" % listener_name)
-        yield from server.acquire_connection()
-
         remote_address, remote_port = writer.get_peer_info()
+        if server.admission and not admitted:
+            # Reject before reading anything from the connection so rejected clients cost as little as possible
+            reason = server.admission.admit(remote_address)
+            if reason is not None:
+                self.logger.debug("Connection from %s:%d on listener '%s' rejected: %s" %
+                                  (remote_address, remote_port, listener_name, reason))
+                yield from writer.close()
+                return
+        if not server.begin_handshake():
+            self.logger.warning("Connection from %s:%d on listener '%s' rejected: too many handshakes in progress" %
+                                (remote_address, remote_port, listener_name))
+            yield from writer.close()
+            return
+        if server.capture:
+            reader, writer = server.capture.tap(reader, writer)
+
         self.logger.info("Connection from %s:%d on listener '%s'" % (remote_address, remote_port, listener_name))
 
         # Wait for first packet and expect a CONNECT
+        handshake_start = self._loop.time()
+        timed_out = False
         try:
-            handler, client_session = yield from BrokerProtocolHandler.init_from_connect(reader, writer, self.plugins_manager, loop=self._loop)
+            handler, client_session = yield from asyncio.wait_for(
+                BrokerProtocolHandler.init_from_connect(reader, writer, self.plugins_manager, loop=self._loop),
+                server.connect_timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            timed_out = True
+            self.logger.warning("%s: no CONNECT received within %s seconds" %
+                                (format_client_message(address=remote_address, port=remote_port),
+                                 server.connect_timeout))
+            yield from writer.close()
+            return
         except HBMQTTException as exc:
             self.logger.warn("[MQTT-3.1.0-1] %s: Can't read first packet an CONNECT: %s" %
                              (format_client_message(address=remote_address, port=remote_port), exc))
@@ -361,6 +635,36 @@ class Broker:
             yield from writer.close()
             self.logger.debug("Connection closed")
             return
+        finally:
+            server.end_handshake(self._loop.time() - handshake_start, timed_out)
+        # The connection slot is only taken once CONNECT is received, so that connections waiting for a slot are not
+        # counted as handshakes in progress, and idle connections are closed by the CONNECT deadline
+        yield from server.acquire_connection()
+        client_session.peercert = writer.get_peer_cert()
+
+        if self._links and not client_session.clean_session and \
+                self._links.handoff(listener_name, client_session, reader, writer):
+            # The session belongs to another worker, which now serves the connection
+            server.release_connection()
+            return
+
+        # Authenticate with the CONNECT credentials before using any existing session, so that a client failing
+        # authentication can't take over or delete the session of another client
+        authenticated = yield from self.authenticate(client_session, self.listeners_config[listener_name])
+        if server.admission:
+            if authenticated:
+                server.admission.auth_succeeded(remote_address)
+            else:
+                server.admission.auth_failed(remote_address)
+        if not authenticated:
+            yield from writer.close()
+            server.release_connection()
+            return
+
+        if client_session.client_id in self._unloaded_sessions:
+            yield from asyncio.shield(self._load_stored_session(client_session.client_id), loop=self._loop)
+        if client_session.client_id in self._sessions:
+            yield from self._takeover(client_session.client_id)
 
         if client_session.clean_session:
             # Delete existing session and create a new one
@@ -370,57 +674,108 @@ class Broker:
                 client_session.client_id = gen_client_id()
             client_session.parent = 0
         else:
-            # Get session from cache
+            # Get session from cache, then from store
             if client_session.client_id in self._sessions:
                 self.logger.debug("Found old session %s" % repr(self._sessions[client_session.client_id]))
-                (client_session,h) = self._sessions[client_session.client_id]
+                connect_session = client_session
+                client_session = self._sessions[client_session.client_id][0]
+                for attr in _connect_attributes:
+                    setattr(client_session, attr, getattr(connect_session, attr))
                 client_session.parent = 1
             else:
-                client_session.parent = 0
+                stored_session = yield from self._load_session(client_session)
+                if stored_session is not None:
+                    client_session = stored_session
+                    client_session.parent = 1
+                else:
+                    client_session.parent = 0
+                self._restore_inflight(client_session)
         if client_session.keep_alive > 0:
             client_session.keep_alive += self.config['timeout-disconnect-delay']
         self.logger.debug("Keep-alive timeout=%d" % client_session.keep_alive)
 
         handler.attach(client_session, reader, writer)
+        handler.router = self._route_message
+        if not client_session.clean_session:
+            handler.inflight_log = self._inflight_log
         self._sessions[client_session.client_id] = (client_session, handler)
+        self._session_expiry.pop(client_session.client_id, None)
 
-        authenticated = yield from self.authenticate(client_session, self.listeners_config[listener_name])
-        if not authenticated:
-            yield from writer.close()
-            return
-
-        while True:
-            try:
-                client_session.transitions.connect()
-                break
-            except MachineError:
-                self.logger.warning("Client %s is reconnecting too quickly, make it wait" % client_session.client_id)
-                # Wait a bit may be client is reconnecting too fast
-                yield from asyncio.sleep(1, loop=self._loop)
+        client_session.transitions.connect()
         yield from handler.mqtt_connack_authorize(authenticated)
+        self._session_changed(client_session)
 
         yield from self.plugins_manager.fire_event(EVENT_BROKER_CLIENT_CONNECTED, client_id=client_session.client_id)
 
         self.logger.debug("%s Start messages handling" % client_session.client_id)
         yield from handler.start()
-        self.logger.debug("Retained messages queue size: %d" % client_session.retained_messages.qsize())
+        self.logger.debug("Retained messages queue size: %d" % client_session.retained_messages_count)
         yield from self.publish_session_retained_messages(client_session)
 
-        # Init and start loop for handling client messages (publish, subscribe/unsubscribe, disconnect)
-        disconnect_waiter = ensure_future(handler.wait_disconnect(), loop=self._loop)
-        subscribe_waiter = ensure_future(handler.get_next_pending_subscription(), loop=self._loop)
-        unsubscribe_waiter = ensure_future(handler.get_next_pending_unsubscription(), loop=self._loop)
-        wait_deliver = ensure_future(handler.mqtt_deliver_next_message(), loop=self._loop)
+        # Handle client events (publish, subscribe/unsubscribe, disconnect) in the order they were received
         connected = True
         while connected:
             try:
-                done, pending = yield from asyncio.wait(
-                    [disconnect_waiter, subscribe_waiter, unsubscribe_waiter, wait_deliver],
-                    return_when=asyncio.FIRST_COMPLETED, loop=self._loop)
-                if disconnect_waiter in done:
-                    result = disconnect_waiter.result()
-                    self.logger.debug("%s Result from wait_diconnect: %s" % (client_session.client_id, result))
-                    if result is None:
+                kind, data = yield from handler.next_event()
+                if kind == INBOX_MESSAGE:
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("%s handling message delivery" % client_session.client_id)
+                    app_message = data
+                    if not app_message.topic:
+                        self.logger.warn("[MQTT-4.7.3-1] - %s invalid TOPIC sent in PUBLISH message, closing connection" % client_session.client_id)
+                        break
+                    if "#" in app_message.topic or "+" in app_message.topic:
+                        self.logger.warn("[MQTT-3.3.2-2] - %s invalid TOPIC sent in PUBLISH message, closing connection" % client_session.client_id)
+                        break
+                    yield from self.plugins_manager.fire_event(EVENT_BROKER_MESSAGE_RECEIVED,
+                                                               client_id=client_session.client_id,
+                                                               message=app_message)
+                    allowed = yield from self.topic_filtering(client_session, app_message.topic, 'publish')
+                    if allowed:
+                        yield from self._broadcast_message(client_session, app_message.topic, app_message.data)
+                        if app_message.publish_packet.retain_flag:
+                            self.retain_message(client_session, app_message.topic, app_message.data,
+                                                app_message.qos)
+                    if app_message.qos:
+                        self._session_changed(client_session)
+                elif kind == INBOX_SUBSCRIBE:
+                    self.logger.debug("%s handling subscription" % client_session.client_id)
+                    subscriptions = data
+                    return_codes = []
+                    for subscription in subscriptions['topics']:
+                        allowed = yield from self.topic_filtering(client_session, subscription[0], 'subscribe')
+                        if allowed:
+                            return_codes.append(self.add_subscription(subscription, client_session))
+                        else:
+                            return_codes.append(0x80)
+                    self._session_changed(client_session)
+                    yield from handler.mqtt_acknowledge_subscription(subscriptions['packet_id'], return_codes)
+                    for index, subscription in enumerate(subscriptions['topics']):
+                        if return_codes[index] != 0x80:
+                            yield from self.plugins_manager.fire_event(
+                                EVENT_BROKER_CLIENT_SUBSCRIBED,
+                                client_id=client_session.client_id,
+                                topic=subscription[0],
+                                qos=subscription[1])
+                            yield from self.publish_retained_messages_for_subscription(subscription, client_session)
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug(repr(self._subscriptions))
+                elif kind == INBOX_UNSUBSCRIBE:
+                    self.logger.debug("%s handling unsubscription" % client_session.client_id)
+                    unsubscription = data
+                    for topic in unsubscription['topics']:
+                        self._del_subscription(topic, client_session)
+                        yield from self.plugins_manager.fire_event(
+                            EVENT_BROKER_CLIENT_UNSUBSCRIBED,
+                            client_id=client_session.client_id,
+                            topic=topic)
+                    self._session_changed(client_session)
+                    yield from handler.mqtt_acknowledge_unsubscription(unsubscription['packet_id'])
+                elif kind == INBOX_DISCONNECT:
+                    self.logger.debug("%s Disconnection: %s" % (client_session.client_id, data))
+                    taken_over = handler in self._taken_over
+                    self._taken_over.discard(handler)
+                    if data is None and not taken_over:
                         self.logger.debug("Will flag: %s" % client_session.will_flag)
                         # Connection closed anormally, send will message
                         if client_session.will_flag:
@@ -437,62 +792,17 @@ class Broker:
                                                     client_session.will_message,
                                                     client_session.will_qos)
                     self.logger.debug("%s Disconnecting session" % client_session.client_id)
-                    yield from self._stop_handler(handler)
-                    client_session.transitions.disconnect()
+                    if not taken_over:
+                        # A taken over session was already disconnected and now belongs to the new connection
+                        yield from self._stop_handler(handler)
+                        client_session.transitions.disconnect()
+                        self._session_changed(client_session)
+                        self._schedule_expiry(client_session)
                     yield from self.plugins_manager.fire_event(EVENT_BROKER_CLIENT_DISCONNECTED, client_id=client_session.client_id)
                     connected = False
-                if unsubscribe_waiter in done:
-                    self.logger.debug("%s handling unsubscription" % client_session.client_id)
-                    unsubscription = unsubscribe_waiter.result()
-                    for topic in unsubscription['topics']:
-                        self._del_subscription(topic, client_session)
-                        yield from self.plugins_manager.fire_event(
-                            EVENT_BROKER_CLIENT_UNSUBSCRIBED,
-                            client_id=client_session.client_id,
-                            topic=topic)
-                    yield from handler.mqtt_acknowledge_unsubscription(unsubscription['packet_id'])
-                    unsubscribe_waiter = asyncio.Task(handler.get_next_pending_unsubscription(), loop=self._loop)
-                if subscribe_waiter in done:
-                    self.logger.debug("%s handling subscription" % client_session.client_id)
-                    subscriptions = subscribe_waiter.result()
-                    return_codes = []
-                    for subscription in subscriptions['topics']:
-                        return_codes.append(self.add_subscription(subscription, client_session))
-                    yield from handler.mqtt_acknowledge_subscription(subscriptions['packet_id'], return_codes)
-                    for index, subscription in enumerate(subscriptions['topics']):
-                        if return_codes[index] != 0x80:
-                            yield from self.plugins_manager.fire_event(
-                                EVENT_BROKER_CLIENT_SUBSCRIBED,
-                                client_id=client_session.client_id,
-                                topic=subscription[0],
-                                qos=subscription[1])
-                            yield from self.publish_retained_messages_for_subscription(subscription, client_session)
-                    subscribe_waiter = asyncio.Task(handler.get_next_pending_subscription(), loop=self._loop)
-                    self.logger.debug(repr(self._subscriptions))
-                if wait_deliver in done:
-                    if self.logger.isEnabledFor(logging.DEBUG):
-                        self.logger.debug("%s handling message delivery" % client_session.client_id)
-                    app_message = wait_deliver.result()
-                    if not app_message.topic:
-                        self.logger.warn("[MQTT-4.7.3-1] - %s invalid TOPIC sent in PUBLISH message, closing connection" % client_session.client_id)
-                        break
-                    if "#" in app_message.topic or "+" in app_message.topic:
-                        self.logger.warn("[MQTT-3.3.2-2] - %s invalid TOPIC sent in PUBLISH message, closing connection" % client_session.client_id)
-                        break
-                    yield from self.plugins_manager.fire_event(EVENT_BROKER_MESSAGE_RECEIVED,
-                                                               client_id=client_session.client_id,
-                                                               message=app_message)
-                    yield from self._broadcast_message(client_session, app_message.topic, app_message.data)
-                    if app_message.publish_packet.retain_flag:
-                        self.retain_message(client_session, app_message.topic, app_message.data, app_message.qos)
-                    wait_deliver = asyncio.Task(handler.mqtt_deliver_next_message(), loop=self._loop)
             except asyncio.CancelledError:
                 self.logger.debug("Client loop cancelled")
                 break
-        disconnect_waiter.cancel()
-        subscribe_waiter.cancel()
-        unsubscribe_waiter.cancel()
-        wait_deliver.cancel()
 
         self.logger.debug("%s Client disconnected" % client_session.client_id)
         server.release_connection()
@@ -507,6 +817,24 @@ class Broker:
         handler.attach(session, reader, writer)
         return handler
 
+    @asyncio.coroutine
+    def _takeover(self, client_id):
+        """
+        [MQTT-3.1.4-2] Disconnect the client already connected with a client id used by a new connection. The previous
+        handler is stopped right away so that the session can be attached to the new connection.
+        :param client_id:
+        """
+        session, handler = self._sessions[client_id]
+        if not session.transitions.is_connected():
+            return
+        self.logger.info("Client %s connected again, closing previous connection" % format_client_message(session))
+        self._taken_over.add(handler)
+        session.transitions.disconnect()
+        yield from self._stop_handler(handler)
+        if session.clean_session:
+            # A clean session ends with its connection
+            self.delete_session(client_id)
+
     @asyncio.coroutine
     def _stop_handler(self, handler):
         """
@@ -552,17 +880,59 @@ class Broker:
         # If all plugins returned True, authentication is success
         return auth_result
 
+    def _get_topic_plugins(self):
+        topic_config = self.config.get('topic-check', None)
+        if not topic_config or not topic_config.get('enabled', False):
+            return []
+        names = topic_config.get('plugins', None)
+        return [p.object for p in self.plugins_manager.plugins
+                if hasattr(p.object, 'topic_filtering') and (names is None or p.name in names)]
+
+    @asyncio.coroutine
+    def topic_filtering(self, session: Session, topic, action):
+        """
+        This method calls the topic_filtering method on plugins enabled in 'topic-check' configuration, to check if
+        a session can subscribe or publish to a topic. Access is allowed if no plugin returns False.
+        Plugins are called directly rather than through the plugin manager because this is done for every PUBLISH.
+        :param session: client session
+        :param topic: topic filter for 'subscribe' action, topic name for 'publish' action
+        :param action: 'subscribe' or 'publish'
+        :return: True if access is allowed
+        """
+        for plugin in self._topic_plugins:
+            allowed = yield from plugin.topic_filtering(session=session, topic=topic, action=action)
+            if allowed is False:
+                self.logger.debug("%s on '%s' denied to %s by plugin %s" %
+                                  (action, topic, format_client_message(session=session), type(plugin).__name__))
+                return False
+        return True
+
     def retain_message(self, source_session, topic_name, data, qos=None):
+        if self._links and source_session is not None:
+            # Retained messages published by clients are set by the worker owning their topic
+            self._links.retain(topic_name, data, qos)
+        else:
+            self._retain(topic_name, data, qos)
+
+    def _retain(self, topic_name, data, qos=None, store=True):
+        """
+        Set or clear the retained message of a topic
+        :param store: write the change to the retained messages store
+        """
         if data is not None and data != b'':
             # If retained flag set, store the message for further subscriptions
             self.logger.debug("Retaining message on topic %s" % topic_name)
-            retained_message = RetainedApplicationMessage(source_session, topic_name, data, qos)
+            retained_message = RetainedApplicationMessage(topic_name, data, qos)
             self._retained_messages[topic_name] = retained_message
+            if store and self._retained_store:
+                self._retained_store.retain(topic_name, data, qos)
         else:
             # [MQTT-3.3.1-10]
             if topic_name in self._retained_messages:
                 self.logger.debug("Clear retained messages for topic '%s'" % topic_name)
                 del self._retained_messages[topic_name]
+                if store and self._retained_store:
+                    self._retained_store.clear(topic_name)
 
     def add_subscription(self, subscription, session):
         import re
@@ -587,6 +957,9 @@ class Broker:
                 (s for (s,qos) in self._subscriptions[a_filter] if s.client_id == session.client_id), None)
             if not already_subscribed:
                 self._subscriptions[a_filter].append((session, qos))
+                self._client_subscriptions.setdefault(session.client_id, dict())[a_filter] = qos
+                if self._links:
+                    self._links.subscribed(a_filter)
             else:
                 self.logger.debug("Client %s has already subscribed to %s" % (format_client_message(session=session), a_filter))
             return qos
@@ -608,6 +981,13 @@ class Broker:
                     self.logger.debug("Removing subscription on topic '%s' for client %s" %
                                       (a_filter, format_client_message(session=session)))
                     subscriptions.pop(index)
+                    if self._links:
+                        self._links.unsubscribed(a_filter)
+                    client_subscriptions = self._client_subscriptions.get(session.client_id, None)
+                    if client_subscriptions is not None:
+                        client_subscriptions.pop(a_filter, None)
+                        if not client_subscriptions:
+                            del self._client_subscriptions[session.client_id]
                     deleted += 1
                     break
         except KeyError:
@@ -623,7 +1003,7 @@ class Broker:
         :return:
         """
         filter_queue = deque()
-        for topic in self._subscriptions:
+        for topic in list(self._client_subscriptions.get(session.client_id, ())):
             if self._del_subscription(topic, session):
                 filter_queue.append(topic)
         for topic in filter_queue:
@@ -640,46 +1020,165 @@ class Broker:
             return match_pattern.match(topic)
 
     @asyncio.coroutine
-    def _broadcast_loop(self):
-        running_tasks = deque()
+    def _broadcast_loop(self, queue):
+        """
+        Route messages of a broadcast shard
+        :param queue: queue of the shard
+        """
+        batch_size = int(self.config['broadcast-batch-size'])
         try:
             while True:
-                while running_tasks and running_tasks[0].done():
-                    running_tasks.popleft()
-                broadcast = yield from self._broadcast_queue.get()
+                batch = [(yield from queue.get())]
+                # Take messages queued meanwhile, so subscribers are resolved once per topic of the batch
+                while len(batch) < batch_size and not queue.empty():
+                    batch.append(queue.get_nowait())
                 if self.logger.isEnabledFor(logging.DEBUG):
-                    self.logger.debug("broadcasting %r" % broadcast)
-                for k_filter in self._subscriptions:
-                    if broadcast['topic'].startswith("$") and (k_filter.startswith("+") or k_filter.startswith("#")):
-                        self.logger.debug("[MQTT-4.7.2-1] - ignoring brodcasting $ topic to subscriptions starting with + or #")
-                    elif self.matches(broadcast['topic'], k_filter):
-                        subscriptions = self._subscriptions[k_filter]
-                        for (target_session, qos) in subscriptions:
-                            if 'qos' in broadcast:
-                                qos = broadcast['qos']
-                            if target_session.transitions.state == 'connected':
-                                self.logger.debug("broadcasting application message from %s on topic '%s' to %s" %
-                                                  (format_client_message(session=broadcast['session']),
-                                                   broadcast['topic'], format_client_message(session=target_session)))
-                                handler = self._get_handler(target_session)
-                                task = ensure_future(
-                                    handler.mqtt_publish(broadcast['topic'], broadcast['data'], qos, retain=False),
-                                    loop=self._loop)
-                                running_tasks.append(task)
-                            else:
-                                self.logger.debug("retaining application message from %s on topic '%s' to client '%s'" %
-                                                  (format_client_message(session=broadcast['session']),
-                                                   broadcast['topic'], format_client_message(session=target_session)))
-                                retained_message = RetainedApplicationMessage(
-                                    broadcast['session'], broadcast['topic'], broadcast['data'], qos)
-                                yield from target_session.retained_messages.put(retained_message)
+                    self.logger.debug("broadcasting %r" % batch)
+                self._route_batch(batch)
+                self._broadcasts_routed(batch)
+                if not queue.empty():
+                    # Getting from a non empty queue doesn't yield: let other shards and publications run
+                    yield from asyncio.sleep(0, loop=self._loop)
         except CancelledError:
             # Wait until current broadcasting tasks end
-            if running_tasks:
-                yield from asyncio.wait(running_tasks, loop=self._loop)
+            if self._publish_tasks:
+                yield from asyncio.wait(self._publish_tasks, loop=self._loop)
+
+    def _broadcasts_routed(self, batch):
+        pending_broadcasts = self._pending_broadcasts
+        for broadcast in batch:
+            session = broadcast['session']
+            if session is not None:
+                pending = pending_broadcasts[id(session)]
+                pending[0] -= 1
+                if not pending[0]:
+                    del pending_broadcasts[id(session)]
+
+    def _subscribers(self, topic):
+        """
+        Get sessions subscribed to a topic
+        :return: list of (session, subscription qos) tuples
+        """
+        subscribers = []
+        for k_filter in self._subscriptions:
+            if topic.startswith("$") and (k_filter.startswith("+") or k_filter.startswith("#")):
+                self.logger.debug("[MQTT-4.7.2-1] - ignoring brodcasting $ topic to subscriptions starting with + or #")
+            elif self.matches(topic, k_filter):
+                subscribers.extend(self._subscriptions[k_filter])
+        return subscribers
+
+    def _prune_publish_tasks(self):
+        publish_tasks = self._publish_tasks
+        while publish_tasks and publish_tasks[0].done():
+            publish_tasks.popleft()
+
+    def _deliver(self, source_session, target_session, topic, data, qos):
+        """
+        Send a message to a connected session, or queue it if the session is disconnected
+        """
+        if target_session.transitions.state == 'connected':
+            self.logger.debug("broadcasting application message from %s on topic '%s' to %s" %
+                              (format_client_message(session=source_session),
+                               topic, format_client_message(session=target_session)))
+            handler = self._get_handler(target_session)
+            self._publish_tasks.append(ensure_future(
+                handler.mqtt_publish(topic, data, qos, retain=False), loop=self._loop))
+            if qos:
+                self._session_changed(target_session)
+        else:
+            self.logger.debug("retaining application message from %s on topic '%s' to client '%s'" %
+                              (format_client_message(session=source_session),
+                               topic, format_client_message(session=target_session)))
+            target_session.retained_messages.put_nowait(RetainedApplicationMessage(topic, data, qos))
+            self._session_changed(target_session)
+
+    def _route(self, source_session, topic, data, force_qos=None):
+        """
+        Send a message to sessions subscribed to its topic, or queue it for disconnected sessions. Publications to
+        connected sessions are started as tasks, so routing never waits.
+        :param source_session: session which published the message
+        :param force_qos: QoS used for all subscribers instead of the subscription QoS
+        """
+        self._prune_publish_tasks()
+        for target_session, qos in self._subscribers(topic):
+            self._deliver(source_session, target_session, topic, data, force_qos if force_qos else qos)
+
+    def _route_batch(self, batch):
+        """
+        Route a batch of broadcast messages. Subscribers are resolved once per distinct topic, and each connected
+        subscriber gets its messages of the batch, in order, in a single publication task so QoS 0 messages are
+        written together.
+        :param batch: list of broadcast dicts
+        """
+        self._prune_publish_tasks()
+        if len(batch) == 1:
+            broadcast = batch[0]
+            self._route(broadcast['session'], broadcast['topic'], broadcast['data'], broadcast.get('qos', None))
+            return
+        topic_subscribers = dict()
+        # id(session) -> (session, [(topic, data, qos)]), in order of first message
+        groups = OrderedDict()
+        for broadcast in batch:
+            topic = broadcast['topic']
+            subscribers = topic_subscribers.get(topic, None)
+            if subscribers is None:
+                subscribers = topic_subscribers[topic] = self._subscribers(topic)
+            force_qos = broadcast.get('qos', None)
+            for target_session, qos in subscribers:
+                if force_qos:
+                    qos = force_qos
+                if target_session.transitions.state == 'connected':
+                    group = groups.get(id(target_session), None)
+                    if group is None:
+                        group = groups[id(target_session)] = (target_session, [])
+                    group[1].append((topic, broadcast['data'], qos))
+                else:
+                    self._deliver(broadcast['session'], target_session, topic, broadcast['data'], qos)
+        for target_session, messages in groups.values():
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("broadcasting %d application messages to %s" %
+                                  (len(messages), format_client_message(session=target_session)))
+            handler = self._get_handler(target_session)
+            self._publish_tasks.append(ensure_future(handler.mqtt_publish_group(messages), loop=self._loop))
+            if any(qos for topic, data, qos in messages):
+                self._session_changed(target_session)
+
+    def _route_message(self, session, app_message):
+        """
+        Route a message as soon as the protocol handler of the publishing client receives it, without going through
+        the client loop and the broadcast queue. Messages on invalid topics, whose publication must be checked by
+        topic filtering plugins, or published while earlier messages of the session wait in a broadcast queue, are
+        left to the client loop.
+        :param session: publishing session
+        :param app_message: IncomingApplicationMessage
+        :return: True if the message was routed
+        """
+        topic = app_message.topic
+        if self._topic_plugins or not topic or '#' in topic or '+' in topic:
+            return False
+        if id(session) in self._pending_broadcasts:
+            # Earlier messages of the session wait in a broadcast queue: queue this one after them
+            return False
+        self.plugins_manager.schedule_event(EVENT_BROKER_MESSAGE_RECEIVED,
+                                            client_id=session.client_id, message=app_message)
+        self._route(session, topic, app_message.data)
+        if self._links:
+            self._links.forward(topic, app_message.data)
+        if app_message.publish_packet.retain_flag:
+            self.retain_message(session, topic, app_message.data, app_message.qos)
+        if app_message.qos:
+            self._session_changed(session)
+        return True
 
     @asyncio.coroutine
     def _broadcast_message(self, session, topic, data, force_qos=None):
+        self._queue_broadcast(session, topic, data, force_qos)
+
+    def _queue_broadcast(self, session, topic, data, force_qos=None):
+        """
+        Queue a message to be routed by the broadcast shard of its topic
+        :param session: session which published the message, or None for messages of the broker
+        """
         broadcast = {
             'session': session,
             'topic': topic,
@@ -687,16 +1186,29 @@ class Broker:
         }
         if force_qos:
             broadcast['qos'] = force_qos
-        yield from self._broadcast_queue.put(broadcast)
+        queues = self._broadcast_queues
+        queue = queues[hash(topic) % len(queues)] if len(queues) > 1 else queues[0]
+        if session is not None:
+            pending = self._pending_broadcasts.get(id(session), None)
+            if pending is None:
+                self._pending_broadcasts[id(session)] = [1, queue]
+            else:
+                # Messages of a session go to the shard of its messages still waiting, so they keep their order
+                pending[0] += 1
+                queue = pending[1]
+            if self._links:
+                # Messages of the broker itself stay in this worker
+                self._links.forward(topic, data, force_qos)
+        queue.put_nowait(broadcast)
 
     @asyncio.coroutine
     def publish_session_retained_messages(self, session):
         self.logger.debug("Publishing %d messages retained for session %s" %
-                          (session.retained_messages.qsize(), format_client_message(session=session))
+                          (session.retained_messages_count, format_client_message(session=session))
                           )
         publish_tasks = []
         handler = self._get_handler(session)
-        while not session.retained_messages.empty():
+        while session.retained_messages_count:
             retained = yield from session.retained_messages.get()
             publish_tasks.append(ensure_future(
                 handler.mqtt_publish(
@@ -729,6 +1241,13 @@ class Broker:
         :param client_id:
         :return:
         """
+        # The session may be stored without having been loaded since startup
+        self._session_deleted(client_id)
+        self._unloaded_sessions.discard(client_id)
+        self._session_expiry.pop(client_id, None)
+        if self._inflight_log:
+            self._inflight_log.discard(client_id)
+            self._recovered_inflight.pop(client_id, None)
         try:
             session = self._sessions[client_id][0]
         except KeyError:
@@ -744,6 +1263,290 @@ class Broker:
         self.logger.debug("deleting existing session %s" % repr(self._sessions[client_id]))
         del self._sessions[client_id]
 
+    def _session_changed(self, session):
+        """
+        Mark a persistent session to be saved by the next flush
+        """
+        if self._persistence_plugins and not session.clean_session:
+            if session.client_id in self._unloaded_sessions:
+                # Message queued for a session subscribed from store: load it, so that the message is saved with it
+                self._load_stored_session(session.client_id)
+                return
+            self._dirty_sessions[session.client_id] = session
+            if len(self._dirty_sessions) >= int(self._persistence_config['flush-size']):
+                self._flush_event.set()
+
+    def _session_deleted(self, client_id):
+        """
+        Mark a session to be deleted from store by the next flush
+        """
+        if self._persistence_plugins:
+            self._dirty_sessions[client_id] = None
+
+    @asyncio.coroutine
+    def _find_session(self, client_id):
+        """
+        Find a session in the persistence plugins
+        :return: (session, subscriptions) tuple, or None if not stored
+        """
+        returns = yield from self.plugins_manager.map_plugin_coro(
+            "find_session",
+            client_id=client_id,
+            filter_plugins=self._persistence_plugins)
+        return next((ret for ret in returns.values() if ret), None)
+
+    @asyncio.coroutine
+    def _load_session(self, connect_session):
+        """
+        Load a persistent session from store
+        :param connect_session: session built from the CONNECT packet
+        :return: restored session, or None if not stored
+        """
+        client_id = connect_session.client_id
+        if not self._persistence_plugins or client_id in self._dirty_sessions:
+            # Pending changes are only deletions for sessions not in memory
+            return None
+        stored = yield from self._find_session(client_id)
+        if stored is None:
+            return None
+        session, subscriptions = stored
+        self.logger.debug("Loaded stored session %s" % repr(session))
+        # Credentials, keep alive and will are those of the new connection
+        for attr in _connect_attributes:
+            setattr(session, attr, getattr(connect_session, attr))
+        session.clean_session = False
+        for subscription in subscriptions:
+            self.add_subscription(subscription, session)
+        return session
+
+    @asyncio.coroutine
+    def _load_stored_subscriptions(self):
+        """
+        Subscribe sessions found in store with a disconnected placeholder session each, until they are loaded by
+        :meth:`_load_stored_session`
+        """
+        returns = yield from self.plugins_manager.map_plugin_coro(
+            "find_subscriptions",
+            filter_plugins=self._persistence_plugins)
+        for stored_subscriptions in returns.values():
+            for client_id, subscriptions in (stored_subscriptions or dict()).items():
+                if not subscriptions or client_id in self._sessions:
+                    continue
+                session = Session(loop=self._loop)
+                session.client_id = client_id
+                session.clean_session = False
+                self._sessions[client_id] = (session, None)
+                self._unloaded_sessions.add(client_id)
+                for subscription in subscriptions:
+                    self.add_subscription(subscription, session)
+                self._schedule_expiry(session)
+        self.logger.debug("%d stored sessions subscribed" % len(self._unloaded_sessions))
+
+    def _load_stored_session(self, client_id):
+        """
+        Start loading a session subscribed from store at startup
+        :return: future of the load
+        """
+        task = self._session_loads.get(client_id, None)
+        if task is None:
+            task = ensure_future(self._replace_stored_session(client_id), loop=self._loop)
+            self._session_loads[client_id] = task
+            task.add_done_callback(lambda t: self._session_loads.pop(client_id, None))
+        return task
+
+    @asyncio.coroutine
+    def _replace_stored_session(self, client_id):
+        """
+        Replace the placeholder of a session subscribed from store with the stored session. Messages queued for the
+        placeholder meanwhile are queued after those of the stored session.
+        """
+        placeholder = self._sessions[client_id][0]
+        try:
+            stored = yield from self._find_session(client_id)
+        except Exception as e:
+            self.logger.error("Can't load stored session '%s': %s" % (client_id, e))
+            stored = None
+        if client_id not in self._unloaded_sessions:
+            # Deleted meanwhile
+            return
+        self._unloaded_sessions.discard(client_id)
+        session = placeholder
+        if stored is not None:
+            session, subscriptions = stored
+            self.logger.debug("Loaded stored session %s" % repr(session))
+            session.clean_session = False
+            self._del_all_subscriptions(placeholder)
+            for subscription in subscriptions:
+                self.add_subscription(subscription, session)
+            while placeholder.retained_messages_count:
+                session.retained_messages.put_nowait(placeholder.retained_messages.get_nowait())
+            self._restore_inflight(session)
+            self._sessions[client_id] = (session, None)
+        self._session_changed(session)
+
+    @asyncio.coroutine
+    def _flush_sessions(self):
+        """
+        Write pending session changes to the persistence plugins
+        """
+        dirty = self._dirty_sessions
+        self._dirty_sessions = dict()
+        self._flush_event.clear()
+        tasks = []
+        for client_id, session in dirty.items():
+            if session is None:
+                tasks.append(self.plugins_manager.map_plugin_coro(
+                    "del_session",
+                    client_id=client_id,
+                    filter_plugins=self._persistence_plugins))
+            else:
+                subscriptions = list(self._client_subscriptions.get(client_id, dict()).items())
+                tasks.append(self.plugins_manager.map_plugin_coro(
+                    "save_session",
+                    session=session,
+                    subscriptions=subscriptions,
+                    filter_plugins=self._persistence_plugins))
+        self.logger.debug("Flushing %d sessions" % len(tasks))
+        results = yield from asyncio.gather(*tasks, loop=self._loop, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error("Session flush failed: %s" % result)
+
+    @asyncio.coroutine
+    def _session_flush_loop(self):
+        interval = float(self._persistence_config['flush-interval'])
+        try:
+            while True:
+                try:
+                    yield from asyncio.wait_for(self._flush_event.wait(), interval, loop=self._loop)
+                except asyncio.TimeoutError:
+                    pass
+                if self._dirty_sessions:
+                    yield from self._flush_sessions()
+        except CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def _load_retained_store(self):
+        store_config = dict(_retained_store_defaults)
+        store_config.update(self.config['retained-store'])
+        try:
+            path = store_config['file']
+        except KeyError:
+            raise BrokerException("'file' parameter missing in 'retained-store' configuration")
+        store = RetainedStore(path, fsync=store_config['fsync'])
+        messages = yield from self._loop.run_in_executor(None, store.load)
+        for topic, (data, qos) in messages.items():
+            self._retained_messages[topic] = RetainedApplicationMessage(topic, data, qos)
+        store.open()
+        self._retained_store = store
+        self._retained_store_config = store_config
+
+    @asyncio.coroutine
+    def _retained_store_loop(self):
+        store = self._retained_store
+        interval = float(self._retained_store_config['flush-interval'])
+        ratio = float(self._retained_store_config['compact-ratio'])
+        min_size = int(self._retained_store_config['compact-min-size'])
+        try:
+            while True:
+                yield from asyncio.sleep(interval, loop=self._loop)
+                try:
+                    yield from store.sync(loop=self._loop)
+                    if store.needs_compaction(ratio, min_size):
+                        replicas = self._links.replicas if self._links else ()
+                        messages = [(m.topic, m.data, m.qos) for m in self._retained_messages.values()
+                                    if m.topic not in replicas]
+                        yield from store.compact(messages, loop=self._loop)
+                except OSError as e:
+                    self.logger.error("Retained messages store write failed: %s" % e)
+        except CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def _open_inflight_log(self):
+        log_config = dict(_inflight_log_defaults)
+        log_config.update(self.config['inflight-log'])
+        try:
+            directory = log_config['directory']
+        except KeyError:
+            raise BrokerException("'directory' parameter missing in 'inflight-log' configuration")
+        inflight_log = InflightLog(directory,
+                                   segment_size=int(log_config['segment-size']),
+                                   max_segments=int(log_config['max-segments']))
+        self._recovered_inflight = yield from self._loop.run_in_executor(None, inflight_log.open)
+        self._inflight_log = inflight_log
+        self._inflight_log_config = log_config
+
+    def _restore_inflight(self, session):
+        """
+        Set in-flight messages of a session not found in memory from the write-ahead log, which is more recent than
+        session store. Messages are then sent again by the protocol handler when it starts.
+        """
+        if not self._inflight_log:
+            return
+        session.inflight_in = None
+        session.inflight_out = None
+        for message in self._recovered_inflight.pop(session.client_id, ()):
+            if message.direction == INCOMING:
+                session.inflight_in[message.packet_id] = message
+            else:
+                session.inflight_out[message.packet_id] = message
+
+    @asyncio.coroutine
+    def _inflight_log_loop(self):
+        interval = float(self._inflight_log_config['sync-interval'])
+        try:
+            while True:
+                yield from asyncio.sleep(interval, loop=self._loop)
+                try:
+                    yield from self._inflight_log.sync(loop=self._loop)
+                except OSError as e:
+                    self.logger.error("In-flight messages log sync failed: %s" % e)
+        except CancelledError:
+            pass
+
+    def _schedule_expiry(self, session):
+        """
+        Schedule removal of a persistent session which just disconnected
+        """
+        interval = float(self.config['session-expiry-interval'])
+        if interval <= 0 or session.clean_session:
+            return
+        deadline = self._loop.time() + interval
+        self._session_expiry[session.client_id] = deadline
+        heapq.heappush(self._expiry_heap, (deadline, session.client_id))
+        if len(self._expiry_heap) > 2 * len(self._session_expiry) + 1000:
+            # Drop entries of sessions which reconnected
+            self._expiry_heap = [(d, c) for c, d in self._session_expiry.items()]
+            heapq.heapify(self._expiry_heap)
+        self._expiry_event.set()
+
+    @asyncio.coroutine
+    def _session_expiry_loop(self):
+        """
+        Remove persistent sessions disconnected for more than ``session-expiry-interval`` seconds. As the interval is
+        the same for all sessions, deadlines are pushed in increasing order and the loop only waits for the earliest.
+        """
+        try:
+            while True:
+                heap = self._expiry_heap
+                if not heap:
+                    self._expiry_event.clear()
+                    yield from self._expiry_event.wait()
+                    continue
+                deadline, client_id = heap[0]
+                delay = deadline - self._loop.time()
+                if delay > 0:
+                    yield from asyncio.sleep(delay, loop=self._loop)
+                    continue
+                heapq.heappop(heap)
+                if self._session_expiry.get(client_id, None) == deadline:
+                    self.logger.debug("Session %s expired" % client_id)
+                    self.delete_session(client_id)
+        except CancelledError:
+            pass
+
     def _get_handler(self, session):
         client_id = session.client_id
         if client_id:
@@ -0,0 +1,217 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Network traffic capture.
+
+Capture files start with the ``HBMQCAP`` magic followed by a format version byte. Then come records, each made of a
+17 bytes header (``!dIBI``: timestamp, connection number, direction, data length) followed by the data. Data of
+``CAPTURE_IN`` and ``CAPTURE_OUT`` records is one raw MQTT packet. Data of ``CAPTURE_OPEN`` records is the peer
+address as ``host:port``.
+
+Passwords are removed from recorded CONNECT packets. Capture files are created readable by their owner only, as they
+still hold usernames and message payloads.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+from collections import namedtuple
+from hbmqtt.adapters import ReaderAdapter, WriterAdapter
+from hbmqtt.errors import HBMQTTException
+from hbmqtt.mqtt.packet import MQTTFixedHeader, CONNECT
+from hbmqtt.mqtt.connect import ConnectVariableHeader
+
+CAPTURE_MAGIC = b'HBMQCAP'
+CAPTURE_VERSION = 1
+
+CAPTURE_OPEN = 0
+CAPTURE_IN = 1
+CAPTURE_OUT = 2
+CAPTURE_CLOSE = 3
+
+_record_header = struct.Struct('!dIBI')
+_field_length = struct.Struct('!H')
+
+CaptureRecord = namedtuple('CaptureRecord', ['timestamp', 'connection', 'direction', 'data'])
+
+
+class CaptureFile:
+    """
+    Write timestamped, direction-tagged raw packets of several connections to a capture file.
+
+    Writes go through the file object buffer, so recording a packet doesn't cost a system call.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # Mode of an existing file isn't changed by os.open()
+        os.chmod(path, 0o600)
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(CAPTURE_MAGIC + bytes([CAPTURE_VERSION]))
+        self._connection_count = 0
+
+    def record(self, connection, direction, data):
+        if self._file is None:
+            return
+        self._file.write(_record_header.pack(time.time(), connection, direction, len(data)))
+        self._file.write(data)
+
+    def tap(self, reader: ReaderAdapter, writer: WriterAdapter):
+        """
+        Wrap a connection reader and writer so that traffic going through them is recorded
+        :return: (reader, writer) tuple of capture adapters
+        """
+        self._connection_count += 1
+        connection = self._connection_count
+        remote_address, remote_port = writer.get_peer_info()
+        self.record(connection, CAPTURE_OPEN, ('%s:%s' % (remote_address, remote_port)).encode('utf-8'))
+        return CaptureReaderAdapter(reader, self, connection), CaptureWriterAdapter(writer, self, connection)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.logger.info("Capture file '%s' closed (%d connections)" % (self.path, self._connection_count))
+
+
+def read_capture(path):
+    """
+    Read records from a capture file
+    :param path: capture file path
+    :return: generator of :class:`CaptureRecord`
+    """
+    with open(path, 'rb') as f:
+        header = f.read(len(CAPTURE_MAGIC) + 1)
+        if header[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise HBMQTTException("'%s' is not a capture file" % path)
+        if header[-1] != CAPTURE_VERSION:
+            raise HBMQTTException("Unsupported capture file version %d" % header[-1])
+        while True:
+            record_header = f.read(_record_header.size)
+            if len(record_header) < _record_header.size:
+                break
+            timestamp, connection, direction, length = _record_header.unpack(record_header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            yield CaptureRecord(timestamp, connection, direction, data)
+
+
+def _fixed_header(buffer):
+    multiplier = 1
+    remaining_length = 0
+    for index in range(1, min(len(buffer), 5)):
+        encoded_byte = buffer[index]
+        remaining_length += (encoded_byte & 0x7f) * multiplier
+        if (encoded_byte & 0x80) == 0:
+            return index + 1, remaining_length
+        multiplier *= 128
+    return None
+
+
+def packet_length(buffer):
+    """
+    Get the length of the MQTT packet at the start of a buffer
+    :param buffer: bytes starting with a MQTT fixed header
+    :return: full packet length, or None if the buffer doesn't contain the complete fixed header
+    """
+    header = _fixed_header(buffer)
+    if header is None:
+        return None
+    return header[0] + header[1]
+
+
+def redact_connect(packet):
+    """
+    Remove the password of a CONNECT packet
+    :param packet: complete raw CONNECT packet
+    :return: packet without password, or only its fixed header, with no content, if it can't be decoded
+    """
+    try:
+        header_size, remaining_length = _fixed_header(packet)
+        name_length, = _field_length.unpack_from(packet, header_size)
+        flags_offset = header_size + _field_length.size + name_length + 1
+        flags = packet[flags_offset]
+        if not flags & ConnectVariableHeader.PASSWORD_FLAG:
+            return packet
+        # Skip keep alive, then client id, will topic and message, and username
+        offset = flags_offset + 3
+        fields = 1
+        if flags & ConnectVariableHeader.WILL_FLAG:
+            fields += 2
+        if flags & ConnectVariableHeader.USERNAME_FLAG:
+            fields += 1
+        for i in range(fields):
+            offset += _field_length.size + _field_length.unpack_from(packet, offset)[0]
+        password_end = offset + _field_length.size + _field_length.unpack_from(packet, offset)[0]
+        if password_end != len(packet):
+            raise ValueError("Invalid CONNECT packet length")
+    except (TypeError, ValueError, IndexError, struct.error):
+        return bytes([packet[0], 0])
+    body = bytearray(packet[header_size:offset])
+    body[flags_offset - header_size] &= ~ConnectVariableHeader.PASSWORD_FLAG
+    return bytes(MQTTFixedHeader(CONNECT, packet[0] & 0x0f, len(body)).to_bytes() + body)
+
+
+class CaptureReaderAdapter(ReaderAdapter):
+    """
+    Reader adapter recording incoming packets to a capture file.
+    Packets are read by the protocol handler in several small reads, so data is buffered until a complete packet is
+    available.
+    """
+    def __init__(self, reader: ReaderAdapter, capture: CaptureFile, connection):
+        self._reader = reader
+        self._capture = capture
+        self._connection = connection
+        self._buffer = bytearray()
+
+    @asyncio.coroutine
+    def read(self, n=-1) -> bytes:
+        data = yield from self._reader.read(n)
+        if data:
+            self._buffer.extend(data)
+            while self._buffer:
+                length = packet_length(self._buffer)
+                if length is None or len(self._buffer) < length:
+                    break
+                packet = bytes(self._buffer[:length])
+                if packet[0] >> 4 == CONNECT:
+                    packet = redact_connect(packet)
+                self._capture.record(self._connection, CAPTURE_IN, packet)
+                del self._buffer[:length]
+        return data
+
+    def feed_eof(self):
+        return self._reader.feed_eof()
+
+
+class CaptureWriterAdapter(WriterAdapter):
+    """
+    Writer adapter recording outgoing packets to a capture file.
+    """
+    def __init__(self, writer: WriterAdapter, capture: CaptureFile, connection):
+        self._writer = writer
+        self._capture = capture
+        self._connection = connection
+
+    def write(self, data):
+        self._capture.record(self._connection, CAPTURE_OUT, bytes(data))
+        self._writer.write(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from self._writer.drain()
+
+    def get_peer_info(self):
+        return self._writer.get_peer_info()
+
+    def get_peer_cert(self):
+        return self._writer.get_peer_cert()
+
+    @asyncio.coroutine
+    def close(self):
+        self._capture.record(self._connection, CAPTURE_CLOSE, b'')
+        yield from self._writer.close()
@@ -0,0 +1,527 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Broker workers cluster.
+
+A broker started with several workers runs one :class:`~hbmqtt.broker.Broker` per process, all listening on the same
+addresses with ``SO_REUSEPORT`` so that the kernel spreads connections between them. Workers share nothing but Unix
+domain sockets in a common directory, through which:
+
+* each worker tells the others which topic filters its sessions subscribe to, and forwards messages published by its
+  clients only to workers with a matching filter;
+* retained messages published by clients are set by the worker owning their topic, which replicates them to all other
+  workers, so that all workers agree on the last retained message of each topic;
+* connections of persistent sessions (``clean_session`` unset) are passed with their CONNECT packet to the worker owning
+  their client id, so that a persistent session is always served by the same worker.
+
+The owner of a topic or client id is selected by its CRC32 modulo the number of workers.
+
+Workers are linked by stream connections carrying frames made of a 8 bytes header (``!BBHI``: frame type, QoS, topic
+length, data length) followed by the topic and data, as records of the retained messages store. Each worker connects
+to all others and only writes to the connections it opened. Connections are passed, with their file descriptor, in
+datagrams of another socket.
+"""
+import asyncio
+import logging
+import os
+import socket
+import struct
+import sys
+import zlib
+from asyncio import CancelledError
+if sys.version_info < (3, 5):
+    from asyncio import async as ensure_future
+else:
+    from asyncio import ensure_future
+from hbmqtt.adapters import StreamReaderAdapter, StreamWriterAdapter
+from hbmqtt.errors import HBMQTTException
+from hbmqtt.mqtt.connect import ConnectPacket, ConnectVariableHeader, ConnectPayload
+
+FRAME_HELLO = 1
+FRAME_SUBSCRIBE = 2
+FRAME_UNSUBSCRIBE = 3
+FRAME_PUBLISH = 4
+FRAME_RETAIN = 5
+FRAME_RETAIN_REQUEST = 6
+
+# Largest datagram passing a connection: listener name, CONNECT packet and data received after it
+MAX_HANDOFF_SIZE = 65536
+
+# Number of topics whose destination workers are cached
+_MAX_ROUTES = 10000
+
+_frame_header = struct.Struct('!BBHI')
+_handoff_header = struct.Struct('!BH')
+_fd = struct.Struct('i')
+
+
+def encode_frame(frame_type, topic, data=b'', qos=None):
+    topic_bytes = topic.encode('utf-8')
+    return _frame_header.pack(frame_type, qos or 0, len(topic_bytes), len(data)) + topic_bytes + data
+
+
+@asyncio.coroutine
+def read_frame(reader):
+    """
+    Read a frame from a stream
+    :param reader: asyncio StreamReader
+    :return: (frame type, topic, data, qos) tuple
+    """
+    header = yield from reader.readexactly(_frame_header.size)
+    frame_type, qos, topic_length, data_length = _frame_header.unpack(header)
+    body = yield from reader.readexactly(topic_length + data_length)
+    return frame_type, body[:topic_length].decode('utf-8'), body[topic_length:], qos
+
+
+def worker_config(config, index, workers, socket_dir):
+    """
+    Build the configuration of a worker from the broker configuration. Listeners share their port with the other
+    workers, and files written by a single broker get a name of their own.
+    :param config: broker configuration
+    :param index: worker index, from 0 to ``workers - 1``
+    :param workers: number of workers
+    :param socket_dir: directory of the cluster sockets
+    :return: worker configuration
+    """
+    config = worker_files(config, index)
+    config['listeners'] = {name: dict(listener, **{'reuse-port': True})
+                           for name, listener in config['listeners'].items()}
+    config['cluster'] = {
+        'workers': workers,
+        'worker': index,
+        'socket-dir': socket_dir,
+    }
+    return config
+
+
+def worker_files(config, index):
+    """
+    Give their own name to the files a broker writes, so that several brokers can run with the same configuration
+    :param config: broker configuration
+    :param index: worker index
+    :return: configuration copy
+    """
+    config = dict(config)
+    config['listeners'] = {name: dict(listener) for name, listener in config['listeners'].items()}
+    for listener in config['listeners'].values():
+        if listener.get('capture', None):
+            listener['capture'] = '%s.%d' % (listener['capture'], index)
+    if config.get('retained-store', None):
+        config['retained-store'] = dict(config['retained-store'])
+        config['retained-store']['file'] = '%s.%d' % (config['retained-store']['file'], index)
+    if config.get('persistence', None) and config['persistence'].get('file', None):
+        config['persistence'] = dict(config['persistence'])
+        config['persistence']['file'] = '%s.%d' % (config['persistence']['file'], index)
+    if config.get('inflight-log', None):
+        config['inflight-log'] = dict(config['inflight-log'])
+        config['inflight-log']['directory'] = os.path.join(config['inflight-log']['directory'], 'worker-%d' % index)
+    return config
+
+
+def topic_matches(broker, topic, a_filter):
+    """
+    Check if a topic matches a filter as messages are routed by a broker
+    """
+    if topic.startswith('$') and (a_filter.startswith('+') or a_filter.startswith('#')):
+        return False
+    return broker.matches(topic, a_filter)
+
+
+def _connect_packet(session):
+    """
+    Build the CONNECT packet a session was created from
+    """
+    vh = ConnectVariableHeader()
+    payload = ConnectPayload()
+    vh.keep_alive = session.keep_alive
+    vh.clean_session_flag = session.clean_session
+    payload.client_id = session.client_id
+    if session.username is not None:
+        vh.username_flag = True
+        payload.username = session.username
+    if session.password is not None:
+        vh.password_flag = True
+        payload.password = session.password
+    if session.will_flag:
+        vh.will_flag = True
+        vh.will_retain_flag = session.will_retain
+        vh.will_qos = session.will_qos
+        payload.will_topic = session.will_topic
+        payload.will_message = session.will_message
+    return ConnectPacket(vh=vh, payload=payload)
+
+
+class WorkerLinks:
+    """
+    Base class of the links of a broker with the brokers of other workers. Subclasses send operations to other
+    workers, as frame types with a topic, data and QoS, and find the workers a message must be forwarded to.
+
+    :param broker: :class:`~hbmqtt.broker.Broker` instance of this worker
+    :param index: index of this worker
+    :param workers: number of workers
+    :param loop: asyncio loop of the broker
+    """
+    def __init__(self, broker, index, workers, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self._broker = broker
+        if loop is not None:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self.index = index
+        self.workers = workers
+        # filter -> number of local subscriptions
+        self._filters = dict()
+        # topic -> workers its messages are forwarded to
+        self._routes = dict()
+        # Topics of retained messages replicated from the worker owning them
+        self.replicas = set()
+
+    def owner(self, key):
+        """
+        Get the index of the worker owning a topic or client id
+        """
+        return zlib.crc32(key.encode('utf-8')) % self.workers
+
+    @asyncio.coroutine
+    def start(self):
+        pass
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+    def _send(self, worker, frame_type, topic, data=b'', qos=None):
+        """
+        Send an operation to another worker
+        :return: False if the worker is disconnected
+        """
+        raise NotImplementedError
+
+    def _send_all(self, frame_type, topic, data=b'', qos=None):
+        for worker in range(self.workers):
+            if worker != self.index:
+                self._send(worker, frame_type, topic, data, qos)
+
+    def _destinations(self, topic):
+        """
+        Find the workers with subscriptions matching a topic
+        :return: tuple of worker indexes
+        """
+        raise NotImplementedError
+
+    def _filter_added(self, a_filter):
+        pass
+
+    def _filter_removed(self, a_filter):
+        pass
+
+    def subscribed(self, a_filter):
+        """
+        Account a new subscription of a local session to a filter
+        """
+        count = self._filters.get(a_filter, 0)
+        self._filters[a_filter] = count + 1
+        if not count:
+            self._filter_added(a_filter)
+
+    def unsubscribed(self, a_filter):
+        """
+        Account the removal of a subscription of a local session to a filter
+        """
+        count = self._filters.get(a_filter, 0)
+        if count > 1:
+            self._filters[a_filter] = count - 1
+        elif count:
+            del self._filters[a_filter]
+            self._filter_removed(a_filter)
+
+    def forward(self, topic, data, qos=None):
+        """
+        Send a message published by a local client to the workers with sessions subscribed to its topic
+        :param qos: QoS used for all subscribers instead of the subscription QoS
+        """
+        workers = self._routes.get(topic, None)
+        if workers is None:
+            if len(self._routes) >= _MAX_ROUTES:
+                self._routes.clear()
+            workers = self._routes[topic] = self._destinations(topic)
+        for worker in workers:
+            if not self._send(worker, FRAME_PUBLISH, topic, data, qos):
+                self.logger.debug("Message on topic '%s' not forwarded to disconnected worker %d" % (topic, worker))
+
+    def retain(self, topic, data, qos=None):
+        """
+        Set, or clear if data is empty, the retained message of a topic on the worker owning the topic, which
+        replicates it to all other workers
+        """
+        owner = self.owner(topic)
+        if owner != self.index:
+            if not self._send(owner, FRAME_RETAIN_REQUEST, topic, data, qos):
+                self.logger.warning("Retained message on topic '%s' lost: worker %d is disconnected" % (topic, owner))
+            return
+        self.replicas.discard(topic)
+        self._broker._retain(topic, data, qos)
+        self._send_all(FRAME_RETAIN, topic, data, qos)
+
+    def _retain_replica(self, topic, data, qos):
+        # Replicas aren't written to the retained messages store: the owner stores them and sends them again when it
+        # connects
+        self._broker._retain(topic, data, qos, store=False)
+        if data:
+            self.replicas.add(topic)
+        else:
+            self.replicas.discard(topic)
+
+    def _owned_retained_messages(self):
+        """
+        Get retained messages published by clients on topics owned by this worker
+        """
+        for message in list(self._broker._retained_messages.values()):
+            if not message.topic.startswith('$') and message.topic not in self.replicas and \
+                    self.owner(message.topic) == self.index:
+                yield message
+
+    def _receive(self, frame_type, topic, data, qos):
+        """
+        Apply an operation sent by another worker
+        """
+        if frame_type == FRAME_PUBLISH:
+            self._broker._queue_broadcast(None, topic, data, qos or None)
+        elif frame_type == FRAME_RETAIN:
+            self._retain_replica(topic, data, qos)
+        elif frame_type == FRAME_RETAIN_REQUEST:
+            self.retain(topic, data, qos)
+
+    def _handoff_data(self, listener_name, session, reader, writer):
+        """
+        Check if the connection of a persistent session must be passed to the worker owning the session. Only plain
+        TCP connections can be passed: TLS and websocket connections are served by the worker which accepted them.
+        :return: (owner, transport, data to read before the connection data) or None to keep the connection
+        """
+        owner = self.owner(session.client_id)
+        if owner == self.index or type(reader) is not StreamReaderAdapter or type(writer) is not StreamWriterAdapter:
+            return None
+        transport = writer.transport
+        if transport.get_extra_info('sslcontext') is not None:
+            return None
+        return owner, transport, _connect_packet(session).to_bytes() + reader.buffered()
+
+    def handoff(self, listener_name, session, reader, writer):
+        """
+        Pass the connection of a persistent session to the worker owning it, with the CONNECT packet read from the
+        connection
+        :param listener_name: name of the listener which accepted the connection
+        :param session: session built from the CONNECT packet
+        :return: True if the connection was passed and must no longer be used
+        """
+        return False
+
+
+class Cluster(WorkerLinks):
+    """
+    Links of a broker with the other worker processes of its cluster
+
+    :param broker: :class:`~hbmqtt.broker.Broker` instance of this worker
+    :param config: ``cluster`` section of the broker configuration
+    :param loop: asyncio loop to use
+    """
+    def __init__(self, broker, config, loop=None):
+        try:
+            workers = int(config['workers'])
+            index = int(config['worker'])
+            self.socket_dir = config['socket-dir']
+        except KeyError as ke:
+            raise HBMQTTException("%s parameter missing in 'cluster' configuration" % ke)
+        super().__init__(broker, index, workers, loop)
+        self.reconnect_delay = float(config.get('reconnect-delay', 0.5))
+        # worker -> filters subscribed on this worker
+        self._peer_filters = dict()
+        # worker -> StreamWriter of the connection to this worker
+        self._peer_writers = dict()
+        self._peer_tasks = []
+        # StreamWriter of connections from other workers -> future done when the connection is closed
+        self._inbound = dict()
+        self._server = None
+        self._handoff_socket = None
+
+    def _path(self, index, kind):
+        return os.path.join(self.socket_dir, 'worker-%d.%s' % (index, kind))
+
+    @asyncio.coroutine
+    def start(self):
+        path = self._path(self.index, 'sock')
+        handoff_path = self._path(self.index, 'handoff')
+        for stale in (path, handoff_path):
+            if os.path.exists(stale):
+                os.unlink(stale)
+        self._server = yield from asyncio.start_unix_server(self._peer_connected, path, loop=self._loop)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(handoff_path)
+        sock.setblocking(False)
+        self._loop.add_reader(sock.fileno(), self._read_handoffs)
+        self._handoff_socket = sock
+        self._peer_tasks = [ensure_future(self._connect_peer(peer), loop=self._loop)
+                            for peer in range(self.workers) if peer != self.index]
+        self.logger.info("Worker %d of %d started" % (self.index, self.workers))
+
+    @asyncio.coroutine
+    def close(self):
+        for task in self._peer_tasks:
+            task.cancel()
+        if self._peer_tasks:
+            yield from asyncio.wait(self._peer_tasks, loop=self._loop)
+        self._peer_tasks = []
+        if self._server:
+            self._server.close()
+            yield from self._server.wait_closed()
+            self._server = None
+        if self._inbound:
+            closed = list(self._inbound.values())
+            for writer in list(self._inbound):
+                writer.close()
+            yield from asyncio.wait(closed, loop=self._loop)
+        if self._handoff_socket:
+            self._loop.remove_reader(self._handoff_socket.fileno())
+            self._handoff_socket.close()
+            self._handoff_socket = None
+        for path in (self._path(self.index, 'sock'), self._path(self.index, 'handoff')):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    @asyncio.coroutine
+    def _connect_peer(self, peer):
+        """
+        Keep a connection open to another worker, telling it the filters subscribed here and the retained messages
+        owned here each time the connection is opened
+        """
+        path = self._path(peer, 'sock')
+        try:
+            while True:
+                try:
+                    reader, writer = yield from asyncio.open_unix_connection(path, loop=self._loop)
+                except OSError:
+                    # Worker not started yet, or restarting
+                    yield from asyncio.sleep(self.reconnect_delay, loop=self._loop)
+                    continue
+                writer.write(encode_frame(FRAME_HELLO, str(self.index)))
+                for a_filter in self._filters:
+                    writer.write(encode_frame(FRAME_SUBSCRIBE, a_filter))
+                for message in self._owned_retained_messages():
+                    writer.write(encode_frame(FRAME_RETAIN, message.topic, message.data, message.qos))
+                self._peer_writers[peer] = writer
+                self.logger.info("Connected to worker %d" % peer)
+                try:
+                    # Workers never write to connections they accepted: reading only ends when the peer stops
+                    yield from reader.read()
+                finally:
+                    del self._peer_writers[peer]
+                    writer.close()
+                self.logger.warning("Connection to worker %d lost" % peer)
+                yield from asyncio.sleep(self.reconnect_delay, loop=self._loop)
+        except CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def _peer_connected(self, reader, writer):
+        peer = None
+        filters = None
+        closed = asyncio.Future(loop=self._loop)
+        self._inbound[writer] = closed
+        try:
+            while True:
+                frame_type, topic, data, qos = yield from read_frame(reader)
+                if frame_type == FRAME_SUBSCRIBE:
+                    filters.add(topic)
+                    self._routes.clear()
+                elif frame_type == FRAME_UNSUBSCRIBE:
+                    filters.discard(topic)
+                    self._routes.clear()
+                elif frame_type == FRAME_HELLO:
+                    peer = int(topic)
+                    filters = self._peer_filters[peer] = set()
+                    self._routes.clear()
+                else:
+                    self._receive(frame_type, topic, data, qos)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # A restarted worker may already be connected again
+            if peer is not None and self._peer_filters.get(peer, None) is filters:
+                del self._peer_filters[peer]
+                self._routes.clear()
+            writer.close()
+            del self._inbound[writer]
+            closed.set_result(None)
+
+    def _send(self, worker, frame_type, topic, data=b'', qos=None):
+        writer = self._peer_writers.get(worker, None)
+        if writer is None:
+            return False
+        writer.write(encode_frame(frame_type, topic, data, qos))
+        return True
+
+    def _filter_added(self, a_filter):
+        self._send_all(FRAME_SUBSCRIBE, a_filter)
+
+    def _filter_removed(self, a_filter):
+        self._send_all(FRAME_UNSUBSCRIBE, a_filter)
+
+    def _destinations(self, topic):
+        return tuple(peer for peer, filters in self._peer_filters.items()
+                     if any(topic_matches(self._broker, topic, a_filter) for a_filter in filters))
+
+    def handoff(self, listener_name, session, reader, writer):
+        handoff = self._handoff_data(listener_name, session, reader, writer)
+        if handoff is None:
+            return False
+        owner, transport, data = handoff
+        sock = transport.get_extra_info('socket')
+        name = listener_name.encode('utf-8')
+        message = _handoff_header.pack(sock.family, len(name)) + name + data
+        if len(message) > MAX_HANDOFF_SIZE:
+            return False
+        try:
+            self._handoff_socket.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, _fd.pack(sock.fileno()))],
+                                       0, self._path(owner, 'handoff'))
+        except OSError as e:
+            self.logger.warning("Connection of client %s not passed to worker %d: %s" % (session.client_id, owner, e))
+            return False
+        self.logger.debug("Connection of client %s passed to worker %d" % (session.client_id, owner))
+        # The socket stays open in the owner process
+        transport.close()
+        return True
+
+    def _read_handoffs(self):
+        while True:
+            try:
+                message, ancdata, flags, address = self._handoff_socket.recvmsg(
+                    MAX_HANDOFF_SIZE, socket.CMSG_SPACE(_fd.size))
+            except (BlockingIOError, InterruptedError):
+                return
+            fds = [_fd.unpack(data[:_fd.size])[0] for level, kind, data in ancdata
+                   if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS]
+            if not fds:
+                continue
+            family, name_length = _handoff_header.unpack_from(message)
+            start = _handoff_header.size
+            listener_name = message[start:start + name_length].decode('utf-8')
+            sock = socket.socket(family, socket.SOCK_STREAM, 0, fds[0])
+            ensure_future(self._serve_handoff(listener_name, sock, message[start + name_length:]), loop=self._loop)
+
+    @asyncio.coroutine
+    def _serve_handoff(self, listener_name, sock, data):
+        reader = asyncio.StreamReader(loop=self._loop)
+        # Data read by the worker which accepted the connection comes first
+        reader.feed_data(data)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=self._loop)
+        try:
+            transport, _ = yield from self._loop.create_connection(lambda: protocol, sock=sock)
+        except OSError as e:
+            self.logger.warning("Passed connection can't be served: %s" % e)
+            sock.close()
+            return
+        writer = asyncio.StreamWriter(transport, protocol, reader, self._loop)
+        yield from self._broker.client_connected(listener_name, StreamReaderAdapter(reader),
+                                                 StreamWriterAdapter(writer), admitted=True)
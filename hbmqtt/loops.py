@@ -0,0 +1,394 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Broker event loop threads.
+
+A broker configured with ``loop-threads`` greater than 1 is the first of a group of brokers, each running its own event
+loop: the broker created by the application runs on the application loop, and it starts the others on loops of new
+threads. Listeners are only opened by the first broker, whose loop accepts connections and assigns each to the loop
+serving the fewest connections. This loop does the TLS handshake and runs the connection.
+
+Brokers of a group share a routing table of the loops with subscriptions to each topic filter, and messages published
+by clients are forwarded to loops with a matching filter. Operations sent to a loop are gathered during an iteration of
+the sending loop and passed in a single ``call_soon_threadsafe`` call. As workers of a cluster (see
+:mod:`hbmqtt.cluster`), loops replicate retained messages set by the loop owning their topic, and pass plain TCP
+connections of persistent sessions to the loop owning their client id.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import socket
+import sys
+import threading
+if sys.version_info < (3, 5):
+    from asyncio import async as ensure_future
+else:
+    from asyncio import ensure_future
+from hbmqtt.adapters import StreamReaderAdapter, StreamWriterAdapter
+from hbmqtt.cluster import WorkerLinks, worker_files, topic_matches, FRAME_RETAIN
+from hbmqtt.errors import HBMQTTException
+
+
+def loop_config(config, index):
+    """
+    Build the configuration of the broker of a loop thread
+    :param config: configuration of the first broker of the group
+    :param index: loop index
+    """
+    config = worker_files(config, index)
+    config['loop-threads'] = 1
+    return config
+
+
+class RoutingTable:
+    """
+    Loops with subscriptions to each topic filter, shared by the brokers of a group. Updates are serialized by a lock.
+    Lookups use an immutable snapshot of the table, rebuilt by the first lookup following an update, so they don't take
+    the lock while the table doesn't change.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # filter -> set of loop indexes
+        self._loops = dict()
+        self.version = 0
+        self._snapshot = (0, ())
+
+    def add(self, a_filter, index):
+        with self._lock:
+            self._loops.setdefault(a_filter, set()).add(index)
+            self.version += 1
+
+    def remove(self, a_filter, index):
+        with self._lock:
+            loops = self._loops.get(a_filter, None)
+            if loops is not None:
+                loops.discard(index)
+                if not loops:
+                    del self._loops[a_filter]
+            self.version += 1
+
+    def snapshot(self):
+        """
+        Get the current table
+        :return: (version, tuple of (filter, frozenset of loop indexes)) tuple
+        """
+        snapshot = self._snapshot
+        if snapshot[0] != self.version:
+            with self._lock:
+                snapshot = self._snapshot = (self.version, tuple((a_filter, frozenset(loops))
+                                                                 for a_filter, loops in self._loops.items()))
+        return snapshot
+
+
+class Acceptor:
+    """
+    Listening sockets of a listener whose connections are assigned to the loops of a group. Acceptors are the server
+    instances of listeners of the first broker of a group.
+
+    :param group: :class:`LoopGroup` instance
+    :param listener_name: listener name
+    :param ssl_context: SSL context of the listener, or None
+    :param server_kwargs: ``reuse_port`` and arguments of ``connect_accepted_socket``
+    :param backlog: listen backlog, and maximum number of connections accepted at once
+    """
+    def __init__(self, group, listener_name, address, port, ssl_context=None, server_kwargs=None, backlog=100):
+        self.logger = logging.getLogger(__name__)
+        self._group = group
+        self._loop = group.broker._loop
+        self._listener_name = listener_name
+        self._ssl_context = ssl_context
+        self._server_kwargs = dict(server_kwargs or ())
+        reuse_port = self._server_kwargs.pop('reuse_port', False)
+        self._backlog = backlog
+        self.sockets = []
+        try:
+            for family, kind, proto, _, sockaddr in socket.getaddrinfo(address, port, type=socket.SOCK_STREAM,
+                                                                       flags=socket.AI_PASSIVE):
+                sock = socket.socket(family, kind, proto)
+                self.sockets.append(sock)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                sock.bind(sockaddr)
+                sock.listen(backlog)
+                sock.setblocking(False)
+        except OSError:
+            for sock in self.sockets:
+                sock.close()
+            raise
+        for sock in self.sockets:
+            self._loop.add_reader(sock.fileno(), self._accept, sock)
+
+    def _accept(self, sock):
+        accepted = []
+        for i in range(self._backlog):
+            try:
+                conn, address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.logger.warning("Listener '%s' can't accept connection: %s" % (self._listener_name, e))
+                break
+            conn.setblocking(False)
+            accepted.append(conn)
+        if accepted:
+            self._group.assign(self._listener_name, accepted, self._ssl_context, self._server_kwargs)
+
+    def close(self):
+        for sock in self.sockets:
+            self._loop.remove_reader(sock.fileno())
+            sock.close()
+        self.sockets = []
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        pass
+
+
+class LoopLink(WorkerLinks):
+    """
+    Links of the broker of a loop with the brokers of the other loops of its group
+
+    :param group: :class:`LoopGroup` instance
+    :param index: loop index
+    :param broker: :class:`~hbmqtt.broker.Broker` instance running on the loop
+    :param loop: loop of the broker
+    """
+    def __init__(self, group, index, broker, loop):
+        super().__init__(broker, index, group.size, loop)
+        self.group = group
+        # Connections served by the loop, only updated by its thread
+        self.connections = 0
+        # loop index -> operations to send at the end of the loop iteration
+        self._outboxes = dict()
+        self._routes_version = 0
+
+    @asyncio.coroutine
+    def start(self):
+        if self.index == 0:
+            yield from self.group.start()
+
+    @asyncio.coroutine
+    def close(self):
+        if self.index == 0:
+            yield from self.group.close()
+
+    def listen(self, listener_name, address, port, ssl_context=None, server_kwargs=None):
+        """
+        Open a listener of the group
+        :return: server instance, or None for brokers of loop threads which don't accept connections
+        """
+        if self.index:
+            return None
+        return Acceptor(self.group, listener_name, address, port, ssl_context, server_kwargs)
+
+    def _send(self, worker, frame_type, topic, data=b'', qos=None):
+        if not self._outboxes:
+            self._loop.call_soon(self._flush)
+        outbox = self._outboxes.get(worker, None)
+        if outbox is None:
+            outbox = self._outboxes[worker] = []
+        outbox.append((frame_type, topic, data, qos))
+        return True
+
+    def _flush(self):
+        outboxes = self._outboxes
+        self._outboxes = dict()
+        for index, operations in outboxes.items():
+            link = self.group.links[index]
+            self.group.call(index, link._receive_all, operations)
+
+    def _receive_all(self, operations):
+        for operation in operations:
+            self._receive(*operation)
+
+    def _filter_added(self, a_filter):
+        self.group.table.add(a_filter, self.index)
+
+    def _filter_removed(self, a_filter):
+        self.group.table.remove(a_filter, self.index)
+
+    def forward(self, topic, data, qos=None):
+        version = self.group.table.version
+        if version != self._routes_version:
+            self._routes.clear()
+            self._routes_version = version
+        super().forward(topic, data, qos)
+
+    def _destinations(self, topic):
+        version, filters = self.group.table.snapshot()
+        loops = set()
+        for a_filter, indexes in filters:
+            if not indexes <= loops and topic_matches(self._broker, topic, a_filter):
+                loops |= indexes
+        loops.discard(self.index)
+        return tuple(loops)
+
+    def sync_retained(self):
+        """
+        Replicate retained messages owned by this loop, loaded from the retained messages store
+        """
+        for message in self._owned_retained_messages():
+            self._send_all(FRAME_RETAIN, message.topic, message.data, message.qos)
+
+    def serve(self, listener_name, socks, ssl_context=None, server_kwargs=None):
+        """
+        Serve connections assigned to this loop
+        :param socks: accepted sockets
+        """
+        for sock in socks:
+            ensure_future(self._serve(listener_name, sock, ssl_context, server_kwargs), loop=self._loop)
+
+    @asyncio.coroutine
+    def _serve(self, listener_name, sock, ssl_context=None, server_kwargs=None, data=b'', admitted=False):
+        self.connections += 1
+        try:
+            reader = asyncio.StreamReader(loop=self._loop)
+            if data:
+                # Data read by the loop which accepted the connection comes first
+                reader.feed_data(data)
+            protocol = asyncio.StreamReaderProtocol(reader, loop=self._loop)
+            try:
+                transport, _ = yield from self._loop.connect_accepted_socket(
+                    lambda: protocol, sock, ssl=ssl_context, **(server_kwargs or dict()))
+            except OSError as e:
+                self.logger.debug("Connection on listener '%s' can't be served: %s" % (listener_name, e))
+                sock.close()
+                return
+            writer = asyncio.StreamWriter(transport, protocol, reader, self._loop)
+            yield from self._broker.client_connected(listener_name, StreamReaderAdapter(reader),
+                                                     StreamWriterAdapter(writer), admitted=admitted)
+        finally:
+            self.connections -= 1
+
+    def handoff(self, listener_name, session, reader, writer):
+        handoff = self._handoff_data(listener_name, session, reader, writer)
+        if handoff is None:
+            return False
+        owner, transport, data = handoff
+        sock = transport.get_extra_info('socket').dup()
+        # The connection stays open through the duplicated socket
+        transport.close()
+        if not self.group.call(owner, self.group.links[owner]._serve_handoff, listener_name, sock, data):
+            sock.close()
+        self.logger.debug("Connection of client %s passed to loop %d" % (session.client_id, owner))
+        return True
+
+    def _serve_handoff(self, listener_name, sock, data):
+        ensure_future(self._serve(listener_name, sock, data=data, admitted=True), loop=self._loop)
+
+
+class LoopGroup:
+    """
+    Event loop threads of a broker and the brokers running on them
+
+    :param broker: :class:`~hbmqtt.broker.Broker` instance accepting connections, running on the application loop
+    :param size: number of loops, including the broker loop
+    """
+    def __init__(self, broker, size):
+        self.logger = logging.getLogger(__name__)
+        if not hasattr(broker._loop, 'connect_accepted_socket'):
+            raise HBMQTTException("'loop-threads' requires Python 3.5.3 or later")
+        self.broker = broker
+        self.size = size
+        self.table = RoutingTable()
+        self.links = [None] * size
+        self.links[0] = LoopLink(self, 0, broker, broker._loop)
+        self._threads = []
+
+    @asyncio.coroutine
+    def start(self):
+        try:
+            for index in range(1, self.size):
+                started = concurrent.futures.Future()
+                thread = threading.Thread(target=self._run, args=(index, started), name='hbmqtt-loop-%d' % index)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+                yield from asyncio.wrap_future(started, loop=self.broker._loop)
+        except Exception:
+            yield from self.close()
+            raise
+        for link in self.links:
+            self.call(link.index, link.sync_retained)
+        self.logger.info("Broker running on %d event loops" % self.size)
+
+    def _run(self, index, started):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            broker = type(self.broker)(loop_config(self.broker.config, index), loop=loop,
+                                       plugin_namespace=self.broker._plugin_namespace)
+            broker._links = self.links[index] = LoopLink(self, index, broker, loop)
+            loop.run_until_complete(broker.start())
+        except Exception as e:
+            self.links[index] = None
+            loop.close()
+            started.set_exception(e)
+            return
+        started.set_result(None)
+        try:
+            loop.run_forever()
+        finally:
+            # Connections still open when the broker was stopped
+            tasks = asyncio.Task.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks, loop=loop))
+            loop.close()
+
+    @asyncio.coroutine
+    def close(self):
+        loop = self.broker._loop
+        for link in self.links[1:]:
+            if link is None:
+                continue
+            if link._broker.transitions.is_started():
+                try:
+                    yield from asyncio.wrap_future(
+                        asyncio.run_coroutine_threadsafe(link._broker.shutdown(), link._loop), loop=loop)
+                except Exception as e:
+                    self.logger.error("Broker of loop %d shutdown failed: %s" % (link.index, e))
+            self.call(link.index, link._loop.stop)
+        for thread in self._threads:
+            yield from loop.run_in_executor(None, thread.join)
+        self._threads = []
+        self.links[1:] = [None] * (self.size - 1)
+
+    def call(self, index, callback, *args):
+        """
+        Call a function in the thread of a loop
+        :return: False if the loop is stopped
+        """
+        link = self.links[index]
+        if link is None:
+            return False
+        try:
+            link._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Loop closed
+            return False
+        return True
+
+    def assign(self, listener_name, socks, ssl_context=None, server_kwargs=None):
+        """
+        Assign accepted connections to the loops serving the fewest connections
+        :param socks: accepted sockets
+        """
+        loads = [link.connections if link is not None else sys.maxsize for link in self.links]
+        batches = dict()
+        for sock in socks:
+            index = loads.index(min(loads))
+            loads[index] += 1
+            batches.setdefault(index, []).append(sock)
+        for index, batch in batches.items():
+            link = self.links[index]
+            if index == 0:
+                link.serve(listener_name, batch, ssl_context, server_kwargs)
+            elif not self.call(index, link.serve, listener_name, batch, ssl_context, server_kwargs):
+                for sock in batch:
+                    sock.close()
@@ -27,6 +27,8 @@ RESERVED_15 = 0x0f
 
 
 class MQTTFixedHeader:
+    __slots__ = ('packet_type', 'remaining_length', 'flags')
+
     def __init__(self, packet_type, flags=0, length=0):
         self.packet_type = packet_type
         self.remaining_length = length
@@ -112,6 +114,8 @@ class MQTTFixedHeader:
 
 
 class MQTTVariableHeader:
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -137,6 +141,8 @@ class MQTTVariableHeader:
 
 
 class PacketIdVariableHeader(MQTTVariableHeader):
+    __slots__ = ('packet_id',)
+
     def __init__(self, packet_id):
         super().__init__()
         self.packet_id = packet_id
@@ -157,6 +163,8 @@ class PacketIdVariableHeader(MQTTVariableHeader):
 
 
 class MQTTPayload:
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -176,6 +184,7 @@ class MQTTPayload:
 
 
 class MQTTPacket:
+    __slots__ = ('fixed_header', 'variable_header', 'payload', 'protocol_ts')
     FIXED_HEADER = MQTTFixedHeader
     VARIABLE_HEADER = None
     PAYLOAD = None
@@ -2,7 +2,8 @@
 #
 # See the file license.txt for copying permission.
 import asyncio
-from asyncio import futures, Queue
+import collections
+from asyncio import futures
 from hbmqtt.mqtt.protocol.handler import ProtocolHandler
 from hbmqtt.mqtt.connect import ConnectPacket
 from hbmqtt.mqtt.connack import *
@@ -12,50 +13,90 @@ from hbmqtt.mqtt.subscribe import SubscribePacket
 from hbmqtt.mqtt.suback import SubackPacket
 from hbmqtt.mqtt.unsubscribe import UnsubscribePacket
 from hbmqtt.mqtt.unsuback import UnsubackPacket
-from hbmqtt.utils import format_client_message
+from hbmqtt.utils import format_client_message, lazy_attribute
 from hbmqtt.session import Session
 from hbmqtt.plugins.manager import PluginManager
 from hbmqtt.adapters import ReaderAdapter, WriterAdapter
 from hbmqtt.errors import MQTTException
+from hbmqtt.mqtt.constants import QOS_2
 from .handler import EVENT_MQTT_PACKET_RECEIVED, EVENT_MQTT_PACKET_SENT
 
+# Kinds of events queued in a broker handler inbox, read with next_event()
+INBOX_SUBSCRIBE = 'subscribe'
+INBOX_UNSUBSCRIBE = 'unsubscribe'
+INBOX_MESSAGE = 'message'
+INBOX_DISCONNECT = 'disconnect'
+
 
 class BrokerProtocolHandler(ProtocolHandler):
+    """
+    Broker side protocol handler. Subscriptions, unsubscriptions, incoming messages and disconnection of the client
+    are queued in order in a single inbox read by the broker with :meth:`next_event`.
+    """
+    _inbox = lazy_attribute('_inbox', lambda self: collections.deque())
+
     def __init__(self, plugins_manager: PluginManager, session: Session=None, loop=None):
         super().__init__(plugins_manager, session, loop)
-        self._disconnect_waiter = None
-        self._pending_subscriptions = Queue(loop=self._loop)
-        self._pending_unsubscriptions = Queue(loop=self._loop)
-
-    @asyncio.coroutine
-    def start(self):
-        yield from super().start()
-        if self._disconnect_waiter is None:
-            self._disconnect_waiter = futures.Future(loop=self._loop)
+        self._inbox_waiter = None
+        self._disconnected = False
+        # Optional function called with (session, message) to route QoS 0 and 1 incoming messages as soon as they
+        # are received, returning False to queue a message in the inbox instead
+        self.router = None
 
     @asyncio.coroutine
     def stop(self):
         yield from super().stop()
-        if self._disconnect_waiter is not None and not self._disconnect_waiter.done():
-            self._disconnect_waiter.set_result(None)
+        self._post_disconnect(None)
+
+    def _post(self, kind, data):
+        self._inbox.append((kind, data))
+        waiter = self._inbox_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _post_disconnect(self, disconnect):
+        # Only the first disconnection is posted: the broker stops reading events after it
+        if not self._disconnected:
+            self._disconnected = True
+            self._post(INBOX_DISCONNECT, disconnect)
 
     @asyncio.coroutine
-    def wait_disconnect(self):
-        return (yield from self._disconnect_waiter)
+    def next_event(self):
+        """
+        Wait for the next event of the client connection
+        :return: (kind, data) tuple, data being the subscription or unsubscription dict for INBOX_SUBSCRIBE and
+            INBOX_UNSUBSCRIBE, the IncomingApplicationMessage for INBOX_MESSAGE and the DISCONNECT packet for
+            INBOX_DISCONNECT, or None if the connection was lost
+        """
+        inbox = self._inbox
+        while not inbox:
+            self._inbox_waiter = futures.Future(loop=self._loop)
+            try:
+                yield from self._inbox_waiter
+            finally:
+                self._inbox_waiter = None
+        return inbox.popleft()
+
+    def _deliver_message(self, app_message):
+        waiter = self._inbox_waiter
+        # Route right away only if the broker is idle waiting for events, so messages aren't routed before events
+        # received earlier. The router also refuses messages while earlier ones of the session wait in a broadcast
+        # queue. QoS 2 messages are delivered on PUBREL and always go through the inbox.
+        if self.router is not None and app_message.qos != QOS_2 and waiter is not None and not waiter.done():
+            if self.router(self.session, app_message):
+                return
+        self._post(INBOX_MESSAGE, app_message)
 
     def handle_write_timeout(self):
         pass
 
     def handle_read_timeout(self):
-        if self._disconnect_waiter is not None and not self._disconnect_waiter.done():
-            self._disconnect_waiter.set_result(None)
+        self._post_disconnect(None)
 
     @asyncio.coroutine
     def handle_disconnect(self, disconnect):
         self.logger.debug("Client disconnecting")
-        if self._disconnect_waiter and not self._disconnect_waiter.done():
-            self.logger.debug("Setting waiter result to %r" % disconnect)
-            self._disconnect_waiter.set_result(disconnect)
+        self._post_disconnect(disconnect)
 
     @asyncio.coroutine
     def handle_connection_closed(self):
@@ -67,8 +108,7 @@ class BrokerProtocolHandler(ProtocolHandler):
         # as CONNECT messages are managed by the broker on client connection
         self.logger.error('%s [MQTT-3.1.0-2] %s : CONNECT message received during messages handling' %
                           (self.session.client_id, format_client_message(self.session)))
-        if self._disconnect_waiter is not None and not self._disconnect_waiter.done():
-            self._disconnect_waiter.set_result(None)
+        self._post_disconnect(None)
 
     @asyncio.coroutine
     def handle_pingreq(self, pingreq: PingReqPacket):
@@ -77,22 +117,12 @@ class BrokerProtocolHandler(ProtocolHandler):
     @asyncio.coroutine
     def handle_subscribe(self, subscribe: SubscribePacket):
         subscription = {'packet_id': subscribe.variable_header.packet_id, 'topics': subscribe.payload.topics}
-        yield from self._pending_subscriptions.put(subscription)
+        self._post(INBOX_SUBSCRIBE, subscription)
 
     @asyncio.coroutine
     def handle_unsubscribe(self, unsubscribe: UnsubscribePacket):
         unsubscription = {'packet_id': unsubscribe.variable_header.packet_id, 'topics': unsubscribe.payload.topics}
-        yield from self._pending_unsubscriptions.put(unsubscription)
-
-    @asyncio.coroutine
-    def get_next_pending_subscription(self):
-        subscription = yield from self._pending_subscriptions.get()
-        return subscription
-
-    @asyncio.coroutine
-    def get_next_pending_unsubscription(self):
-        unsubscription = yield from self._pending_unsubscriptions.get()
-        return unsubscription
+        self._post(INBOX_UNSUBSCRIBE, unsubscription)
 
     @asyncio.coroutine
     def mqtt_acknowledge_subscription(self, packet_id, return_codes):
@@ -28,6 +28,7 @@ from hbmqtt.session import Session, OutgoingApplicationMessage, IncomingApplicat
 from hbmqtt.mqtt.constants import *
 from hbmqtt.plugins.manager import PluginManager
 from hbmqtt.errors import HBMQTTException
+from hbmqtt.utils import lazy_attribute
 
 import sys
 if sys.version_info < (3, 5):
@@ -47,6 +48,13 @@ class ProtocolHandler:
     """
     Class implementing the MQTT communication protocol using asyncio features
     """
+    # Waiters of publish flows acknowledgements by packet id, created when a flow starts
+    _puback_waiters = lazy_attribute('_puback_waiters', lambda self: dict())
+    _pubrec_waiters = lazy_attribute('_pubrec_waiters', lambda self: dict())
+    _pubrel_waiters = lazy_attribute('_pubrel_waiters', lambda self: dict())
+    _pubcomp_waiters = lazy_attribute('_pubcomp_waiters', lambda self: dict())
+    # Set when the reader coro ends, only waited for by stop()
+    _reader_stopped = lazy_attribute('_reader_stopped', lambda self: asyncio.Event(loop=self._loop))
 
     def __init__(self, plugins_manager: PluginManager, session: Session=None, loop=None):
         self.logger = logging.getLogger(__name__)
@@ -65,12 +73,9 @@ class ProtocolHandler:
         self._reader_task = None
         self._keepalive_task = None
         self._reader_ready = None
-        self._reader_stopped = asyncio.Event(loop=self._loop)
 
-        self._puback_waiters = dict()
-        self._pubrec_waiters = dict()
-        self._pubrel_waiters = dict()
-        self._pubcomp_waiters = dict()
+        # Optional hbmqtt.wal.InflightLog where in-flight messages are logged
+        self.inflight_log = None
 
     def _init_session(self, session: Session):
         assert session
@@ -103,9 +108,9 @@ class ProtocolHandler:
     def start(self):
         if not self._is_attached():
             raise ProtocolHandlerException("Handler is not attached to a stream")
-        self._reader_ready = asyncio.Event(loop=self._loop)
+        self._reader_ready = asyncio.Future(loop=self._loop)
         self._reader_task = asyncio.Task(self._reader_loop(), loop=self._loop)
-        yield from asyncio.wait([self._reader_ready.wait()], loop=self._loop)
+        yield from self._reader_ready
         if self.keepalive_timeout:
             self._keepalive_task = self._loop.call_later(self.keepalive_timeout, self.handle_write_timeout)
 
@@ -131,16 +136,20 @@ class ProtocolHandler:
             self.logger.debug("Handler writer close failed: %s" % e)
 
     def _stop_waiters(self):
-        self.logger.debug("Stopping %d puback waiters" % len(self._puback_waiters))
-        self.logger.debug("Stopping %d pucomp waiters" % len(self._pubcomp_waiters))
-        self.logger.debug("Stopping %d purec waiters" % len(self._pubrec_waiters))
-        self.logger.debug("Stopping %d purel waiters" % len(self._pubrel_waiters))
-        for waiter in itertools.chain(
-                self._puback_waiters.values(),
-                self._pubcomp_waiters.values(),
-                self._pubrec_waiters.values(),
-                self._pubrel_waiters.values()):
-            waiter.cancel()
+        for name in ('_puback_waiters', '_pubcomp_waiters', '_pubrec_waiters', '_pubrel_waiters'):
+            waiters = lazy_attribute.created(self, name)
+            if waiters:
+                self.logger.debug("Stopping %d %s" % (len(waiters), name[1:].replace('_', ' ')))
+                for waiter in waiters.values():
+                    waiter.cancel()
+
+    def _log_inflight(self, app_message):
+        if self.inflight_log is not None:
+            self.inflight_log.put(self.session.client_id, app_message)
+
+    def _log_acknowledged(self, app_message):
+        if self.inflight_log is not None:
+            self.inflight_log.delete(self.session.client_id, app_message.direction, app_message.packet_id)
 
     @asyncio.coroutine
     def _retry_deliveries(self):
@@ -150,7 +159,11 @@ class ProtocolHandler:
         """
         self.logger.debug("Begin messages delivery retries")
         tasks = []
-        for message in itertools.chain(self.session.inflight_in.values(), self.session.inflight_out.values()):
+        if self.session.inflight_in_count or self.session.inflight_out_count:
+            messages = itertools.chain(self.session.inflight_in.values(), self.session.inflight_out.values())
+        else:
+            messages = ()
+        for message in messages:
             tasks.append(asyncio.wait_for(self._handle_message_flow(message), 10, loop=self._loop))
         if tasks:
             done, pending = yield from asyncio.wait(tasks, loop=self._loop)
@@ -187,6 +200,32 @@ class ProtocolHandler:
 
         return message
 
+    @asyncio.coroutine
+    def mqtt_publish_group(self, messages):
+        """
+        Sends MQTT publish messages in order. Consecutive QoS 0 messages are written to the stream at once, while
+        QoS 1 and 2 messages flows are started as tasks in order.
+        This method returns once all messages flows are completed.
+        :param messages: list of (topic, data, qos) tuples, sent without retain flag
+        """
+        packets = []
+        flows = []
+        for topic, data, qos in messages:
+            if qos == QOS_0:
+                if flows and not packets:
+                    # Let flows started just before send their PUBLISH first
+                    yield from asyncio.sleep(0, loop=self._loop)
+                packets.append(OutgoingApplicationMessage(None, topic, qos, data, False).build_publish_packet())
+            else:
+                if packets:
+                    yield from self._send_packets(packets)
+                    packets = []
+                flows.append(ensure_future(self.mqtt_publish(topic, data, qos, retain=False), loop=self._loop))
+        if packets:
+            yield from self._send_packets(packets)
+        if flows:
+            yield from asyncio.wait(flows, loop=self._loop)
+
     @asyncio.coroutine
     def _handle_message_flow(self, app_message):
         """
@@ -225,8 +264,8 @@ class ProtocolHandler:
                                     repr(app_message.publish_packet))
             else:
                 try:
-                    self.session.delivered_message_queue.put_nowait(app_message)
-                except:
+                    self._deliver_message(app_message)
+                except asyncio.QueueFull:
                     self.logger.warning("delivered messages queue full. QOS_0 message discarded")
 
     @asyncio.coroutine
@@ -245,6 +284,7 @@ class ProtocolHandler:
             if app_message.packet_id not in self.session.inflight_out:
                 # Store message in session
                 self.session.inflight_out[app_message.packet_id] = app_message
+                self._log_inflight(app_message)
             if app_message.publish_packet is not None:
                 # A Publish packet has already been sent, this is a retry
                 publish_packet = app_message.build_publish_packet(dup=True)
@@ -263,10 +303,11 @@ class ProtocolHandler:
 
             # Discard inflight message
             del self.session.inflight_out[app_message.packet_id]
+            self._log_acknowledged(app_message)
         elif app_message.direction == INCOMING:
             # Initiate delivery
             self.logger.debug("Add message to delivery")
-            yield from self.session.delivered_message_queue.put(app_message)
+            self._deliver_message(app_message)
             # Send PUBACK
             puback = PubackPacket.build(app_message.packet_id)
             yield from self._send_packet(puback)
@@ -296,6 +337,7 @@ class ProtocolHandler:
                 else:
                     # Store message in session
                     self.session.inflight_out[app_message.packet_id] = app_message
+                    self._log_inflight(app_message)
                     publish_packet = app_message.build_publish_packet()
                 # Send PUBLISH packet
                 yield from self._send_packet(publish_packet)
@@ -315,6 +357,8 @@ class ProtocolHandler:
             if not app_message.pubcomp_packet:
                 # Send pubrel
                 app_message.pubrel_packet = PubrelPacket.build(app_message.packet_id)
+                # Once PUBREC is received, the flow resumes with PUBREL
+                self._log_inflight(app_message)
                 yield from self._send_packet(app_message.pubrel_packet)
                 # Wait for PUBCOMP
                 waiter = asyncio.Future(loop=self._loop)
@@ -324,8 +368,10 @@ class ProtocolHandler:
                 app_message.pubcomp_packet = waiter.result()
             # Discard inflight message
             del self.session.inflight_out[app_message.packet_id]
+            self._log_acknowledged(app_message)
         elif app_message.direction == INCOMING:
             self.session.inflight_in[app_message.packet_id] = app_message
+            self._log_inflight(app_message)
             # Send pubrec
             pubrec_packet = PubrecPacket.build(app_message.packet_id)
             yield from self._send_packet(pubrec_packet)
@@ -344,8 +390,9 @@ class ProtocolHandler:
                 del self._pubrel_waiters[app_message.packet_id]
                 app_message.pubrel_packet = waiter.result()
                 # Initiate delivery and discard message
-                yield from self.session.delivered_message_queue.put(app_message)
+                self._deliver_message(app_message)
                 del self.session.inflight_in[app_message.packet_id]
+                self._log_acknowledged(app_message)
                 # Send pubcomp
                 pubcomp_packet = PubcompPacket.build(app_message.packet_id)
                 yield from self._send_packet(pubcomp_packet)
@@ -361,9 +408,10 @@ class ProtocolHandler:
         keepalive_timeout = self.session.keep_alive
         if keepalive_timeout <= 0:
             keepalive_timeout = None
+        if not self._reader_ready.done():
+            self._reader_ready.set_result(None)
         while True:
             try:
-                self._reader_ready.set()
                 while running_tasks and running_tasks[0].done():
                     running_tasks.popleft()
                 if len(running_tasks) > 1:
@@ -454,6 +502,33 @@ class ProtocolHandler:
             self.logger.warning("Unhandled exception: %s" % e)
             raise
 
+    def _deliver_message(self, app_message):
+        """
+        Make an incoming message available to the application, through :meth:`mqtt_deliver_next_message`
+        :param app_message: IncomingApplicationMessage
+        """
+        self.session.delivered_message_queue.put_nowait(app_message)
+
+    @asyncio.coroutine
+    def _send_packets(self, packets):
+        """
+        Send packets with a single write to the stream
+        """
+        try:
+            self.writer.write(b''.join(packet.to_bytes() for packet in packets))
+            yield from self.writer.drain()
+            if self._keepalive_task:
+                self._keepalive_task.cancel()
+                self._keepalive_task = self._loop.call_later(self.keepalive_timeout, self.handle_write_timeout)
+            for packet in packets:
+                self.plugins_manager.schedule_event(EVENT_MQTT_PACKET_SENT, packet=packet, session=self.session)
+        except ConnectionResetError:
+            yield from self.handle_connection_closed()
+            raise
+        except BaseException as e:
+            self.logger.warning("Unhandled exception: %s" % e)
+            raise
+
     @asyncio.coroutine
     def mqtt_deliver_next_message(self):
         if self.logger.isEnabledFor(logging.DEBUG):
@@ -564,4 +639,3 @@ class ProtocolHandler:
         incoming_message = IncomingApplicationMessage(packet_id, publish_packet.topic_name, qos, publish_packet.data, publish_packet.retain_flag)
         incoming_message.publish_packet = publish_packet
         yield from self._handle_message_flow(incoming_message)
-        self.logger.debug("Message queue size: %d" % self.session.delivered_message_queue.qsize())
@@ -7,6 +7,8 @@ from hbmqtt.codecs import *
 
 
 class PublishVariableHeader(MQTTVariableHeader):
+    __slots__ = ('topic_name', 'packet_id')
+
     def __init__(self, topic_name: str, packet_id: int=None):
         super().__init__()
         if '*' in topic_name:
@@ -37,6 +39,8 @@ class PublishVariableHeader(MQTTVariableHeader):
 
 
 class PublishPayload(MQTTPayload):
+    __slots__ = ('data',)
+
     def __init__(self, data: bytes=None):
         super().__init__()
         self.data = data
@@ -62,6 +66,7 @@ class PublishPayload(MQTTPayload):
 
 
 class PublishPacket(MQTTPacket):
+    __slots__ = ()
     VARIABLE_HEADER = PublishVariableHeader
     PAYLOAD = PublishPayload
 
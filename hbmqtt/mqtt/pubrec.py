@@ -6,6 +6,7 @@ from hbmqtt.errors import HBMQTTException
 
 
 class PubrecPacket(MQTTPacket):
+    __slots__ = ()
     VARIABLE_HEADER = PacketIdVariableHeader
     PAYLOAD = None
 
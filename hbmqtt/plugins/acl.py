@@ -0,0 +1,211 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+
+ACTION_SUBSCRIBE = 'subscribe'
+ACTION_PUBLISH = 'publish'
+
+_READ = 0x01
+_WRITE = 0x02
+
+_access = {
+    'read': _READ,
+    'write': _WRITE,
+    'readwrite': _READ | _WRITE,
+}
+
+_action_access = {
+    ACTION_SUBSCRIBE: _READ,
+    ACTION_PUBLISH: _WRITE,
+}
+
+_defaults = {
+    'cache-size': 1000,
+}
+
+
+class TopicTrie:
+    """
+    Topic filters compiled in a tree of topic levels, with allowed and denied access at the end of each filter.
+
+    A topic or topic filter is allowed if it is covered by an allowing filter and doesn't overlap a denying filter.
+    """
+    __slots__ = ('children', 'allow', 'deny', 'subtree_deny')
+
+    def __init__(self):
+        self.children = dict()
+        self.allow = 0
+        self.deny = 0
+        # Access denied by this node or a node below, so a '#' filter overlapping this subtree is denied
+        self.subtree_deny = 0
+
+    def add(self, a_filter, access, deny=False):
+        node = self
+        for level in a_filter.split('/'):
+            if deny:
+                node.subtree_deny |= access
+            node = node.children.setdefault(level, TopicTrie())
+        if deny:
+            node.subtree_deny |= access
+            node.deny |= access
+        else:
+            node.allow |= access
+
+    def allowed(self, topic, access):
+        levels = topic.split('/')
+        return bool(self._covered(levels, 0, access)) and not self._denied(levels, 0, access)
+
+    def _covered(self, levels, index, access):
+        children = self.children
+        wildcard = children.get('#', None)
+        if wildcard is not None and wildcard.allow & access:
+            return True
+        if index == len(levels):
+            return self.allow & access
+        level = levels[index]
+        if level == '#':
+            return False
+        child = children.get('+', None)
+        if child is not None and child._covered(levels, index + 1, access):
+            return True
+        if level != '+':
+            child = children.get(level, None)
+            if child is not None and child._covered(levels, index + 1, access):
+                return True
+        return False
+
+    def _denied(self, levels, index, access):
+        if not self.subtree_deny & access:
+            return False
+        children = self.children
+        wildcard = children.get('#', None)
+        if wildcard is not None and wildcard.deny & access:
+            return True
+        if index == len(levels):
+            return self.deny & access
+        level = levels[index]
+        if level == '#':
+            return True
+        if level == '+':
+            return any(child._denied(levels, index + 1, access)
+                       for name, child in children.items() if name != '#')
+        for name in ('+', level):
+            child = children.get(name, None)
+            if child is not None and child._denied(levels, index + 1, access):
+                return True
+        return False
+
+
+class TopicACLPlugin:
+    """
+    Authorize subscriptions and publications with an ACL file in mosquitto format::
+
+        # Rules before any 'user' line apply to anonymous clients
+        topic read public/#
+        user alice
+        topic readwrite alice/#
+        topic deny alice/secret
+        # Patterns apply to all clients, %u is replaced by username and %c by client id
+        pattern readwrite devices/%c/#
+
+    Rules of a session are compiled in a :class:`TopicTrie` on first use and decisions are cached per session, so
+    checking a topic already seen costs a dict lookup. Topics not allowed by any rule are denied.
+    """
+    def __init__(self, context):
+        self.context = context
+        self._user_rules = dict()
+        self._patterns = []
+        # client_id -> (username, trie, {(topic, action): decision})
+        self._sessions = dict()
+        self.topic_config = dict(_defaults)
+        self.topic_config.update(self.context.config.get('topic-check', None) or dict())
+        self._cache_size = int(self.topic_config['cache-size'])
+        acl_file = self.topic_config.get('acl-file', None)
+        if acl_file:
+            self._read_acl_file(acl_file)
+        else:
+            self.context.logger.debug("Configuration parameter 'acl-file' not found")
+
+    def _read_acl_file(self, acl_file):
+        try:
+            with open(acl_file) as f:
+                username = None
+                for l in f:
+                    line = l.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    keyword, _, value = line.partition(' ')
+                    value = value.strip()
+                    if keyword == 'user':
+                        username = value
+                        self._user_rules.setdefault(username, [])
+                    elif keyword in ('topic', 'pattern'):
+                        access, _, a_filter = value.partition(' ')
+                        if access not in _access and access != 'deny':
+                            access, a_filter = 'readwrite', value
+                        rule = (access, a_filter.strip())
+                        if keyword == 'topic':
+                            self._user_rules.setdefault(username, []).append(rule)
+                        else:
+                            self._patterns.append(rule)
+                    else:
+                        self.context.logger.warning("Invalid ACL line ignored: %s" % line)
+            self.context.logger.debug("%d user(s) and %d pattern(s) read from ACL file %s" %
+                                      (len(self._user_rules), len(self._patterns), acl_file))
+        except FileNotFoundError:
+            self.context.logger.warning("ACL file %s not found" % acl_file)
+
+    @staticmethod
+    def _substitute(a_filter, session):
+        for token, value in (('%u', session.username), ('%c', session.client_id)):
+            if token in a_filter:
+                # A substituted value containing wildcards or separators would widen the rule
+                if not value or '+' in value or '#' in value or '/' in value:
+                    return None
+                a_filter = a_filter.replace(token, value)
+        return a_filter
+
+    def compile_rules(self, session):
+        """
+        Build the topic trie of rules applying to a session
+        """
+        trie = TopicTrie()
+        rules = list(self._user_rules.get(session.username or None, ()))
+        for access, a_filter in self._patterns:
+            a_filter = self._substitute(a_filter, session)
+            if a_filter is not None:
+                rules.append((access, a_filter))
+        for access, a_filter in rules:
+            if access == 'deny':
+                trie.add(a_filter, _READ | _WRITE, deny=True)
+            else:
+                trie.add(a_filter, _access[access])
+        return trie
+
+    @asyncio.coroutine
+    def topic_filtering(self, *args, **kwargs):
+        session = kwargs.get('session', None)
+        topic = kwargs.get('topic', None)
+        action = kwargs.get('action', None)
+        state = self._sessions.get(session.client_id, None)
+        if state is None or state[0] != session.username:
+            state = (session.username, self.compile_rules(session), dict())
+            self._sessions[session.client_id] = state
+        decisions = state[2]
+        key = (topic, action)
+        try:
+            return decisions[key]
+        except KeyError:
+            pass
+        decision = state[1].allowed(topic, _action_access[action])
+        if len(decisions) >= self._cache_size:
+            decisions.clear()
+        decisions[key] = decision
+        if not decision:
+            self.context.logger.debug("%s denied to '%s' on topic '%s'" % (action, session.client_id, topic))
+        return decision
+
+    @asyncio.coroutine
+    def on_broker_client_disconnected(self, client_id):
+        self._sessions.pop(client_id, None)
@@ -3,8 +3,22 @@
 # See the file license.txt for copying permission.
 import logging
 import asyncio
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from passlib.apps import custom_app_context as pwd_context
 
+_file_auth_defaults = {
+    'verify-workers': 4,
+    'verify-executor': 'thread',
+    'cache-ttl': 300,
+    'cache-size': 10000,
+}
+
 
 class BaseAuthPlugin:
     def __init__(self, context):
@@ -50,10 +64,30 @@ class AnonymousAuthPlugin(BaseAuthPlugin):
 
 
 class FileAuthPlugin(BaseAuthPlugin):
+    """
+    Authenticate users against a password file.
+
+    Password hashes are verified in an executor so that slow hashes don't block the event loop. Successful
+    verifications are cached for ``cache-ttl`` seconds, keyed by a HMAC digest of username, password and hash, so
+    clients reconnecting with the same credentials skip the hash computation.
+    """
     def __init__(self, context):
         super().__init__(context)
         self._users = dict()
         self._read_password_file()
+        config = dict(_file_auth_defaults)
+        config.update(self.auth_config or dict())
+        self._cache_ttl = float(config['cache-ttl'])
+        self._cache_size = int(config['cache-size'])
+        self._verify_workers = int(config['verify-workers'])
+        self._verify_executor = config['verify-executor']
+        self._executor = None
+        # Random key so that cache digests can't be used to guess passwords
+        self._cache_key = os.urandom(32)
+        # digest -> expiry time of successful verifications, oldest first
+        self._cache = OrderedDict()
+        # digest -> future of verifications running in executor
+        self._verifying = dict()
 
     def _read_password_file(self):
         password_file = self.auth_config.get('password-file', None)
@@ -85,7 +119,57 @@ class FileAuthPlugin(BaseAuthPlugin):
                     authenticated = False
                     self.context.logger.debug("No hash found for user '%s'" % session.username)
                 else:
-                    authenticated = pwd_context.verify(session.password, hash)
+                    authenticated = yield from self._verify(session.username, session.password, hash)
             else:
                 return None
         return authenticated
+
+    def _digest(self, username, password, hash):
+        message = '\0'.join((username, password, hash)).encode('utf-8')
+        return hmac.new(self._cache_key, message, hashlib.sha256).digest()
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self._verify_executor == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self._verify_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self._verify_workers)
+        return self._executor
+
+    @asyncio.coroutine
+    def _verify(self, username, password, hash):
+        if password is None:
+            return False
+        digest = self._digest(username, password, hash)
+        now = time.monotonic()
+        expiry = self._cache.get(digest, None)
+        if expiry is not None:
+            if expiry > now:
+                self._cache.move_to_end(digest)
+                self.context.logger.debug("Cached credentials verification for user '%s'" % username)
+                return True
+            del self._cache[digest]
+        # Concurrent connections with the same credentials share a single verification. Each waiter is shielded so
+        # that a cancelled connection doesn't cancel the verification of the others
+        loop = self.context.loop if self.context.loop is not None else asyncio.get_event_loop()
+        future = self._verifying.get(digest, None)
+        if future is None:
+            future = loop.run_in_executor(self._get_executor(), pwd_context.verify, password, hash)
+            self._verifying[digest] = future
+            future.add_done_callback(partial(self._verified, digest))
+        return (yield from asyncio.shield(future, loop=loop))
+
+    def _verified(self, digest, future):
+        del self._verifying[digest]
+        if future.cancelled() or future.exception() is not None:
+            return
+        if future.result() and self._cache_ttl > 0 and self._cache_size > 0:
+            self._cache[digest] = time.monotonic() + self._cache_ttl
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    @asyncio.coroutine
+    def on_broker_post_shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -54,6 +54,8 @@ class PluginManager:
         self._plugins = []
         self._load_plugins(namespace)
         self._fired_events = []
+        # event name -> [(plugin name, event method)], built on first fire of each event
+        self._event_methods = dict()
         plugins_manager[namespace] = self
 
     @property
@@ -128,31 +130,44 @@ class PluginManager:
         :param wait: indicates if fire_event should wait for plugin calls completion (True), or not
         :return:
         """
-        tasks = []
-        event_method_name = "on_" + event_name
-        for plugin in self._plugins:
-            event_method = getattr(plugin.object, event_method_name, None)
-            if event_method:
-                try:
-                    task = self._schedule_coro(event_method(*args, **kwargs))
-                    tasks.append(task)
-
-                    def clean_fired_events(future):
-                        try:
-                            self._fired_events.remove(task)
-                        except KeyError:
-                            pass
-
-                    task.add_done_callback(clean_fired_events)
-                except AssertionError:
-                    self.logger.error("Method '%s' on plugin '%s' is not a coroutine" %
-                                      (event_method_name, plugin.name))
-
-        self._fired_events.extend(tasks)
+        tasks = self.schedule_event(event_name, *args, **kwargs)
         if wait:
             if tasks:
                 yield from asyncio.wait(tasks, loop=self._loop)
 
+    def schedule_event(self, event_name, *args, **kwargs):
+        """
+        Fire an event to plugins without waiting for plugin calls. Unlike fire_event, this isn't a coroutine so it can
+        be called from code which must not yield, like message routing. Firing an event no plugin handles only costs a
+        dict lookup.
+        :param event_name:
+        :return: list of scheduled plugin call tasks
+        """
+        try:
+            event_methods = self._event_methods[event_name]
+        except KeyError:
+            event_method_name = "on_" + event_name
+            event_methods = [(plugin.name, getattr(plugin.object, event_method_name))
+                             for plugin in self._plugins if hasattr(plugin.object, event_method_name)]
+            self._event_methods[event_name] = event_methods
+        tasks = []
+        for plugin_name, event_method in event_methods:
+            try:
+                task = self._schedule_coro(event_method(*args, **kwargs))
+            except AssertionError:
+                self.logger.error("Method 'on_%s' on plugin '%s' is not a coroutine" % (event_name, plugin_name))
+                continue
+            task.add_done_callback(self._clean_fired_event)
+            tasks.append(task)
+        self._fired_events.extend(tasks)
+        return tasks
+
+    def _clean_fired_event(self, task):
+        try:
+            self._fired_events.remove(task)
+        except ValueError:
+            pass
+
     @asyncio.coroutine
     def map(self, coro, *args, **kwargs):
         """
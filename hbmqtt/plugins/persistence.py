@@ -2,8 +2,128 @@
 #
 # See the file license.txt for copying permission.
 import asyncio
+import hashlib
 import sqlite3
-import pickle
+import threading
+import time
+from collections import OrderedDict
+from queue import Queue, Empty
+from hbmqtt.session import Session, ApplicationMessage, OutgoingApplicationMessage, RetainedApplicationMessage, \
+    INCOMING
+from hbmqtt.errors import CodecException
+
+_defaults = {
+    'commit-delay': 0.05,
+    'commit-size': 100,
+    'digest-cache-size': 10000,
+}
+
+_STOP = object()
+
+# session_message direction of messages queued for an offline session, keyed by a sequence number which doesn't change
+# while the message stays queued
+_QUEUED = 2
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class SQLiteWorker(threading.Thread):
+    """
+    Thread running all operations on a SQLite connection, so that disk access never blocks the event loop.
+
+    Operations are queued with :meth:`submit` and executed in order. Writes are group-committed: after a first write,
+    following operations are executed in the same transaction until ``commit_size`` writes are pending or
+    ``commit_delay`` seconds elapsed. Futures of writes are resolved once their transaction is committed, futures of
+    reads as soon as they are executed.
+    """
+    def __init__(self, conn, loop, logger, commit_delay=0.05, commit_size=100):
+        super().__init__(name='hbmqtt-sqlite', daemon=True)
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.logger = logger
+        self.commit_delay = commit_delay
+        self.commit_size = commit_size
+        self._loop = loop
+        self._queue = Queue()
+
+    def submit(self, operation, *args, write=True):
+        """
+        Queue an operation to be run in the worker thread
+        :param operation: callable receiving the cursor and args
+        :param write: True if operation modifies the database and must be committed
+        :return: asyncio future resolved with the operation result
+        """
+        future = asyncio.Future(loop=self._loop)
+        self._queue.put((operation, args, write, future))
+        return future
+
+    def stop(self):
+        self._queue.put(_STOP)
+
+    def _resolve(self, future, result=None, exception=None):
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def _complete(self, future, result=None, exception=None):
+        self._loop.call_soon_threadsafe(self._resolve, future, result, exception)
+
+    def _execute(self, item):
+        operation, args, write, future = item
+        try:
+            result = operation(self.cursor, *args)
+        except Exception as e:
+            self._complete(future, exception=e)
+            return None
+        if write:
+            return future, result
+        self._complete(future, result)
+        return None
+
+    def _commit(self, pending):
+        try:
+            self.conn.commit()
+        except Exception as e:
+            self.logger.error("Commit of %d operations failed: %s" % (len(pending), e))
+            for future, result in pending:
+                self._complete(future, exception=e)
+        else:
+            for future, result in pending:
+                self._complete(future, result)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            pending = []
+            done = self._execute(item)
+            if done:
+                pending.append(done)
+                deadline = time.monotonic() + self.commit_delay
+                while len(pending) < self.commit_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    done = self._execute(item)
+                    if done:
+                        pending.append(done)
+            if pending:
+                self._commit(pending)
+        self.conn.close()
 
 
 class SQLitePlugin:
@@ -12,11 +132,24 @@ class SQLitePlugin:
         self.conn = None
         self.cursor = None
         self.db_file = None
+        self._worker = None
+        # client_id -> (session state digest, {(direction, packet_id): message digest}) of what is stored, least
+        # recently saved or loaded first. Sessions without digests are written whole.
+        self._saved = OrderedDict()
+        self._saved_size = _defaults['digest-cache-size']
+        # Last sequence number given to a queued message. Numbers only need to be unique within a session.
+        self._queued_sequence = 0
+        if self.context.loop is not None:
+            self._loop = self.context.loop
+        else:
+            self._loop = asyncio.get_event_loop()
         try:
-            self.persistence_config = self.context.config['persistence']
+            self.persistence_config = dict(_defaults)
+            self.persistence_config.update(self.context.config['persistence'])
+            self._saved_size = int(self.persistence_config['digest-cache-size'])
             self.init_db()
         except KeyError:
-            self.context.logger.warn("'persistence' section not found in context configuration")
+            self.context.logger.debug("'persistence' section not found in context configuration")
 
     def init_db(self):
         self.db_file = self.persistence_config.get('file', None)
@@ -24,42 +157,179 @@ class SQLitePlugin:
             self.context.logger.warn("'file' persistence parameter not found")
         else:
             try:
-                self.conn = sqlite3.connect(self.db_file)
+                # Connection is created here but only used by the worker thread afterwards
+                self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
                 self.cursor = self.conn.cursor()
                 self.context.logger.info("Database file '%s' opened" % self.db_file)
             except Exception as e:
                 self.context.logger.error("Error while initializing database '%s' : %s" % (self.db_file, e))
         if self.cursor:
+            # WAL lets commits append to the log instead of rewriting pages, with a single fsync at checkpoints
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            self.cursor.execute("PRAGMA synchronous=NORMAL")
             self.cursor.execute("CREATE TABLE IF NOT EXISTS session(client_id TEXT PRIMARY KEY, data BLOB)")
+            self.cursor.execute("CREATE TABLE IF NOT EXISTS session_message("
+                                "client_id TEXT, direction INTEGER, packet_id INTEGER, data BLOB, "
+                                "PRIMARY KEY (client_id, direction, packet_id))")
+            self.conn.commit()
+            self._worker = SQLiteWorker(self.conn, self._loop, self.context.logger,
+                                        commit_delay=float(self.persistence_config['commit-delay']),
+                                        commit_size=int(self.persistence_config['commit-size']))
+            self._worker.start()
+
+    @staticmethod
+    def _write_session(cursor, client_id, data, messages, deleted_messages, replace=False):
+        if data is not None:
+            cursor.execute("INSERT OR REPLACE INTO session (client_id, data) VALUES (?,?)", (client_id, data))
+        if replace:
+            cursor.execute("DELETE FROM session_message WHERE client_id=?", (client_id,))
+        for (direction, packet_id) in deleted_messages:
+            cursor.execute("DELETE FROM session_message WHERE client_id=? AND direction=? AND packet_id=?",
+                           (client_id, direction, packet_id))
+        for (direction, packet_id), message_data in messages:
+            # Update in place to keep rowid, which gives messages order
+            cursor.execute("UPDATE session_message SET data=? WHERE client_id=? AND direction=? AND packet_id=?",
+                           (message_data, client_id, direction, packet_id))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO session_message (client_id, direction, packet_id, data) VALUES (?,?,?,?)",
+                               (client_id, direction, packet_id, message_data))
+
+    def _set_saved(self, client_id, data_digest, digests):
+        self._saved[client_id] = (data_digest, digests)
+        self._saved.move_to_end(client_id)
+        while len(self._saved) > self._saved_size:
+            self._saved.popitem(last=False)
+
+    @staticmethod
+    def _find_session(cursor, client_id):
+        row = cursor.execute("SELECT data FROM session where client_id=?", (client_id,)).fetchone()
+        if row is None:
+            return None
+        messages = cursor.execute("SELECT direction, packet_id, data FROM session_message WHERE client_id=? ORDER BY rowid",
+                                  (client_id,)).fetchall()
+        return row[0], messages
+
+    @staticmethod
+    def _find_sessions(cursor):
+        return cursor.execute("SELECT client_id, data FROM session").fetchall()
+
+    @staticmethod
+    def _del_session(cursor, client_id):
+        cursor.execute("DELETE FROM session where client_id=?", (client_id,))
+        cursor.execute("DELETE FROM session_message where client_id=?", (client_id,))
+
+    def _session_messages(self, session):
+        """
+        Get messages to store with a session
+        :return: generator of ((direction, packet_id), message data) tuples
+        """
+        if session.inflight_in_count:
+            for message in session.inflight_in.values():
+                yield (message.direction, message.packet_id), message.to_bytes()
+        if session.inflight_out_count:
+            for message in session.inflight_out.values():
+                yield (message.direction, message.packet_id), message.to_bytes()
+        if not session.retained_messages_count:
+            return
+        # asyncio.Queue has no public way to peek at its items
+        for queued in session.retained_messages._queue:
+            if queued.sequence is None:
+                self._queued_sequence += 1
+                queued.sequence = self._queued_sequence
+            message = OutgoingApplicationMessage(None, queued.topic, queued.qos or 0, queued.data, False)
+            yield (_QUEUED, queued.sequence), message.to_bytes()
 
     @asyncio.coroutine
-    def save_session(self, session):
-        if self.cursor:
-            dump = pickle.dumps(session)
+    def save_session(self, session, subscriptions=None):
+        """
+        Save session state. Only parts changed since the last save or load of this session are written: the session
+        record if client state or subscriptions changed, and in-flight or queued messages added, updated or removed.
+        :param session: session to save
+        :param subscriptions: list of (topic filter, qos) tuples subscribed by the session
+        """
+        if self._worker:
+            data = session.to_bytes(subscriptions)
+            saved = self._saved.get(session.client_id, None)
+            saved_data, saved_messages = saved if saved is not None else (None, dict())
+            data_digest = _digest(data)
+            if data_digest == saved_data:
+                data = None
+            messages = []
+            digests = dict()
+            for key, message_data in self._session_messages(session):
+                digests[key] = _digest(message_data)
+                if saved_messages.get(key, None) != digests[key]:
+                    messages.append((key, message_data))
+            deleted_messages = [key for key in saved_messages if key not in digests]
+            if data is None and not messages and not deleted_messages:
+                return
+            self._set_saved(session.client_id, data_digest, digests)
             try:
-                self.cursor.execute(
-                    "INSERT OR REPLACE INTO session (client_id, data) VALUES (?,?)", (session.client_id, dump))
-                self.conn.commit()
+                yield from self._worker.submit(self._write_session, session.client_id, data, messages,
+                                               deleted_messages, saved is None)
             except Exception as e:
+                self._saved.pop(session.client_id, None)
                 self.context.logger.error("Failed saving session '%s': %s" % (session, e))
 
     @asyncio.coroutine
     def find_session(self, client_id):
-        if self.cursor:
-            row = self.cursor.execute("SELECT data FROM session where client_id=?", (client_id,)).fetchone()
-            if row:
-                return pickle.loads(row[0])
-            else:
+        """
+        Load a saved session, with its in-flight and queued messages
+        :param client_id: client id of the session to load
+        :return: (session, subscriptions) tuple, or None if no valid session is found
+        """
+        if self._worker:
+            row = yield from self._worker.submit(self._find_session, client_id, write=False)
+            if row is None:
+                return None
+            data, messages_data = row
+            try:
+                session, subscriptions = Session.from_bytes(data, loop=self._loop)
+                digests = dict()
+                for direction, packet_id, message_data in messages_data:
+                    message, offset = ApplicationMessage.from_bytes(message_data)
+                    if direction == _QUEUED:
+                        queued = RetainedApplicationMessage(message.topic, message.data, message.qos)
+                        queued.sequence = packet_id
+                        self._queued_sequence = max(self._queued_sequence, packet_id)
+                        session.retained_messages.put_nowait(queued)
+                    elif direction == INCOMING:
+                        session.inflight_in[message.packet_id] = message
+                    else:
+                        session.inflight_out[message.packet_id] = message
+                    digests[(direction, packet_id)] = _digest(message_data)
+            except CodecException as ce:
+                self.context.logger.warning("Can't load session '%s': %s" % (client_id, ce))
                 return None
+            self._set_saved(client_id, _digest(data), digests)
+            return session, subscriptions
+
+    @asyncio.coroutine
+    def find_subscriptions(self):
+        """
+        Get subscriptions of all saved sessions, without loading their in-flight and queued messages
+        :return: dict of client_id -> list of (topic filter, qos) tuples
+        """
+        if self._worker:
+            rows = yield from self._worker.submit(self._find_sessions, write=False)
+            subscriptions = dict()
+            for client_id, data in rows:
+                try:
+                    session, subscriptions[client_id] = Session.from_bytes(data, loop=self._loop)
+                except CodecException as ce:
+                    self.context.logger.warning("Can't load session '%s': %s" % (client_id, ce))
+            return subscriptions
 
     @asyncio.coroutine
     def del_session(self, client_id):
-        if self.cursor:
-            self.cursor.execute("DELETE FROM session where client_id=?", (client_id,))
-            self.conn.commit()
+        if self._worker:
+            self._saved.pop(client_id, None)
+            yield from self._worker.submit(self._del_session, client_id)
 
     @asyncio.coroutine
     def on_broker_post_shutdown(self):
-        if self.conn:
-            self.conn.close()
+        if self._worker:
+            self._worker.stop()
+            yield from self._loop.run_in_executor(None, self._worker.join)
+            self._worker = None
             self.context.logger.info("Database file '%s' closed" % self.db_file)
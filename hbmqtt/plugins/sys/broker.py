@@ -127,6 +127,20 @@ class BrokerSysPlugin:
         tasks.append(self.schedule_broadcast_sys_topic('messages/publish/sent', int_to_bytes_str(self._stats[STAT_PUBLISH_SENT])))
         tasks.append(self.schedule_broadcast_sys_topic('messages/retained/count', int_to_bytes_str(len(self.context.retained_messages))))
         tasks.append(self.schedule_broadcast_sys_topic('messages/subscriptions/count', int_to_bytes_str(subscriptions_count)))
+        for listener_name, server in getattr(self.context, 'listeners', dict()).items():
+            handshake_stats = server.handshake_stats
+            handshake_avg = handshake_stats['duration_total'] / handshake_stats['count'] if handshake_stats['count'] else 0
+            for name, value in (('handshakes/in_progress', int_to_bytes_str(server.handshakes)),
+                                ('handshakes/count', int_to_bytes_str(handshake_stats['count'])),
+                                ('handshakes/timeouts', int_to_bytes_str(handshake_stats['timeouts'])),
+                                ('handshakes/rejected', int_to_bytes_str(handshake_stats['rejected'])),
+                                ('handshakes/duration/avg', ('%.6f' % handshake_avg).encode('utf-8')),
+                                ('handshakes/duration/max', ('%.6f' % handshake_stats['duration_max']).encode('utf-8'))):
+                tasks.append(self.schedule_broadcast_sys_topic('listeners/%s/%s' % (listener_name, name), value))
+            if server.admission:
+                for reason, count in server.admission.rejected.items():
+                    tasks.append(self.schedule_broadcast_sys_topic(
+                        'listeners/%s/connections/rejected/%s' % (listener_name, reason), int_to_bytes_str(count)))
 
         # Wait until broadcasting tasks end
         while tasks and tasks[0].done():
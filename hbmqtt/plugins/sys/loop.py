@@ -0,0 +1,216 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import heapq
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from hbmqtt.plugins.sys.broker import DOLLAR_SYS_ROOT
+
+DOLLAR_SYS_LOOP_ROOT = DOLLAR_SYS_ROOT + 'loop/'
+
+_defaults = {
+    'interval': 0.1,
+    'threshold': 0.1,
+    'samples': 1000,
+    'offenders': 10,
+}
+
+
+class LoopStall:
+    """
+    A period during which the event loop didn't run any other callback
+    """
+    def __init__(self, started, stack):
+        self.started = started
+        """ datetime the stall was detected at"""
+
+        self.duration = None
+        """ stall duration in seconds, ``None`` until the loop runs again"""
+
+        self.stack = stack
+        """ formatted stack of the loop thread captured while stalled"""
+
+    def as_dict(self):
+        return {'started': str(self.started), 'duration': self.duration, 'stack': self.stack}
+
+    def __lt__(self, other):
+        return self.duration < other.duration
+
+    def __repr__(self):
+        return type(self).__name__ + '(started={0}, duration={1})'.format(self.started, self.duration)
+
+
+class LoopMonitor:
+    """
+    Measures event loop scheduling lag and captures stacks of callbacks blocking the loop.
+
+    A timer callback is scheduled every ``interval`` seconds on the loop. The difference between the time it actually
+    runs and the time it was scheduled for is the loop lag. A watchdog thread checks this callback keeps running: if
+    it didn't for more than ``threshold`` seconds, the stack of the loop thread is captured, which points at the code
+    blocking the loop. The ``offenders`` longest stalls are kept.
+
+    Stalls are only counted and recorded by the loop thread, once the loop runs again.
+    """
+    def __init__(self, loop, interval=0.1, threshold=0.1, samples=1000, offenders=10, clock=time.monotonic):
+        self.logger = logging.getLogger(__name__)
+        self._loop = loop
+        self._clock = clock
+        self.interval = interval
+        self.threshold = threshold
+        self.stall_count = 0
+        self._lags = deque(maxlen=samples)
+        self._max_offenders = offenders
+        self._offenders = []
+        self._expected = None
+        self._heartbeat = None
+        self._handle = None
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._current_stall = None
+
+    def start(self):
+        """
+        Start monitoring. Must be called from the loop thread.
+        """
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._heartbeat = self._clock()
+        self._schedule()
+        self._thread = threading.Thread(target=self._watchdog, name='hbmqtt-loop-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self.interval
+        self._handle = self._loop.call_at(self._expected, self._tick)
+
+    def _tick(self):
+        lag = self._loop.time() - self._expected
+        self._lags.append(lag)
+        now = self._clock()
+        blocked = now - self._heartbeat
+        self._heartbeat = now
+        stall = self._current_stall
+        if stall is not None:
+            self._current_stall = None
+            # Time since the previous tick, less the sampling interval which isn't part of the stall
+            stall.duration = blocked - self.interval
+            if stall.duration < self.threshold:
+                # Watchdog raced with this tick: the loop wasn't actually blocked
+                self._schedule()
+                return
+            self.stall_count += 1
+            self.logger.warning("Event loop blocked for %.3fs:\n%s" % (stall.duration, stall.stack))
+            if len(self._offenders) < self._max_offenders:
+                heapq.heappush(self._offenders, stall)
+            else:
+                heapq.heappushpop(self._offenders, stall)
+        self._schedule()
+
+    def _watchdog(self):
+        while not self._stopped.wait(self.threshold / 2):
+            self._check()
+
+    def _check(self):
+        """
+        Capture the stack of the loop thread if the loop is blocked. Called by the watchdog thread.
+        """
+        if self._current_stall is not None:
+            return
+        if self._clock() - self._heartbeat > self.interval + self.threshold:
+            frame = sys._current_frames().get(self._thread_id, None)
+            if frame is None:
+                return
+            stack = ''.join(traceback.format_stack(frame))
+            self._current_stall = LoopStall(datetime.now(), stack)
+
+    def percentile(self, p):
+        """
+        Get a lag percentile over the last samples
+        :param p: percentile, between 0 and 100
+        :return: lag in seconds, ``None`` if no sample is available
+        """
+        if not self._lags:
+            return None
+        lags = sorted(self._lags)
+        index = min(len(lags) - 1, int(round(p / 100 * (len(lags) - 1))))
+        return lags[index]
+
+    @property
+    def offenders(self):
+        """
+        Longest stalls recorded, longest first
+        """
+        return sorted(self._offenders, reverse=True)
+
+
+class BrokerLoopMonitorPlugin:
+    """
+    Run a :class:`LoopMonitor` on the broker loop when the ``loop-monitor`` configuration section is set, and
+    broadcast lag percentiles and worst stalls under ``$SYS/broker/loop/`` every ``sys_interval`` seconds.
+    """
+    def __init__(self, context):
+        self.context = context
+        self.monitor = None
+        self._sys_handle = None
+        monitor_config = self.context.config.get('loop-monitor', None)
+        if monitor_config is not None:
+            self._monitor_config = dict(_defaults)
+            self._monitor_config.update(monitor_config or dict())
+        else:
+            self._monitor_config = None
+
+    @asyncio.coroutine
+    def on_broker_post_start(self, *args, **kwargs):
+        if self._monitor_config is None:
+            self.context.logger.debug("Loop monitor disabled")
+            return
+        self.monitor = LoopMonitor(self.context.loop,
+                                   interval=float(self._monitor_config['interval']),
+                                   threshold=float(self._monitor_config['threshold']),
+                                   samples=int(self._monitor_config['samples']),
+                                   offenders=int(self._monitor_config['offenders']))
+        self.monitor.start()
+        sys_interval = int(self.context.config.get('sys_interval', 0))
+        if sys_interval > 0:
+            self._sys_handle = self.context.loop.call_later(sys_interval, self.broadcast_loop_topics)
+
+    @asyncio.coroutine
+    def on_broker_pre_shutdown(self, *args, **kwargs):
+        if self._sys_handle:
+            self._sys_handle.cancel()
+            self._sys_handle = None
+        if self.monitor:
+            self.monitor.stop()
+
+    def _schedule_broadcast(self, topic_basename, data):
+        return asyncio.Task(self.context.broadcast_message(DOLLAR_SYS_LOOP_ROOT + topic_basename, data),
+                            loop=self.context.loop)
+
+    def broadcast_loop_topics(self):
+        for p in (50, 90, 99, 100):
+            lag = self.monitor.percentile(p)
+            if lag is not None:
+                name = 'lag/max' if p == 100 else 'lag/p%d' % p
+                self._schedule_broadcast(name, ('%.6f' % lag).encode('utf-8'))
+        self._schedule_broadcast('stalls/count', str(self.monitor.stall_count).encode('utf-8'))
+        self._schedule_broadcast('stalls/worst',
+                                 json.dumps([s.as_dict() for s in self.monitor.offenders]).encode('utf-8'))
+        sys_interval = int(self.context.config['sys_interval'])
+        self._sys_handle = self.context.loop.call_later(sys_interval, self.broadcast_loop_topics)
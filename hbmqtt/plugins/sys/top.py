@@ -0,0 +1,156 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import heapq
+import json
+from hbmqtt.mqtt.packet import PUBLISH
+from hbmqtt.plugins.sys.broker import DOLLAR_SYS_ROOT
+
+DOLLAR_SYS_TOP_ROOT = DOLLAR_SYS_ROOT + 'top/'
+
+_defaults = {
+    'size': 10,
+    'capacity': 100,
+}
+
+
+class SpaceSaving:
+    """
+    Space-Saving stream summary (Metwally, Agrawal, El Abbadi).
+
+    Keeps at most ``capacity`` counters whatever the number of distinct keys seen. When a new key arrives and the
+    summary is full, the key with the smallest count is evicted and the new key inherits its count as error bound.
+    Any key whose real count is greater than ``total / capacity`` is guaranteed to be in the summary.
+    """
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("Space-Saving capacity must be positive: %d" % capacity)
+        self.capacity = capacity
+        self.total = 0
+        # key -> [count, error]
+        self._counters = dict()
+        # min-heap of (count, key), one entry per counter. Counts only grow, so an entry may lag behind its counter
+        self._heap = []
+
+    def add(self, key, weight=1):
+        self.total += weight
+        counter = self._counters.get(key, None)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self._counters) < self.capacity:
+            self._counters[key] = [weight, 0]
+            heapq.heappush(self._heap, (weight, key))
+            return
+        # Find the real minimum: refresh stale heap entries until the top one is up to date
+        while True:
+            count, min_key = self._heap[0]
+            actual = self._counters[min_key][0]
+            if actual == count:
+                break
+            heapq.heapreplace(self._heap, (actual, min_key))
+        del self._counters[min_key]
+        self._counters[key] = [count + weight, count]
+        heapq.heapreplace(self._heap, (count + weight, key))
+
+    def top(self, n):
+        """
+        Get the ``n`` keys with the highest estimated counts
+        :param n: number of keys to return
+        :return: list of (key, count, error) tuples, highest count first
+        """
+        items = heapq.nlargest(n, self._counters.items(), key=lambda item: item[1][0])
+        return [(key, counter[0], counter[1]) for key, counter in items]
+
+    def clear(self):
+        self.total = 0
+        self._counters = dict()
+        self._heap = []
+
+    def __len__(self):
+        return len(self._counters)
+
+
+class BrokerTopPlugin:
+    """
+    Track heaviest publishers and topics, in messages and bytes, and periodically broadcast the current top-N under
+    ``$SYS/broker/top/``.
+    Memory used is bounded by the ``capacity`` of the underlying summaries, whatever the number of clients and topics.
+    """
+    def __init__(self, context):
+        self.context = context
+        self._top_config = dict(_defaults)
+        self._top_config.update(self.context.config.get('top', None) or dict())
+        capacity = int(self._top_config['capacity'])
+        self._summaries = {
+            ('clients', 'messages'): SpaceSaving(capacity),
+            ('clients', 'bytes'): SpaceSaving(capacity),
+            ('topics', 'messages'): SpaceSaving(capacity),
+            ('topics', 'bytes'): SpaceSaving(capacity),
+        }
+        self._enabled = False
+        self._interval = 0
+        self._window_start = None
+        self._top_handle = None
+
+    @asyncio.coroutine
+    def on_broker_post_start(self, *args, **kwargs):
+        self._interval = int(self._top_config.get('interval', self.context.config.get('sys_interval', 0)))
+        if self._interval > 0:
+            self._enabled = True
+            self._reset_window()
+            self.context.logger.debug("Setup $SYS top broadcasting every %d secondes" % self._interval)
+            self._top_handle = self.context.loop.call_later(self._interval, self.broadcast_top_topics)
+        else:
+            self.context.logger.debug("$SYS top disabled")
+
+    @asyncio.coroutine
+    def on_broker_pre_shutdown(self, *args, **kwargs):
+        self._enabled = False
+        if self._top_handle:
+            self._top_handle.cancel()
+            self._top_handle = None
+
+    @asyncio.coroutine
+    def on_mqtt_packet_received(self, *args, **kwargs):
+        if not self._enabled:
+            return
+        packet = kwargs.get('packet')
+        session = kwargs.get('session', None)
+        if packet and session and packet.fixed_header.packet_type == PUBLISH:
+            # Avoid re-encoding the whole packet: fixed header is a few bytes only
+            packet_size = packet.fixed_header.bytes_length + packet.fixed_header.remaining_length
+            self._summaries[('clients', 'messages')].add(session.client_id)
+            self._summaries[('clients', 'bytes')].add(session.client_id, packet_size)
+            self._summaries[('topics', 'messages')].add(packet.topic_name)
+            self._summaries[('topics', 'bytes')].add(packet.topic_name, packet_size)
+
+    def _reset_window(self):
+        self._window_start = self.context.loop.time()
+        for summary in self._summaries.values():
+            summary.clear()
+
+    def get_top(self, kind, unit):
+        """
+        Get the current top-N entries for a given summary
+        :param kind: 'clients' or 'topics'
+        :param unit: 'messages' or 'bytes'
+        :return: list of dict with 'name', 'count', 'error' and 'rate' (per second over the current window)
+        """
+        elapsed = max(self.context.loop.time() - self._window_start, 1e-6)
+        size = int(self._top_config['size'])
+        return [{'name': name, 'count': count, 'error': error, 'rate': round(count / elapsed, 3)}
+                for name, count, error in self._summaries[(kind, unit)].top(size)]
+
+    def broadcast_top_topics(self):
+        """
+        Broadcast current top-N for each summary, start a new counting window and reschedule next execution
+        """
+        for (kind, unit) in self._summaries:
+            data = json.dumps(self.get_top(kind, unit)).encode('utf-8')
+            asyncio.Task(self.context.broadcast_message(DOLLAR_SYS_TOP_ROOT + kind + '/' + unit, data),
+                         loop=self.context.loop)
+        self._reset_window()
+        self.context.logger.debug("Broadcasting $SYS top topics")
+        self._top_handle = self.context.loop.call_later(self._interval, self.broadcast_top_topics)
@@ -0,0 +1,104 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler sampling the stack of a thread from a helper thread.
+
+    Samples are aggregated by stack and written in the *collapsed stacks* text format (one ``frame;frame;frame count``
+    line per distinct stack, root frame first) which can be rendered by flamegraph tools like ``flamegraph.pl`` or
+    speedscope.
+
+    Sampling only walks frames and counts tuples of code objects, so it can run against live traffic; frame labels
+    are built once per code object when the profile is written.
+
+    :param output: path of the collapsed stacks file to write when profiling stops
+    :param frequency: samples per second
+    :param duration: stop sampling after this number of seconds. ``None`` samples until :meth:`stop` is called
+    :param thread_id: identifier of the thread to sample. Defaults to the thread calling :meth:`start`
+    """
+    def __init__(self, output, frequency=100, duration=None, thread_id=None):
+        self.logger = logging.getLogger(__name__)
+        self.output = output
+        self.frequency = frequency
+        self.duration = duration
+        self.thread_id = thread_id
+        self.sample_count = 0
+        self._stacks = Counter()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='hbmqtt-profiler', daemon=True)
+        self._thread.start()
+        self.logger.info("Profiling started (%d Hz), output to '%s'" % (self.frequency, self.output))
+
+    def stop(self):
+        """
+        Stop sampling and wait for the profile file to be written
+        """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        interval = 1.0 / self.frequency
+        if self.duration is not None:
+            deadline = time.monotonic() + self.duration
+        else:
+            deadline = None
+        while not self._stopped.wait(interval):
+            self.sample()
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        self.write_collapsed()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id, None)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self._stacks[tuple(stack)] += 1
+        self.sample_count += 1
+
+    @staticmethod
+    def _label(code):
+        return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def collapsed(self):
+        """
+        Get collected samples as collapsed stacks lines
+        :return: list of ``frame;frame;frame count`` strings
+        """
+        labels = dict()
+        lines = []
+        for stack, count in self._stacks.items():
+            frames = []
+            for code in reversed(stack):
+                label = labels.get(code, None)
+                if label is None:
+                    label = labels[code] = self._label(code)
+                frames.append(label)
+            lines.append('%s %d' % (';'.join(frames), count))
+        return lines
+
+    def write_collapsed(self):
+        with open(self.output, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+        self.logger.info("Profiling stopped: %d samples written to '%s'" % (self.sample_count, self.output))
@@ -0,0 +1,220 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Durable retained messages store.
+
+Retained messages are stored in a snapshot file holding the full set of retained messages at some point, and an
+append-only log of retain and clear operations done after this snapshot. Both files start with the ``HBMQRET`` magic
+followed by a format version byte, then records made of a 8 bytes header (``!BBHI``: operation, QoS, topic length,
+data length) followed by the topic and data.
+
+The log is periodically compacted into a new snapshot. While the snapshot is written, operations are appended to a
+second log file (``.log.new``) which replaces the log once the snapshot is complete, so a crash at any time leaves
+files which load to the latest state.
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+from hbmqtt.errors import HBMQTTException
+
+RETAINED_MAGIC = b'HBMQRET'
+RETAINED_VERSION = 1
+
+OP_RETAIN = 1
+OP_CLEAR = 2
+
+_file_header = RETAINED_MAGIC + bytes([RETAINED_VERSION])
+_record_header = struct.Struct('!BBHI')
+
+
+def _encode_record(op, topic, data=b'', qos=0):
+    topic_bytes = topic.encode('utf-8')
+    return _record_header.pack(op, qos or 0, len(topic_bytes), len(data)) + topic_bytes + data
+
+
+def _fsync(fd):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_records(path):
+    """
+    Read records of a snapshot or log file. An incomplete record at the end of the file, left by an interrupted
+    write, is ignored.
+    :param path: file path
+    :return: generator of (operation, topic, data, qos) tuples
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[:len(_file_header)] != _file_header:
+                raise HBMQTTException("'%s' is not a retained messages file or has an unsupported version" % path)
+            offset = len(_file_header)
+            header_size = _record_header.size
+            unpack_from = _record_header.unpack_from
+            while offset + header_size <= size:
+                op, qos, topic_length, data_length = unpack_from(buffer, offset)
+                start = offset + header_size
+                end = start + topic_length + data_length
+                if end > size:
+                    break
+                topic = buffer[start:start + topic_length].decode('utf-8')
+                yield op, topic, buffer[start + topic_length:end], qos
+                offset = end
+
+
+class RetainedStore:
+    """
+    Store of retained messages made of a snapshot file and an append-only log.
+
+    Writes go through the log file object buffer and reach the disk on :meth:`sync`.
+
+    :param path: snapshot file path. The log is stored in ``path + '.log'``
+    :param fsync: call ``fsync`` on log syncs
+    """
+    def __init__(self, path, fsync=False):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.log_path = path + '.log'
+        self.fsync = fsync
+        self.snapshot_size = 0
+        self.log_size = 0
+        self._log = None
+        self._compacting = False
+
+    def load(self):
+        """
+        Load retained messages from snapshot and logs
+        :return: dict of topic => (data, qos)
+        """
+        messages = dict()
+        for path in (self.path, self.log_path, self.log_path + '.new'):
+            if not os.path.exists(path):
+                continue
+            for op, topic, data, qos in read_records(path):
+                if op == OP_RETAIN:
+                    messages[topic] = (data, qos)
+                else:
+                    messages.pop(topic, None)
+        if os.path.exists(self.log_path + '.new'):
+            # A compaction was interrupted: start again from a snapshot of the loaded state
+            self._write_snapshot(self._records(messages))
+            os.remove(self.log_path + '.new')
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+        self.snapshot_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.logger.info("%d retained messages loaded from '%s'" % (len(messages), self.path))
+        return messages
+
+    def open(self):
+        """
+        Open the log for appending operations. Must be called after :meth:`load`
+        """
+        self._log = self._open_log(self.log_path)
+        self.log_size = self._log.tell()
+
+    @staticmethod
+    def _open_log(path):
+        log = open(path, 'ab')
+        if log.tell() == 0:
+            log.write(_file_header)
+        return log
+
+    def retain(self, topic, data, qos=None):
+        self._append(_encode_record(OP_RETAIN, topic, data, qos))
+
+    def clear(self, topic):
+        self._append(_encode_record(OP_CLEAR, topic))
+
+    def _append(self, record):
+        if self._log is not None:
+            self._log.write(record)
+            self.log_size += len(record)
+
+    @asyncio.coroutine
+    def sync(self, loop=None):
+        """
+        Flush the log. ``fsync`` runs in an executor thread, on a duplicate of the log file descriptor so that the log
+        can be closed or replaced meanwhile.
+        :param loop: asyncio loop
+        """
+        if self._log is None:
+            return
+        self._log.flush()
+        if self.fsync:
+            if loop is None:
+                loop = asyncio.get_event_loop()
+            yield from loop.run_in_executor(None, _fsync, os.dup(self._log.fileno()))
+
+    def flush(self):
+        """
+        Flush the log, blocking until ``fsync`` is done
+        """
+        if self._log is not None:
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+
+    def needs_compaction(self, ratio=2, min_size=1024 * 1024):
+        """
+        Tell if the log became large enough, compared to the snapshot, to be worth compacting
+        """
+        return not self._compacting and self.log_size > max(min_size, ratio * self.snapshot_size)
+
+    @staticmethod
+    def _records(messages):
+        for topic, (data, qos) in messages.items():
+            yield _encode_record(OP_RETAIN, topic, data, qos)
+
+    def _write_snapshot(self, records):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_file_header)
+            for record in records:
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @asyncio.coroutine
+    def compact(self, messages, loop=None):
+        """
+        Write a new snapshot and truncate the log. The snapshot is written in an executor thread.
+        :param messages: current retained messages as a list of (topic, data, qos) tuples. Operations done after this
+            list was built must be appended to the store once this coroutine started
+        :param loop: asyncio loop
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._compacting = True
+        try:
+            # Following operations go to a new log, replayed after the new snapshot
+            self._log.flush()
+            fd = os.dup(self._log.fileno()) if self.fsync else None
+            self._log.close()
+            self._log = self._open_log(self.log_path + '.new')
+            if fd is not None:
+                yield from loop.run_in_executor(None, _fsync, fd)
+            records = [_encode_record(OP_RETAIN, topic, data, qos) for topic, data, qos in messages]
+            yield from loop.run_in_executor(None, self._write_snapshot, records)
+            self.snapshot_size = os.path.getsize(self.path)
+            yield from self.sync(loop)
+            os.replace(self.log_path + '.new', self.log_path)
+            self.log_size = self._log.tell()
+            self.logger.debug("Retained messages compacted: %d messages, %d bytes" %
+                              (len(records), self.snapshot_size))
+        finally:
+            self._compacting = False
+
+    def close(self):
+        if self._log is not None:
+            self.flush()
+            self._log.close()
+            self._log = None
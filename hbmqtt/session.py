@@ -2,20 +2,70 @@
 #
 # See the file license.txt for copying permission.
 import asyncio
-from transitions import Machine
+from struct import Struct
 from asyncio import Queue
 from collections import OrderedDict
 from hbmqtt.mqtt.publish import PublishPacket
-from hbmqtt.errors import HBMQTTException
+from hbmqtt.mqtt.pubrec import PubrecPacket
+from hbmqtt.mqtt.pubrel import PubrelPacket
+from hbmqtt.errors import HBMQTTException, CodecException
+from hbmqtt.states import StateMachine
 
 OUTGOING = 0
 INCOMING = 1
 
+# Persistent state encoding version, first byte of Session.to_bytes() output
+SESSION_FORMAT_VERSION = 1
+
+_session_header = Struct('!BBBHH')
+_message_header = Struct('!BH')
+_string_length = Struct('!H')
+_data_length = Struct('!I')
+
+_MESSAGE_INCOMING = 0x01
+_MESSAGE_QOS = 0x06
+_MESSAGE_RETAIN = 0x08
+_MESSAGE_PUBLISH = 0x10
+_MESSAGE_PUBREC = 0x20
+_MESSAGE_PUBREL = 0x40
+_MESSAGE_PACKET_ID = 0x80
+
+_SESSION_CLEAN = 0x01
+_SESSION_WILL = 0x02
+_SESSION_WILL_RETAIN = 0x04
+_SESSION_USERNAME = 0x08
+
+
+def _pack_string(out: bytearray, value: str):
+    data = value.encode('utf-8')
+    out.extend(_string_length.pack(len(data)))
+    out.extend(data)
+
+
+def _pack_data(out: bytearray, value: bytes):
+    out.extend(_data_length.pack(len(value)))
+    out.extend(value)
+
+
+def _unpack_string(buffer, offset):
+    length, = _string_length.unpack_from(buffer, offset)
+    offset += _string_length.size
+    return bytes(buffer[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def _unpack_data(buffer, offset):
+    length, = _data_length.unpack_from(buffer, offset)
+    offset += _data_length.size
+    return bytes(buffer[offset:offset + length]), offset + length
+
 
 class ApplicationMessage:
     """
         ApplicationMessage and subclasses are used to store published message information flow. These objects can contain different information depending on the way they were created (incoming or outgoing) and the quality of service used between peers.
     """
+    __slots__ = ('packet_id', 'topic', 'qos', 'data', 'retain', 'direction', 'publish_packet', 'puback_packet',
+                 'pubrec_packet', 'pubrel_packet', 'pubcomp_packet')
+
     def __init__(self, packet_id, topic, qos, data, retain):
         self.packet_id = packet_id
         """ Publish message `packet identifier <http://docs.oasis-open.org/mqtt/mqtt/v3.1.1/os/mqtt-v3.1.1-os.html#_Toc398718025>`_"""
@@ -56,6 +106,63 @@ class ApplicationMessage:
         """
         return PublishPacket.build(self.topic, self.data, self.packet_id, dup, self.qos, self.retain)
 
+    def to_bytes(self) -> bytes:
+        """
+            Encode message and its flow progress (PUBLISH, PUBREC and PUBREL exchanged or not) for persistence.
+            Other packets of the flow are not kept as they are not needed to resume it.
+
+        :return: encoded message
+        """
+        flags = (self.qos or 0) << 1
+        if getattr(self, 'direction', OUTGOING) == INCOMING:
+            flags |= _MESSAGE_INCOMING
+        if self.retain:
+            flags |= _MESSAGE_RETAIN
+        if self.publish_packet is not None:
+            flags |= _MESSAGE_PUBLISH
+        if self.pubrec_packet is not None:
+            flags |= _MESSAGE_PUBREC
+        if self.pubrel_packet is not None:
+            flags |= _MESSAGE_PUBREL
+        if self.packet_id is not None:
+            flags |= _MESSAGE_PACKET_ID
+        out = bytearray(_message_header.pack(flags, self.packet_id or 0))
+        _pack_string(out, self.topic)
+        _pack_data(out, bytes(self.data))
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, buffer, offset=0):
+        """
+            Decode a message encoded with :meth:`to_bytes`
+
+        :param buffer: encoded data
+        :param offset: position of the message in buffer
+        :return: (message, offset) tuple, where message is an :class:`IncomingApplicationMessage` or an
+            :class:`OutgoingApplicationMessage` and offset the position following the message in buffer
+        """
+        try:
+            flags, packet_id = _message_header.unpack_from(buffer, offset)
+            topic, offset = _unpack_string(buffer, offset + _message_header.size)
+            data, offset = _unpack_data(buffer, offset)
+        except Exception as e:
+            raise CodecException("Invalid encoded application message: %s" % e)
+        if not flags & _MESSAGE_PACKET_ID:
+            packet_id = None
+        qos = (flags & _MESSAGE_QOS) >> 1
+        retain = bool(flags & _MESSAGE_RETAIN)
+        if flags & _MESSAGE_INCOMING:
+            message = IncomingApplicationMessage(packet_id, topic, qos, data, retain)
+        else:
+            message = OutgoingApplicationMessage(packet_id, topic, qos, data, retain)
+        if flags & _MESSAGE_PUBLISH:
+            message.publish_packet = message.build_publish_packet()
+        if flags & _MESSAGE_PUBREC:
+            message.pubrec_packet = PubrecPacket.build(packet_id)
+        if flags & _MESSAGE_PUBREL:
+            message.pubrel_packet = PubrelPacket.build(packet_id)
+        return message, offset
+
     def __eq__(self, other):
         return self.packet_id == other.packet_id
 
@@ -64,6 +171,8 @@ class IncomingApplicationMessage(ApplicationMessage):
     """
         Incoming :class:`~hbmqtt.session.ApplicationMessage`.
     """
+    __slots__ = ()
+
     def __init__(self, packet_id, topic, qos, data, retain):
         super().__init__(packet_id, topic, qos, data, retain)
         self.direction = INCOMING
@@ -73,12 +182,42 @@ class OutgoingApplicationMessage(ApplicationMessage):
     """
         Outgoing :class:`~hbmqtt.session.ApplicationMessage`.
     """
+    __slots__ = ()
+
     def __init__(self, packet_id, topic, qos, data, retain):
         super().__init__(packet_id, topic, qos, data, retain)
         self.direction = OUTGOING
 
 
+class RetainedApplicationMessage:
+    """
+        Message retained by the broker on a topic, or queued for a disconnected session. Only what is needed to publish
+        it again is kept, no packet.
+    """
+    __slots__ = ('topic', 'data', 'qos', 'sequence')
+
+    def __init__(self, topic, data, qos=None):
+        self.topic = topic
+        self.data = data
+        self.qos = qos
+        # Key of a message queued for a session in the session store, set by persistence plugins
+        self.sequence = None
+
+
+class SessionStates(StateMachine):
+    states = ('new', 'connected', 'disconnected')
+    initial = 'new'
+    triggers = {
+        'connect': {'new': 'connected', 'disconnected': 'connected'},
+        'disconnect': {'connected': 'disconnected', 'new': 'disconnected', 'disconnected': 'disconnected'},
+    }
+
+
 class Session:
+    __slots__ = ('transitions', 'remote_address', 'remote_port', 'client_id', 'clean_session', 'will_flag',
+                 'will_message', 'will_qos', 'will_retain', 'will_topic', 'keep_alive', 'publish_retry_delay',
+                 'broker_uri', 'username', 'password', 'cafile', 'capath', 'cadata', 'peercert', '_packet_id', 'parent',
+                 '_loop', '_inflight_out', '_inflight_in', '_retained_messages', '_delivered_message_queue')
     states = ['new', 'connected', 'disconnected']
 
     def __init__(self, loop=None):
@@ -100,6 +239,8 @@ class Session:
         self.cafile = None
         self.capath = None
         self.cadata = None
+        # Certificate of a client connected through TLS, as returned by ssl.SSLSocket.getpeercert()
+        self.peercert = None
         self._packet_id = 0
         self.parent = 0
         if loop is not None:
@@ -107,32 +248,74 @@ class Session:
         else:
             self._loop = asyncio.get_event_loop()
 
-        # Used to store outgoing ApplicationMessage while publish protocol flows
-        self.inflight_out = OrderedDict()
+        # Message containers are created on first use: most sessions are idle and never need some of them
+        self._inflight_out = None
+        self._inflight_in = None
+        self._retained_messages = None
+        self._delivered_message_queue = None
 
-        # Used to store incoming ApplicationMessage while publish protocol flows
-        self.inflight_in = OrderedDict()
+    def _init_states(self):
+        self.transitions = SessionStates()
 
-        # Stores messages retained for this session
-        self.retained_messages = Queue(loop=self._loop)
+    @property
+    def inflight_out(self):
+        """
+        Outgoing ApplicationMessage stored while publish protocol flows
+        """
+        if self._inflight_out is None:
+            self._inflight_out = OrderedDict()
+        return self._inflight_out
 
-        # Stores PUBLISH messages ID received in order and ready for application process
-        self.delivered_message_queue = Queue(loop=self._loop)
+    @inflight_out.setter
+    def inflight_out(self, value):
+        self._inflight_out = value
 
-    def _init_states(self):
-        self.transitions = Machine(states=Session.states, initial='new')
-        self.transitions.add_transition(trigger='connect', source='new', dest='connected')
-        self.transitions.add_transition(trigger='connect', source='disconnected', dest='connected')
-        self.transitions.add_transition(trigger='disconnect', source='connected', dest='disconnected')
-        self.transitions.add_transition(trigger='disconnect', source='new', dest='disconnected')
-        self.transitions.add_transition(trigger='disconnect', source='disconnected', dest='disconnected')
+    @property
+    def inflight_in(self):
+        """
+        Incoming ApplicationMessage stored while publish protocol flows
+        """
+        if self._inflight_in is None:
+            self._inflight_in = OrderedDict()
+        return self._inflight_in
+
+    @inflight_in.setter
+    def inflight_in(self, value):
+        self._inflight_in = value
+
+    @property
+    def retained_messages(self):
+        """
+        Messages retained for this session while it is disconnected
+        """
+        if self._retained_messages is None:
+            self._retained_messages = Queue(loop=self._loop)
+        return self._retained_messages
+
+    @retained_messages.setter
+    def retained_messages(self, value):
+        self._retained_messages = value
+
+    @property
+    def delivered_message_queue(self):
+        """
+        PUBLISH messages received in order and ready for application process
+        """
+        if self._delivered_message_queue is None:
+            self._delivered_message_queue = Queue(loop=self._loop)
+        return self._delivered_message_queue
+
+    @delivered_message_queue.setter
+    def delivered_message_queue(self, value):
+        self._delivered_message_queue = value
 
     @property
     def next_packet_id(self):
         self._packet_id += 1
         if self._packet_id > 65535:
             self._packet_id = 1
-        while self._packet_id in self.inflight_in or self._packet_id in self.inflight_out:
+        while (self._inflight_in and self._packet_id in self._inflight_in) or \
+                (self._inflight_out and self._packet_id in self._inflight_out):
             self._packet_id += 1
             if self._packet_id > 65535:
                 raise HBMQTTException("More than 65525 messages pending. No free packet ID")
@@ -141,31 +324,104 @@ class Session:
 
     @property
     def inflight_in_count(self):
-        return len(self.inflight_in)
+        return len(self._inflight_in) if self._inflight_in is not None else 0
 
     @property
     def inflight_out_count(self):
-        return len(self.inflight_out)
+        return len(self._inflight_out) if self._inflight_out is not None else 0
 
     @property
     def retained_messages_count(self):
-        return self.retained_messages.qsize()
+        return self._retained_messages.qsize() if self._retained_messages is not None else 0
+
+    def to_bytes(self, subscriptions=None) -> bytes:
+        """
+        Encode persistent session state: client id, credentials, will and subscriptions.
+        In-flight messages are not included; they are encoded one by one with
+        :meth:`ApplicationMessage.to_bytes` so they can be stored separately.
+
+        :param subscriptions: list of (topic filter, qos) tuples subscribed by this session
+        :return: encoded session state, starting with :data:`SESSION_FORMAT_VERSION`
+        """
+        flags = 0
+        if self.clean_session:
+            flags |= _SESSION_CLEAN
+        if self.will_flag:
+            flags |= _SESSION_WILL
+        if self.will_retain:
+            flags |= _SESSION_WILL_RETAIN
+        if self.username is not None:
+            flags |= _SESSION_USERNAME
+        out = bytearray(_session_header.pack(SESSION_FORMAT_VERSION, flags, self.will_qos or 0,
+                                             self.keep_alive, self._packet_id))
+        _pack_string(out, self.client_id)
+        if self.username is not None:
+            _pack_string(out, self.username)
+        if self.will_flag:
+            _pack_string(out, self.will_topic)
+            _pack_data(out, bytes(self.will_message))
+        subscriptions = subscriptions or []
+        out.extend(_string_length.pack(len(subscriptions)))
+        for a_filter, qos in subscriptions:
+            _pack_string(out, a_filter)
+            out.append(qos)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, buffer, loop=None):
+        """
+        Decode session state encoded with :meth:`to_bytes`
+
+        :param buffer: encoded data
+        :param loop: asyncio loop of the created session
+        :return: (session, subscriptions) tuple
+        """
+        try:
+            version, flags, will_qos, keep_alive, packet_id = _session_header.unpack_from(buffer, 0)
+        except Exception as e:
+            raise CodecException("Invalid encoded session: %s" % e)
+        if version != SESSION_FORMAT_VERSION:
+            raise CodecException("Unsupported session format version %d" % version)
+        session = cls(loop)
+        try:
+            session.clean_session = bool(flags & _SESSION_CLEAN)
+            session.keep_alive = keep_alive
+            session._packet_id = packet_id
+            session.client_id, offset = _unpack_string(buffer, _session_header.size)
+            if flags & _SESSION_USERNAME:
+                session.username, offset = _unpack_string(buffer, offset)
+            if flags & _SESSION_WILL:
+                session.will_flag = True
+                session.will_retain = bool(flags & _SESSION_WILL_RETAIN)
+                session.will_qos = will_qos
+                session.will_topic, offset = _unpack_string(buffer, offset)
+                session.will_message, offset = _unpack_data(buffer, offset)
+            count, = _string_length.unpack_from(buffer, offset)
+            offset += _string_length.size
+            subscriptions = []
+            for i in range(count):
+                a_filter, offset = _unpack_string(buffer, offset)
+                subscriptions.append((a_filter, buffer[offset]))
+                offset += 1
+        except Exception as e:
+            raise CodecException("Invalid encoded session: %s" % e)
+        return session, subscriptions
 
     def __repr__(self):
         return type(self).__name__ + '(clientId={0}, state={1})'.format(self.client_id, self.transitions.state)
 
     def __getstate__(self):
-        state = self.__dict__.copy()
-        # Remove the unpicklable entries.
-        # del state['transitions']
-        del state['retained_messages']
-        del state['delivered_message_queue']
-        return state
-
-    def __setstate(self, state):
-        self.__dict__.update(state)
-        self.retained_messages = Queue()
-        self.delivered_message_queue = Queue()
+        # Queues and loop can't be pickled
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name not in ('_loop', '_retained_messages', '_delivered_message_queue'))
+
+    def __setstate__(self, state):
+        self.peercert = None
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._loop = asyncio.get_event_loop()
+        self._retained_messages = None
+        self._delivered_message_queue = None
 
     def __eq__(self, other):
         return self.client_id == other.client_id
\ No newline at end of file
@@ -0,0 +1,74 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Compact finite state machines.
+
+A state machine class declares its states and a table of triggers, shared by all instances. An instance only holds
+its current state name, so creating one costs a single small object. Each trigger becomes a method changing the
+state, and each state an ``is_<state>()`` method, as with the ``transitions`` package machines this replaces.
+"""
+from hbmqtt.errors import HBMQTTException
+
+
+class MachineError(HBMQTTException):
+    """
+    Raised when a trigger is called from a state it can't leave with
+    """
+    def __init__(self, value):
+        super().__init__(value)
+        self.value = value
+
+
+def _trigger(name, table):
+    def trigger(self):
+        try:
+            self.state = table[self.state]
+        except KeyError:
+            raise MachineError("Can't trigger event %s from state %s!" % (name, self.state))
+        return True
+    trigger.__name__ = name
+    return trigger
+
+
+def _is_state(state):
+    def is_state(self):
+        return self.state == state
+    is_state.__name__ = 'is_' + state
+    return is_state
+
+
+class _StateMachineMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        for state in namespace.get('states', ()):
+            namespace['is_' + state] = _is_state(state)
+        for trigger, table in namespace.get('triggers', dict()).items():
+            namespace[trigger] = _trigger(trigger, table)
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class StateMachine(metaclass=_StateMachineMeta):
+    """
+    Base class of state machines. Subclasses define:
+
+    * ``states``: state names
+    * ``initial``: initial state name
+    * ``triggers``: dict of trigger name => dict of source state => destination state
+    """
+    __slots__ = ('state',)
+    states = ()
+    initial = None
+    triggers = dict()
+
+    def __init__(self, initial=None):
+        self.state = initial if initial is not None else self.initial
+
+    def __getstate__(self):
+        return self.state
+
+    def __setstate__(self, state):
+        self.state = state
+
+    def __repr__(self):
+        return '%s(state=%s)' % (type(self).__name__, self.state)
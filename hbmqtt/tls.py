@@ -0,0 +1,266 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+TLS termination helpers.
+
+A TCP listener with ``ssl`` and ``ssl-offload`` set doesn't handle TLS in the broker process: ``ssl-offload`` helper
+processes listen on the listener address with ``SO_REUSEPORT``, so that the kernel spreads connections between them.
+Each helper runs its own event loop, does the TLS handshakes and relays the decrypted streams, both ways, over Unix
+domain socket connections to the broker.
+
+A relayed connection starts with a header made of its length (``!I``) and a JSON object holding the address of the
+client (``peername``) and its certificate, as returned by :meth:`ssl.SSLSocket.getpeercert` (``peercert``). The
+broker serves the rest of the connection as a plain TCP connection whose writer adapter returns this address and
+certificate, so that admission control and authentication plugins see the client and not the helper.
+
+Helpers stop when the broker closes the listener, or when the broker process exits.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import ssl
+import struct
+import sys
+import tempfile
+from functools import partial
+from hbmqtt.adapters import StreamReaderAdapter, StreamWriterAdapter
+from hbmqtt.errors import HBMQTTException
+
+_header_length = struct.Struct('!I')
+MAX_HEADER_LENGTH = 65536
+
+
+def server_context(listener):
+    """
+    Build the SSL context of a listener
+    :param listener: listener configuration, with ``certfile`` and ``keyfile`` and optionally ``cafile``, ``capath``
+    and ``cadata`` to verify client certificates
+    """
+    sc = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=listener.get('cafile', None),
+                                    capath=listener.get('capath', None), cadata=listener.get('cadata', None))
+    sc.load_cert_chain(listener['certfile'], listener['keyfile'])
+    sc.verify_mode = ssl.CERT_OPTIONAL
+    return sc
+
+
+def _tuples(value):
+    # JSON turns the tuples of getpeercert() results into lists
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    if isinstance(value, dict):
+        return dict((key, _tuples(item)) for key, item in value.items())
+    return value
+
+
+def encode_header(peername, peercert):
+    """
+    Encode the header of a relayed connection
+    :param peername: (address, port) of the client
+    :param peercert: certificate of the client, or None
+    """
+    data = json.dumps({'peername': list(peername[:2]), 'peercert': peercert}).encode('utf-8')
+    return _header_length.pack(len(data)) + data
+
+
+@asyncio.coroutine
+def read_header(reader):
+    """
+    Read the header of a relayed connection
+    :param reader: StreamReader of the connection
+    :return: ((address, port), peercert) tuple
+    """
+    length, = _header_length.unpack((yield from reader.readexactly(_header_length.size)))
+    if length > MAX_HEADER_LENGTH:
+        raise HBMQTTException("Invalid relayed connection header length: %d" % length)
+    try:
+        header = json.loads((yield from reader.readexactly(length)).decode('utf-8'))
+        return tuple(header['peername']), _tuples(header['peercert'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HBMQTTException("Invalid relayed connection header: %s" % e)
+
+
+class RelayWriterAdapter(StreamWriterAdapter):
+    """
+    Writer adapter of a connection relayed by a TLS helper, returning the address and certificate of the client
+    """
+    def __init__(self, writer, peername, peercert):
+        super().__init__(writer)
+        self._peername = peername
+        self._peercert = peercert
+
+    def get_peer_info(self):
+        return self._peername[0], self._peername[1]
+
+    def get_peer_cert(self):
+        return self._peercert
+
+
+@asyncio.coroutine
+def _pipe(reader, writer):
+    try:
+        while True:
+            data = yield from reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            yield from writer.drain()
+    except OSError:
+        pass
+    finally:
+        if writer.can_write_eof():
+            try:
+                writer.write_eof()
+            except OSError:
+                writer.close()
+        else:
+            writer.close()
+
+
+@asyncio.coroutine
+def _relay(reader, writer, path, loop):
+    try:
+        relay_reader, relay_writer = yield from asyncio.open_unix_connection(path, loop=loop)
+    except OSError:
+        writer.close()
+        return
+    relay_writer.write(encode_header(writer.get_extra_info('peername'), writer.get_extra_info('peercert')))
+    yield from asyncio.gather(_pipe(reader, relay_writer), _pipe(relay_reader, writer), loop=loop)
+    relay_writer.close()
+    writer.close()
+
+
+def run_helper(listener, address, port, path, conn):
+    """
+    Run a TLS helper process, until ``conn`` is closed by the broker
+    :param listener: listener configuration
+    :param address: address to listen on
+    :param port: port to listen on
+    :param path: path of the Unix domain socket of the broker
+    :param conn: multiprocessing Connection, on which the helper sends None once listening or an error message
+    """
+    # Interrupting the broker stops it, which stops its helpers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        server_kwargs = dict()
+        connect_timeout = listener.get('connect-timeout', 10)
+        if connect_timeout and sys.version_info >= (3, 7):
+            server_kwargs['ssl_handshake_timeout'] = float(connect_timeout)
+        server = loop.run_until_complete(asyncio.start_server(partial(_relay, path=path, loop=loop), address, port,
+                                                              ssl=server_context(listener), reuse_port=True,
+                                                              loop=loop, **server_kwargs))
+    except Exception as e:
+        conn.send(str(e))
+        loop.close()
+        return
+    conn.send(None)
+    loop.add_reader(conn.fileno(), loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.remove_reader(conn.fileno())
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+class TLSOffload:
+    """
+    TLS helper processes of a listener and the Unix domain socket server receiving their connections. Instances are the
+    server instances of listeners with ``ssl-offload`` set.
+
+    :param broker: :class:`~hbmqtt.broker.Broker` instance serving relayed connections
+    :param listener_name: name of the listener
+    :param listener: listener configuration
+    :param address: address to listen on
+    :param port: port to listen on
+    :param helpers: number of helper processes
+    :param loop: asyncio loop to use
+    """
+    def __init__(self, broker, listener_name, listener, address, port, helpers, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self._broker = broker
+        self._listener_name = listener_name
+        self._listener = listener
+        self._address = address
+        self._port = port
+        self._size = helpers
+        if loop is not None:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        connect_timeout = listener.get('connect-timeout', 10)
+        self._header_timeout = float(connect_timeout) if connect_timeout else None
+        # (process, connection) tuples
+        self._helpers = []
+        self._server = None
+        self._socket_dir = None
+
+    @asyncio.coroutine
+    def start(self):
+        self._socket_dir = tempfile.mkdtemp(prefix='hbmqtt-tls-')
+        path = os.path.join(self._socket_dir, 'relay.sock')
+        self._server = yield from asyncio.start_unix_server(self._relayed, path, loop=self._loop)
+        # Helpers are spawned rather than forked, as the broker may run threads
+        context = multiprocessing.get_context('spawn')
+        try:
+            for index in range(self._size):
+                conn, helper_conn = context.Pipe()
+                process = context.Process(target=run_helper, name='hbmqtt-tls-%s-%d' % (self._listener_name, index),
+                                          args=(self._listener, self._address, self._port, path, helper_conn),
+                                          daemon=True)
+                process.start()
+                helper_conn.close()
+                self._helpers.append((process, conn))
+            for process, conn in self._helpers:
+                try:
+                    error = yield from self._loop.run_in_executor(None, conn.recv)
+                except EOFError:
+                    error = "exit code %s" % process.exitcode
+                if error is not None:
+                    raise HBMQTTException("TLS helper %s failed to start: %s" % (process.name, error))
+        except Exception:
+            self.close()
+            yield from self.wait_closed()
+            raise
+        self.logger.debug("Listener '%s' TLS offloaded to %d helper processes" % (self._listener_name, self._size))
+
+    @asyncio.coroutine
+    def _relayed(self, reader, writer):
+        try:
+            peername, peercert = yield from asyncio.wait_for(read_header(reader), self._header_timeout,
+                                                             loop=self._loop)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, HBMQTTException) as e:
+            self.logger.warning("Invalid connection from TLS helper of listener '%s': %r" % (self._listener_name, e))
+            writer.close()
+            return
+        yield from self._broker.client_connected(self._listener_name, StreamReaderAdapter(reader),
+                                                 RelayWriterAdapter(writer, peername, peercert))
+
+    def close(self):
+        if self._server:
+            self._server.close()
+        # Helpers stop when their connection is closed
+        for process, conn in self._helpers:
+            conn.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        if self._server:
+            yield from self._server.wait_closed()
+            self._server = None
+        for process, conn in self._helpers:
+            yield from self._loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.terminate()
+                yield from self._loop.run_in_executor(None, process.join)
+        self._helpers = []
+        if self._socket_dir:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
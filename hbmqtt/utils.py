@@ -26,6 +26,33 @@ def format_client_message(session=None, address=None, port=None):
         return "(unknown client)"
 
 
+class lazy_attribute:
+    """
+    Instance attribute created on first access, for per connection structures most connections never use.
+    Once created, the value is stored in the instance dict and read from there without calling the descriptor.
+
+    :param name: attribute name
+    :param factory: function called with the instance to create the value
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.factory(instance)
+        return value
+
+    @staticmethod
+    def created(instance, name):
+        """
+        Get the value of a lazy attribute if it was already created
+        :return: attribute value or None
+        """
+        return instance.__dict__.get(name, None)
+
+
 def gen_client_id():
     """
     Generates random client ID
@@ -0,0 +1,271 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Write-ahead log of in-flight QoS 1 and QoS 2 messages.
+
+The log is made of fixed-size segment files mapped in memory, so appending a record is a memory copy. Segment files
+start with the ``HBMQWAL`` magic followed by a format version byte, then records made of a 11 bytes header
+(``!BHII``: record type, client id length, payload length, CRC32 of client id and payload) followed by the client id
+and payload. ``WAL_PUT`` records payload is an :class:`~hbmqtt.session.ApplicationMessage` encoded with
+:meth:`~hbmqtt.session.ApplicationMessage.to_bytes`. ``WAL_DELETE`` records payload is the direction and packet id
+(``!BH``) of a message which left the in-flight state. Reading a segment stops at the first zeroed or invalid record.
+
+Segments are deleted, oldest first, once they contain no more live messages. When more than ``max_segments``
+segments are used, live messages of the oldest segment are copied to the current one so that a message staying in
+flight for a long time doesn't prevent segments reuse.
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from hbmqtt.session import ApplicationMessage, INCOMING, OUTGOING
+from hbmqtt.errors import HBMQTTException
+
+WAL_MAGIC = b'HBMQWAL'
+WAL_VERSION = 1
+
+WAL_PUT = 1
+WAL_DELETE = 2
+
+_segment_header = WAL_MAGIC + bytes([WAL_VERSION])
+_record_header = struct.Struct('!BHII')
+_delete_payload = struct.Struct('!BH')
+_message_header = struct.Struct('!BH')
+
+
+class _Segment:
+    def __init__(self, path, number, size, create=False):
+        self.path = path
+        self.number = number
+        self.live = 0
+        self._file = open(path, 'w+b' if create else 'r+b')
+        if create:
+            self._file.truncate(size)
+        else:
+            size = os.fstat(self._file.fileno()).st_size
+        self.size = size
+        self.buffer = mmap.mmap(self._file.fileno(), size)
+        if create:
+            self.buffer[:len(_segment_header)] = _segment_header
+        self.offset = len(_segment_header)
+
+    def write(self, record):
+        end = self.offset + len(record)
+        self.buffer[self.offset:end] = record
+        offset = self.offset
+        self.offset = end
+        return offset
+
+    def records(self):
+        """
+        Read valid records from the segment start and set the write position after the last one
+        :return: generator of (offset, length, record type, client id, payload) tuples
+        """
+        if self.buffer[:len(_segment_header)] != _segment_header:
+            raise HBMQTTException("'%s' is not a WAL segment or has an unsupported version" % self.path)
+        offset = len(_segment_header)
+        while offset + _record_header.size <= self.size:
+            record_type, client_id_length, payload_length, crc = _record_header.unpack_from(self.buffer, offset)
+            start = offset + _record_header.size
+            end = start + client_id_length + payload_length
+            if record_type not in (WAL_PUT, WAL_DELETE) or end > self.size:
+                break
+            data = self.buffer[start:end]
+            if zlib.crc32(data) != crc:
+                break
+            yield offset, end - offset, record_type, data[:client_id_length].decode('utf-8'), data[client_id_length:]
+            offset = end
+        self.offset = offset
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.buffer.close()
+        self._file.close()
+
+
+def _encode_record(record_type, client_id, payload):
+    data = client_id.encode('utf-8') + payload
+    return _record_header.pack(record_type, len(data) - len(payload), len(payload), zlib.crc32(data)) + data
+
+
+class InflightLog:
+    """
+    Write-ahead log of in-flight messages.
+
+    Records reach the disk when :meth:`sync` is called, so several appends share the cost of a single ``msync``.
+
+    :param directory: directory holding segment files
+    :param segment_size: size of segment files, in bytes
+    :param max_segments: number of segments above which live messages of the oldest segment are relocated
+    """
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_segments=8):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._segments = []
+        # client_id -> {(direction, packet_id): (segment, offset, length)} of messages in flight
+        self._live = dict()
+        self._unsynced = set()
+        self._retired = []
+        self._relocating = False
+
+    def open(self):
+        """
+        Open the log, reading existing segments
+        :return: dict of client_id => list of in-flight :class:`~hbmqtt.session.ApplicationMessage`, in log order
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.wal'))
+        for name in names:
+            segment = _Segment(os.path.join(self.directory, name), int(name[:-4]), self.segment_size)
+            self._segments.append(segment)
+            for offset, length, record_type, client_id, payload in segment.records():
+                if record_type == WAL_PUT:
+                    flags, packet_id = _message_header.unpack_from(payload, 0)
+                    direction = INCOMING if flags & 0x01 else OUTGOING
+                    self._set_live(client_id, (direction, packet_id), (segment, offset, length))
+                else:
+                    self._drop_live(client_id, _delete_payload.unpack(payload))
+        if not self._segments:
+            self._new_segment()
+        self._retire()
+        recovered = dict()
+        count = 0
+        for client_id, messages in self._live.items():
+            recovered[client_id] = [self._read_message(location) for location in messages.values()]
+            count += len(messages)
+        self.logger.info("%d in-flight messages of %d sessions recovered from '%s'" %
+                         (count, len(recovered), self.directory))
+        return recovered
+
+    @staticmethod
+    def _read_message(location):
+        segment, offset, length = location
+        record_type, client_id_length, payload_length, crc = _record_header.unpack_from(segment.buffer, offset)
+        start = offset + _record_header.size + client_id_length
+        message, end = ApplicationMessage.from_bytes(segment.buffer[start:start + payload_length])
+        return message
+
+    def _new_segment(self, size=None):
+        number = self._segments[-1].number + 1 if self._segments else 0
+        path = os.path.join(self.directory, '%016d.wal' % number)
+        segment = _Segment(path, number, max(size or 0, self.segment_size), create=True)
+        self._segments.append(segment)
+        if len(self._segments) > self.max_segments and not self._relocating:
+            self._relocate(self._segments[0])
+        return segment
+
+    def _set_live(self, client_id, key, location):
+        messages = self._live.setdefault(client_id, OrderedDict())
+        previous = messages.pop(key, None)
+        if previous is not None:
+            previous[0].live -= 1
+        messages[key] = location
+        location[0].live += 1
+
+    def _drop_live(self, client_id, key):
+        messages = self._live.get(client_id, None)
+        if messages is None:
+            return None
+        location = messages.pop(key, None)
+        if location is not None:
+            location[0].live -= 1
+        if not messages:
+            del self._live[client_id]
+        return location
+
+    def _append(self, record):
+        segment = self._segments[-1]
+        if segment.offset + len(record) > segment.size:
+            segment = self._new_segment(len(_segment_header) + len(record))
+        offset = segment.write(record)
+        self._unsynced.add(segment)
+        return segment, offset, len(record)
+
+    def _relocate(self, segment):
+        """
+        Copy live messages of a segment to the current segment
+        """
+        self._relocating = True
+        try:
+            for client_id, messages in self._live.items():
+                for key, (source, offset, length) in list(messages.items()):
+                    if source is segment:
+                        record = segment.buffer[offset:offset + length]
+                        segment.live -= 1
+                        location = self._append(record)
+                        messages[key] = location
+                        location[0].live += 1
+        finally:
+            self._relocating = False
+
+    def _retire(self):
+        """
+        Retire oldest segments without live messages. Deleting segments in order ensures a delete record is never
+        removed while the record it cancels still exists.
+        """
+        while len(self._segments) > 1 and self._segments[0].live == 0:
+            self._retired.append(self._segments.pop(0))
+
+    def put(self, client_id, message):
+        """
+        Log a message entering in flight, or a change of its flow state
+        :param client_id: session client id
+        :param message: :class:`~hbmqtt.session.ApplicationMessage`
+        """
+        location = self._append(_encode_record(WAL_PUT, client_id, message.to_bytes()))
+        self._set_live(client_id, (message.direction, message.packet_id), location)
+        self._retire()
+
+    def delete(self, client_id, direction, packet_id):
+        """
+        Log a message leaving the in-flight state
+        """
+        if self._drop_live(client_id, (direction, packet_id)) is not None:
+            self._append(_encode_record(WAL_DELETE, client_id, _delete_payload.pack(direction, packet_id)))
+            self._retire()
+
+    def discard(self, client_id):
+        """
+        Log all in-flight messages of a session as deleted
+        """
+        for direction, packet_id in list(self._live.get(client_id, ())):
+            self.delete(client_id, direction, packet_id)
+
+    @asyncio.coroutine
+    def sync(self, loop=None):
+        """
+        Write appended records to disk and delete retired segments. Disk writes are done in an executor thread.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        segments, self._unsynced = self._unsynced, set()
+        retired, self._retired = self._retired, []
+        if segments or retired:
+            yield from loop.run_in_executor(None, self._sync, segments, retired)
+
+    @staticmethod
+    def _sync(segments, retired):
+        for segment in segments:
+            if segment not in retired:
+                segment.flush()
+        for segment in retired:
+            segment.close()
+            os.remove(segment.path)
+
+    def close(self):
+        self._sync(self._unsynced, self._retired)
+        self._unsynced = set()
+        self._retired = []
+        for segment in self._segments:
+            segment.flush()
+            segment.close()
+        self._segments = []
+        self._live = dict()
@@ -7,21 +7,30 @@ HBMQTT - MQTT 3.1.1 broker
 Usage:
     hbmqtt --version
     hbmqtt (-h | --help)
-    hbmqtt [-c <config_file> ] [-d]
+    hbmqtt [-c <config_file> ] [-d] [--workers <n>] [--profile <profile_file>] [--profile-duration <seconds>] [--profile-frequency <hz>]
 
 Options:
-    -h --help           Show this screen.
-    --version           Show version.
-    -c <config_file>    Broker configuration file (YAML format)
-    -d                  Enable debug messages
+    -h --help                       Show this screen.
+    --version                       Show version.
+    -c <config_file>                Broker configuration file (YAML format)
+    -d                              Enable debug messages
+    --workers <n>                   Number of broker processes sharing the listeners [default: 1]
+    --profile <profile_file>        Sample broker stacks and write them as collapsed stacks for flamegraphs
+    --profile-duration <seconds>    Profiling duration. Default: until broker stops
+    --profile-frequency <hz>        Profiling samples per second [default: 100]
 """
 
 import sys
 import logging
 import asyncio
 import os
+import signal
+import shutil
+import tempfile
 from hbmqtt.broker import Broker
+from hbmqtt.cluster import worker_config
 from hbmqtt.version import get_version
+from hbmqtt.profiler import SamplingProfiler
 from docopt import docopt
 from hbmqtt.utils import read_yaml_config
 
@@ -66,14 +75,71 @@ def main(*args, **kwargs):
     else:
         config = read_yaml_config(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'default_broker.yaml'))
         logger.debug("Using default configuration")
+    workers = int(arguments['--workers'])
+    if workers > 1:
+        run_workers(config, workers, arguments)
+    else:
+        run_broker(config, arguments, arguments['--profile'])
+
+
+def run_workers(config, workers, arguments):
+    """
+    Run a broker in each of a number of worker processes, and wait until they all end. Workers don't get terminal
+    signals directly: the main process stops them when it is interrupted or terminated.
+    """
+    socket_dir = tempfile.mkdtemp(prefix='hbmqtt-')
+    pids = []
+
+    def stop_workers(signum, frame):
+        for worker_pid in pids:
+            try:
+                os.kill(worker_pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, stop_workers)
+    try:
+        for index in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                for signum in (signal.SIGTERM, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                status = 1
+                try:
+                    profile_file = arguments['--profile']
+                    run_broker(worker_config(config, index, workers, socket_dir), arguments,
+                               '%s.%d' % (profile_file, index) if profile_file else None)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def run_broker(config, arguments, profile_file):
     loop = asyncio.get_event_loop()
     broker = Broker(config)
+    profiler = None
+    if profile_file:
+        duration = arguments['--profile-duration']
+        profiler = SamplingProfiler(profile_file,
+                                    frequency=int(arguments['--profile-frequency']),
+                                    duration=float(duration) if duration else None)
     try:
         loop.run_until_complete(broker.start())
+        if profiler:
+            profiler.start()
         loop.run_forever()
     except KeyboardInterrupt:
         loop.run_until_complete(broker.shutdown())
     finally:
+        if profiler:
+            profiler.stop()
         loop.close()
 
 
@@ -0,0 +1,252 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+hbmqtt_replay - Replay captured MQTT traffic against a broker
+
+Usage:
+    hbmqtt_replay --version
+    hbmqtt_replay (-h | --help)
+    hbmqtt_replay CAPTURE_FILE [--host HOST] [--port PORT] [--speed SPEED | --max-speed] [--timeout TIMEOUT] [-d]
+
+Options:
+    -h --help           Show this screen.
+    --version           Show version.
+    --host HOST         Broker host [default: 127.0.0.1]
+    --port PORT         Broker port [default: 1883]
+    --speed SPEED       Replay speed factor, 2 replays twice faster than captured [default: 1]
+    --max-speed         Send packets as fast as possible, only keeping per-connection ordering
+    --timeout TIMEOUT   Seconds to wait for pending acknowledgments after the last packet of a connection [default: 5]
+    -d                  Enable debug messages
+"""
+
+import sys
+import logging
+import asyncio
+import struct
+from collections import deque, OrderedDict
+from hbmqtt.capture import read_capture, CAPTURE_IN
+from hbmqtt.mqtt.packet import CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, \
+    UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP
+from hbmqtt.mqtt.puback import PubackPacket
+from hbmqtt.mqtt.pubrec import PubrecPacket
+from hbmqtt.mqtt.pubcomp import PubcompPacket
+from hbmqtt.version import get_version
+from docopt import docopt
+
+logger = logging.getLogger(__name__)
+
+# Packets sent by a client to acknowledge broker messages: their packet ids only make sense for the captured broker,
+# so they are not replayed and the replayer acknowledges messages itself
+_ACKNOWLEDGMENTS = (PUBACK, PUBREC, PUBCOMP)
+
+
+def _packet_body(data):
+    """
+    Skip fixed header
+    """
+    index = 1
+    while data[index] & 0x80:
+        index += 1
+    return data[index + 1:]
+
+
+def _packet_id(body):
+    return struct.unpack('!H', body[:2])[0]
+
+
+def _publish_packet_id(data):
+    body = _packet_body(data)
+    topic_length = struct.unpack('!H', body[:2])[0]
+    return _packet_id(body[2 + topic_length:])
+
+
+def _expected_response(data):
+    """
+    Get the key identifying the broker response expected for a client packet, used to measure latency
+    """
+    packet_type = data[0] >> 4
+    if packet_type == CONNECT:
+        return CONNACK, None
+    if packet_type == PINGREQ:
+        return PINGRESP, None
+    if packet_type == PUBLISH:
+        qos = (data[0] >> 1) & 0x03
+        if qos == 1:
+            return PUBACK, _publish_packet_id(data)
+        if qos == 2:
+            return PUBREC, _publish_packet_id(data)
+        return None
+    if packet_type in (SUBSCRIBE, UNSUBSCRIBE, PUBREL):
+        response = {SUBSCRIBE: SUBACK, UNSUBSCRIBE: UNSUBACK, PUBREL: PUBCOMP}[packet_type]
+        return response, _packet_id(_packet_body(data))
+    return None
+
+
+def load_capture(path):
+    """
+    Load client to broker packets from a capture file
+    :return: (connections, start) where connections maps connection number to a list of (timestamp, data, response)
+    """
+    connections = OrderedDict()
+    start = None
+    for record in read_capture(path):
+        if start is None:
+            start = record.timestamp
+        if record.direction != CAPTURE_IN:
+            continue
+        if record.data[0] >> 4 in _ACKNOWLEDGMENTS:
+            continue
+        packets = connections.setdefault(record.connection, [])
+        packets.append((record.timestamp, record.data, _expected_response(record.data)))
+    return connections, start
+
+
+class ReplayStats:
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.messages_received = 0
+        self.latencies = []
+        self.errors = 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+
+
+@asyncio.coroutine
+def _read_responses(reader, writer, pending, stats, loop):
+    while True:
+        header = yield from reader.read(1)
+        if not header:
+            break
+        length_bytes = bytearray()
+        multiplier = 1
+        remaining_length = 0
+        while True:
+            encoded_byte = (yield from reader.readexactly(1))[0]
+            length_bytes.append(encoded_byte)
+            remaining_length += (encoded_byte & 0x7f) * multiplier
+            if (encoded_byte & 0x80) == 0:
+                break
+            multiplier *= 128
+        body = yield from reader.readexactly(remaining_length)
+        stats.packets_received += 1
+        packet_type = header[0] >> 4
+        if packet_type == PUBLISH:
+            stats.messages_received += 1
+            qos = (header[0] >> 1) & 0x03
+            if qos:
+                topic_length = struct.unpack('!H', body[:2])[0]
+                packet_id = _packet_id(body[2 + topic_length:])
+                if qos == 1:
+                    writer.write(PubackPacket.build(packet_id).to_bytes())
+                else:
+                    writer.write(PubrecPacket.build(packet_id).to_bytes())
+            continue
+        if packet_type == PUBREL:
+            writer.write(PubcompPacket.build(_packet_id(body)).to_bytes())
+            continue
+        if packet_type in (CONNACK, PINGRESP):
+            key = (packet_type, None)
+        else:
+            key = (packet_type, _packet_id(body))
+        waiters = pending.get(key, None)
+        if waiters:
+            stats.latencies.append(loop.time() - waiters.popleft())
+            if not waiters:
+                del pending[key]
+
+
+@asyncio.coroutine
+def replay_connection(packets, start, origin, speed, args, stats, loop):
+    """
+    Replay packets of one captured connection, in order
+    """
+    pending = dict()
+    if speed:
+        delay = origin + (packets[0][0] - start) / speed - loop.time()
+        if delay > 0:
+            yield from asyncio.sleep(delay, loop=loop)
+    try:
+        reader, writer = yield from asyncio.open_connection(args['--host'], int(args['--port']), loop=loop)
+    except OSError as e:
+        logger.warning("Connection failed: %s" % e)
+        stats.errors += 1
+        return
+    reader_task = asyncio.Task(_read_responses(reader, writer, pending, stats, loop), loop=loop)
+    try:
+        for timestamp, data, response in packets:
+            if speed:
+                delay = origin + (timestamp - start) / speed - loop.time()
+                if delay > 0:
+                    yield from asyncio.sleep(delay, loop=loop)
+            if response is not None:
+                pending.setdefault(response, deque()).append(loop.time())
+            writer.write(data)
+            stats.packets_sent += 1
+            stats.bytes_sent += len(data)
+            yield from writer.drain()
+        timeout = loop.time() + float(args['--timeout'])
+        while pending and not reader_task.done() and loop.time() < timeout:
+            yield from asyncio.sleep(0.01, loop=loop)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        logger.debug("Connection lost: %s" % e)
+        stats.errors += 1
+    finally:
+        reader_task.cancel()
+        writer.close()
+
+
+@asyncio.coroutine
+def do_replay(args, loop):
+    connections, start = load_capture(args['CAPTURE_FILE'])
+    if args['--max-speed']:
+        speed = None
+    else:
+        speed = float(args['--speed'])
+    logger.info("Replaying %d connections from '%s'" % (len(connections), args['CAPTURE_FILE']))
+    stats = ReplayStats()
+    begin = loop.time()
+    tasks = [asyncio.Task(replay_connection(packets, start, begin, speed, args, stats, loop), loop=loop)
+             for packets in connections.values()]
+    if tasks:
+        yield from asyncio.wait(tasks, loop=loop)
+    elapsed = loop.time() - begin
+    return stats, elapsed
+
+
+def main(*args, **kwargs):
+    if sys.version_info[:2] < (3, 4):
+        logger.fatal("Error: Python 3.4+ is required")
+        sys.exit(-1)
+
+    arguments = docopt(__doc__, version=get_version())
+    formatter = "[%(asctime)s] :: %(levelname)s - %(message)s"
+
+    if arguments['-d']:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logging.basicConfig(level=level, format=formatter)
+
+    loop = asyncio.get_event_loop()
+    stats, elapsed = loop.run_until_complete(do_replay(arguments, loop))
+    loop.close()
+
+    print("Elapsed:           %.3f s" % elapsed)
+    print("Packets sent:      %d (%d bytes)" % (stats.packets_sent, stats.bytes_sent))
+    print("Throughput:        %.1f packets/s" % (stats.packets_sent / elapsed if elapsed else 0))
+    print("Packets received:  %d (%d PUBLISH)" % (stats.packets_received, stats.messages_received))
+    print("Acknowledged:      %d" % len(stats.latencies))
+    print("Latency (ms):      p50=%.3f p90=%.3f p99=%.3f max=%.3f" %
+          tuple(stats.percentile(p) * 1000 for p in (50, 90, 99, 100)))
+    print("Errors:            %d" % stats.errors)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,6 @@ setup(
     include_package_data=True,
     platforms='all',
     install_requires=[
-        'transitions==0.2.5',
         'websockets',
         'passlib',
         'docopt',
@@ -48,6 +47,10 @@ setup(
             'auth_anonymous = hbmqtt.plugins.authentication:AnonymousAuthPlugin',
             'auth_file = hbmqtt.plugins.authentication:FileAuthPlugin',
             'broker_sys = hbmqtt.plugins.sys.broker:BrokerSysPlugin',
+            'broker_sys_top = hbmqtt.plugins.sys.top:BrokerTopPlugin',
+            'broker_sys_loop = hbmqtt.plugins.sys.loop:BrokerLoopMonitorPlugin',
+            'persistence = hbmqtt.plugins.persistence:SQLitePlugin',
+            'topic_acl = hbmqtt.plugins.acl:TopicACLPlugin',
         ],
         'hbmqtt.client.plugins': [
             'packet_logger_plugin = hbmqtt.plugins.logging:PacketLoggerPlugin',
@@ -56,6 +59,7 @@ setup(
             'hbmqtt = scripts.broker_script:main',
             'hbmqtt_pub = scripts.pub_script:main',
             'hbmqtt_sub = scripts.sub_script:main',
+            'hbmqtt_replay = scripts.replay_script:main',
         ]
     }
 )
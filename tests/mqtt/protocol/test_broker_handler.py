@@ -0,0 +1,78 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+from hbmqtt.plugins.manager import PluginManager
+from hbmqtt.session import Session, IncomingApplicationMessage
+from hbmqtt.mqtt.protocol.broker_handler import BrokerProtocolHandler, \
+    INBOX_SUBSCRIBE, INBOX_UNSUBSCRIBE, INBOX_MESSAGE, INBOX_DISCONNECT
+from hbmqtt.mqtt.subscribe import SubscribePacket, SubscribePayload
+from hbmqtt.mqtt.unsubscribe import UnsubscribePacket, UnubscribePayload
+from hbmqtt.mqtt.packet import PacketIdVariableHeader
+from hbmqtt.mqtt.disconnect import DisconnectPacket
+
+
+class BrokerProtocolHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.plugin_manager = PluginManager("hbmqtt.test.plugins", context=None, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_inbox_order(self):
+        @asyncio.coroutine
+        def test_coro():
+            session = Session(self.loop)
+            session.client_id = 'client'
+            handler = BrokerProtocolHandler(self.plugin_manager, session, loop=self.loop)
+            waiter = asyncio.ensure_future(handler.next_event(), loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertFalse(waiter.done())
+
+            message = IncomingApplicationMessage(None, 'a/b', 0, b'data', False)
+            yield from handler.handle_subscribe(
+                SubscribePacket(variable_header=PacketIdVariableHeader(1), payload=SubscribePayload([('a/#', 1)])))
+            handler._deliver_message(message)
+            yield from handler.handle_unsubscribe(
+                UnsubscribePacket(variable_header=PacketIdVariableHeader(2), payload=UnubscribePayload(['a/#'])))
+            disconnect = DisconnectPacket()
+            yield from handler.handle_disconnect(disconnect)
+            # Only the first disconnection is queued
+            handler.handle_read_timeout()
+
+            kind, data = yield from waiter
+            self.assertEqual(kind, INBOX_SUBSCRIBE)
+            self.assertEqual(data, {'packet_id': 1, 'topics': [('a/#', 1)]})
+            self.assertEqual((yield from handler.next_event()), (INBOX_MESSAGE, message))
+            self.assertEqual((yield from handler.next_event()), (INBOX_UNSUBSCRIBE, {'packet_id': 2, 'topics': ['a/#']}))
+            self.assertEqual((yield from handler.next_event()), (INBOX_DISCONNECT, disconnect))
+            self.assertFalse(handler._inbox)
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_router(self):
+        @asyncio.coroutine
+        def test_coro():
+            session = Session(self.loop)
+            session.client_id = 'client'
+            handler = BrokerProtocolHandler(self.plugin_manager, session, loop=self.loop)
+            routed = []
+            handler.router = lambda s, m: routed.append(m) or True
+            first = IncomingApplicationMessage(1, 'a/b', 1, b'data', False)
+            second = IncomingApplicationMessage(2, 'a/b', 1, b'data', False)
+            qos2 = IncomingApplicationMessage(3, 'a/b', 2, b'data', False)
+            # Broker isn't waiting for events yet
+            handler._deliver_message(first)
+            self.assertEqual(routed, [])
+            self.assertEqual((yield from handler.next_event()), (INBOX_MESSAGE, first))
+            waiter = asyncio.ensure_future(handler.next_event(), loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            handler._deliver_message(second)
+            handler._deliver_message(qos2)
+            self.assertEqual(routed, [second])
+            self.assertEqual((yield from waiter), (INBOX_MESSAGE, qos2))
+
+        self.loop.run_until_complete(test_coro())
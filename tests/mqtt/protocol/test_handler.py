@@ -8,7 +8,7 @@ import random
 from hbmqtt.plugins.manager import PluginManager
 from hbmqtt.session import Session, OutgoingApplicationMessage, IncomingApplicationMessage
 from hbmqtt.mqtt.protocol.handler import ProtocolHandler
-from hbmqtt.adapters import StreamWriterAdapter, StreamReaderAdapter
+from hbmqtt.adapters import StreamWriterAdapter, StreamReaderAdapter, BufferReader, BufferWriter
 from hbmqtt.mqtt.constants import *
 from hbmqtt.mqtt.publish import PublishPacket
 from hbmqtt.mqtt.puback import PubackPacket
@@ -114,6 +114,29 @@ class ProtocolHandlerTest(unittest.TestCase):
         if future.exception():
             raise future.exception()
 
+    def test_publish_group_qos0(self):
+        class CountingWriter(BufferWriter):
+            writes = 0
+
+            def write(self, data):
+                self.writes += 1
+                super().write(data)
+
+        @asyncio.coroutine
+        def test_coro():
+            s = Session()
+            writer = CountingWriter()
+            handler = ProtocolHandler(self.plugin_manager, loop=self.loop)
+            handler.attach(s, BufferReader(b''), writer)
+            yield from handler.mqtt_publish_group([('a', b'1', QOS_0), ('b', b'2', QOS_0), ('a', b'3', QOS_0)])
+            self.assertEqual(writer.writes, 1)
+            reader = BufferReader(writer.get_buffer())
+            for topic, data in (('a', b'1'), ('b', b'2'), ('a', b'3')):
+                packet = yield from PublishPacket.from_stream(reader)
+                self.assertEqual((packet.topic_name, packet.data, packet.qos), (topic, data, QOS_0))
+
+        self.loop.run_until_complete(test_coro())
+
     def test_publish_qos1(self):
         @asyncio.coroutine
         def server_mock(reader, writer):
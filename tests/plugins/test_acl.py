@@ -0,0 +1,108 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+
+import unittest
+import logging
+import os
+import asyncio
+from hbmqtt.plugins.manager import BaseContext
+from hbmqtt.plugins.acl import TopicACLPlugin, TopicTrie, ACTION_SUBSCRIBE, ACTION_PUBLISH, _READ, _WRITE
+from hbmqtt.session import Session
+
+formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=formatter)
+
+
+class TestTopicTrie(unittest.TestCase):
+    def test_covered(self):
+        trie = TopicTrie()
+        trie.add('a/#', _READ)
+        trie.add('b/+/c', _READ)
+        self.assertTrue(trie.allowed('a', _READ))
+        self.assertTrue(trie.allowed('a/b/c', _READ))
+        self.assertTrue(trie.allowed('a/+/#', _READ))
+        self.assertFalse(trie.allowed('a/b', _WRITE))
+        self.assertTrue(trie.allowed('b/x/c', _READ))
+        self.assertTrue(trie.allowed('b/+/c', _READ))
+        self.assertFalse(trie.allowed('b/#', _READ))
+        self.assertFalse(trie.allowed('b/x/d', _READ))
+        self.assertFalse(trie.allowed('#', _READ))
+
+    def test_denied(self):
+        trie = TopicTrie()
+        trie.add('a/#', _READ | _WRITE)
+        trie.add('a/secret/#', _READ | _WRITE, deny=True)
+        self.assertTrue(trie.allowed('a/public', _READ))
+        self.assertFalse(trie.allowed('a/secret', _READ))
+        self.assertFalse(trie.allowed('a/secret/x', _WRITE))
+        # Filters overlapping a denied topic are denied
+        self.assertFalse(trie.allowed('a/+', _READ))
+        self.assertFalse(trie.allowed('a/#', _READ))
+        self.assertFalse(trie.allowed('a/+/public', _READ))
+        self.assertTrue(trie.allowed('a/public/+', _READ))
+
+
+class TestTopicACLPlugin(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _create_plugin(self, **topic_config):
+        context = BaseContext()
+        context.logger = logging.getLogger(__name__)
+        context.config = {
+            'topic-check': dict(topic_config)
+        }
+        context.config['topic-check']['acl-file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)), "acl")
+        return TopicACLPlugin(context)
+
+    def _check(self, plugin, session, topic, action):
+        return self.loop.run_until_complete(plugin.topic_filtering(session=session, topic=topic, action=action))
+
+    def _session(self, client_id, username=None):
+        s = Session(self.loop)
+        s.client_id = client_id
+        s.username = username
+        return s
+
+    def test_user_rules(self):
+        plugin = self._create_plugin()
+        alice = self._session('c1', 'alice')
+        self.assertTrue(self._check(plugin, alice, 'alice/data', ACTION_PUBLISH))
+        self.assertFalse(self._check(plugin, alice, 'alice/secret', ACTION_SUBSCRIBE))
+        self.assertTrue(self._check(plugin, alice, 'shared/x/in', ACTION_PUBLISH))
+        self.assertFalse(self._check(plugin, alice, 'shared/x/in', ACTION_SUBSCRIBE))
+        self.assertFalse(self._check(plugin, alice, 'public/news', ACTION_SUBSCRIBE))
+
+    def test_anonymous_rules(self):
+        plugin = self._create_plugin()
+        anonymous = self._session('c2')
+        self.assertTrue(self._check(plugin, anonymous, 'public/news', ACTION_SUBSCRIBE))
+        self.assertFalse(self._check(plugin, anonymous, 'public/news', ACTION_PUBLISH))
+
+    def test_patterns(self):
+        plugin = self._create_plugin()
+        bob = self._session('device-1', 'bob')
+        self.assertTrue(self._check(plugin, bob, 'devices/device-1/state', ACTION_PUBLISH))
+        self.assertFalse(self._check(plugin, bob, 'devices/device-2/state', ACTION_PUBLISH))
+        self.assertTrue(self._check(plugin, bob, 'users/bob/inbox', ACTION_SUBSCRIBE))
+        # Wildcards in substituted values don't widen rules
+        joker = self._session('+', 'joker')
+        self.assertFalse(self._check(plugin, joker, 'devices/+/state', ACTION_SUBSCRIBE))
+
+    def test_decision_cache(self):
+        plugin = self._create_plugin(**{'cache-size': 2})
+        alice = self._session('c1', 'alice')
+        self._check(plugin, alice, 'alice/a', ACTION_PUBLISH)
+        self._check(plugin, alice, 'alice/b', ACTION_PUBLISH)
+        self.assertEqual(len(plugin._sessions['c1'][2]), 2)
+        self._check(plugin, alice, 'alice/c', ACTION_PUBLISH)
+        self.assertEqual(len(plugin._sessions['c1'][2]), 1)
+        # Rules are compiled again if the session username changes
+        alice.username = 'bob'
+        self.assertFalse(self._check(plugin, alice, 'alice/c', ACTION_PUBLISH))
+        self.loop.run_until_complete(plugin.on_broker_client_disconnected(client_id='c1'))
+        self.assertNotIn('c1', plugin._sessions)
@@ -6,6 +6,9 @@ import unittest
 import logging
 import os
 import asyncio
+import time
+from unittest.mock import patch
+from passlib.apps import custom_app_context as pwd_context
 from hbmqtt.plugins.manager import BaseContext
 from hbmqtt.plugins.authentication import AnonymousAuthPlugin, FileAuthPlugin
 from hbmqtt.session import Session
@@ -109,3 +112,76 @@ class TestFileAuthPlugin(unittest.TestCase):
         auth_plugin = FileAuthPlugin(context)
         ret = self.loop.run_until_complete(auth_plugin.authenticate(session=s))
         self.assertFalse(ret)
+
+    def _create_plugin(self, **auth_config):
+        context = BaseContext()
+        context.logger = logging.getLogger(__name__)
+        context.config = {
+            'auth': dict(auth_config)
+        }
+        context.config['auth']['password-file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)), "passwd")
+        return FileAuthPlugin(context)
+
+    def _session(self, password):
+        s = Session()
+        s.username = "user"
+        s.password = password
+        return s
+
+    def test_verification_cached(self):
+        auth_plugin = self._create_plugin()
+        with patch('hbmqtt.plugins.authentication.pwd_context.verify', wraps=pwd_context.verify) as verify:
+            for password in ("test", "test", "wrong password", "wrong password"):
+                ret = self.loop.run_until_complete(auth_plugin.authenticate(session=self._session(password)))
+                self.assertEqual(ret, password == "test")
+            # Failed verifications are not cached
+            self.assertEqual(verify.call_count, 3)
+        self.assertEqual(len(auth_plugin._cache), 1)
+        self.loop.run_until_complete(auth_plugin.on_broker_post_shutdown())
+
+    def test_cache_limits(self):
+        auth_plugin = self._create_plugin(**{'cache-ttl': 0.05, 'cache-size': 1})
+        auth_plugin._users['other'] = auth_plugin._users['user']
+        with patch('hbmqtt.plugins.authentication.pwd_context.verify', wraps=pwd_context.verify) as verify:
+            s = self._session("test")
+            self.assertTrue(self.loop.run_until_complete(auth_plugin.authenticate(session=s)))
+            s.username = "other"
+            self.assertTrue(self.loop.run_until_complete(auth_plugin.authenticate(session=s)))
+            self.assertEqual(len(auth_plugin._cache), 1)
+            self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+            self.assertTrue(self.loop.run_until_complete(auth_plugin.authenticate(session=s)))
+            self.assertEqual(verify.call_count, 3)
+        self.loop.run_until_complete(auth_plugin.on_broker_post_shutdown())
+
+    def test_concurrent_verifications_shared(self):
+        auth_plugin = self._create_plugin()
+        with patch('hbmqtt.plugins.authentication.pwd_context.verify', wraps=pwd_context.verify) as verify:
+            tasks = [auth_plugin.authenticate(session=self._session("test")) for i in range(10)]
+            results = self.loop.run_until_complete(asyncio.gather(*tasks, loop=self.loop))
+            self.assertEqual(results, [True] * 10)
+            self.assertEqual(verify.call_count, 1)
+        self.loop.run_until_complete(auth_plugin.on_broker_post_shutdown())
+
+    def test_concurrent_verification_cancelled(self):
+        auth_plugin = self._create_plugin()
+        verify_password = pwd_context.verify
+
+        def slow_verify(password, hash):
+            time.sleep(0.1)
+            return verify_password(password, hash)
+
+        @asyncio.coroutine
+        def test_coro():
+            tasks = [asyncio.Task(auth_plugin.authenticate(session=self._session("test")), loop=self.loop)
+                     for i in range(3)]
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            # First connection times out while the verification is running
+            tasks[0].cancel()
+            return (yield from asyncio.gather(*tasks[1:], loop=self.loop))
+
+        with patch('hbmqtt.plugins.authentication.pwd_context.verify', side_effect=slow_verify) as verify:
+            self.assertEqual(self.loop.run_until_complete(test_coro()), [True, True])
+            self.assertEqual(verify.call_count, 1)
+        self.assertEqual(len(auth_plugin._cache), 1)
+        self.assertEqual(auth_plugin._verifying, {})
+        self.loop.run_until_complete(auth_plugin.on_broker_post_shutdown())
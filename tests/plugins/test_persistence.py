@@ -9,7 +9,7 @@ import asyncio
 import sqlite3
 from hbmqtt.plugins.manager import BaseContext
 from hbmqtt.plugins.persistence import SQLitePlugin
-from hbmqtt.session import Session
+from hbmqtt.session import Session, OutgoingApplicationMessage, RetainedApplicationMessage
 
 formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=formatter)
@@ -18,6 +18,22 @@ logging.basicConfig(level=logging.DEBUG, format=formatter)
 class TestSQLitePlugin(unittest.TestCase):
     def setUp(self):
         self.loop = asyncio.new_event_loop()
+        self.dbfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test.db")
+
+    def tearDown(self):
+        self.loop.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.dbfile + suffix):
+                os.remove(self.dbfile + suffix)
+
+    def _create_plugin(self, **persistence_config):
+        context = BaseContext()
+        context.logger = logging.getLogger(__name__)
+        context.loop = self.loop
+        context.config = {
+            'persistence': dict(file=self.dbfile, **persistence_config)
+        }
+        return SQLitePlugin(context)
 
     def test_create_tables(self):
         dbfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test.db")
@@ -38,6 +54,142 @@ class TestSQLitePlugin(unittest.TestCase):
             tables.append(row[0])
         self.assertIn("session", tables)
 
+    def test_wal_mode(self):
+        sql_plugin = self._create_plugin()
+        conn = sqlite3.connect(self.dbfile)
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+        self.loop.run_until_complete(sql_plugin.on_broker_post_shutdown())
+
+    def _session(self, client_id):
+        s = Session(self.loop)
+        s.client_id = client_id
+        return s
+
+    def test_save_find_del_session(self):
+        sql_plugin = self._create_plugin()
+
+        @asyncio.coroutine
+        def test_coro():
+            s = self._session('test_save_session')
+            message = OutgoingApplicationMessage(1, 'a/b', 1, b'data', False)
+            s.inflight_out[1] = message
+            yield from sql_plugin.save_session(s, [('a/#', 1)])
+            sql_plugin._saved.clear()
+            found, subscriptions = yield from sql_plugin.find_session('test_save_session')
+            self.assertEqual(found.client_id, 'test_save_session')
+            self.assertEqual(subscriptions, [('a/#', 1)])
+            self.assertEqual(found.inflight_out[1].data, b'data')
+            yield from sql_plugin.del_session('test_save_session')
+            found = yield from sql_plugin.find_session('test_save_session')
+            self.assertIsNone(found)
+            yield from sql_plugin.on_broker_post_shutdown()
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_save_session_delta(self):
+        sql_plugin = self._create_plugin()
+        submitted = []
+
+        @asyncio.coroutine
+        def test_coro():
+            s = self._session('test_delta')
+            for packet_id in (1, 2):
+                s.inflight_out[packet_id] = OutgoingApplicationMessage(packet_id, 'a/b', 1, b'data', False)
+            yield from sql_plugin.save_session(s)
+            submit = sql_plugin._worker.submit
+
+            def record_submit(operation, *args, **kwargs):
+                submitted.append(args)
+                return submit(operation, *args, **kwargs)
+            sql_plugin._worker.submit = record_submit
+            # Nothing changed: nothing written
+            yield from sql_plugin.save_session(s)
+            self.assertEqual(submitted, [])
+            # One message acknowledged: only this message is deleted
+            del s.inflight_out[1]
+            yield from sql_plugin.save_session(s)
+            self.assertEqual(submitted, [('test_delta', None, [], [(0, 1)], False)])
+            yield from sql_plugin.on_broker_post_shutdown()
+
+        self.loop.run_until_complete(test_coro())
+        conn = sqlite3.connect(self.dbfile)
+        rows = conn.execute("SELECT packet_id FROM session_message where client_id='test_delta'").fetchall()
+        self.assertEqual(rows, [(2,)])
+
+    def test_save_queued_delta(self):
+        sql_plugin = self._create_plugin()
+        submitted = []
+
+        @asyncio.coroutine
+        def test_coro():
+            s = self._session('test_queued')
+            for i in range(3):
+                s.retained_messages.put_nowait(RetainedApplicationMessage('a/b', str(i).encode(), 1))
+            yield from sql_plugin.save_session(s)
+            submit = sql_plugin._worker.submit
+
+            def record_submit(operation, *args, **kwargs):
+                submitted.append(args)
+                return submit(operation, *args, **kwargs)
+            sql_plugin._worker.submit = record_submit
+            # Head of the queue delivered: only this message is deleted
+            s.retained_messages.get_nowait()
+            yield from sql_plugin.save_session(s)
+            self.assertEqual(len(submitted), 1)
+            client_id, data, messages, deleted_messages, replace = submitted[0]
+            self.assertEqual((data, messages, len(deleted_messages)), (None, [], 1))
+            # Sequence numbers of loaded messages are kept, and new messages are queued after them
+            sql_plugin._saved.clear()
+            found, subscriptions = yield from sql_plugin.find_session('test_queued')
+            found.retained_messages.put_nowait(RetainedApplicationMessage('a/b', b'3', 1))
+            yield from sql_plugin.save_session(found)
+            sql_plugin._saved.clear()
+            found, subscriptions = yield from sql_plugin.find_session('test_queued')
+            self.assertEqual([found.retained_messages.get_nowait().data for i in range(3)], [b'1', b'2', b'3'])
+            yield from sql_plugin.on_broker_post_shutdown()
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_digest_cache_size(self):
+        sql_plugin = self._create_plugin(**{'digest-cache-size': 1})
+
+        @asyncio.coroutine
+        def test_coro():
+            sessions = [self._session('cached_%d' % i) for i in range(2)]
+            for s in sessions:
+                for packet_id in (1, 2):
+                    s.inflight_out[packet_id] = OutgoingApplicationMessage(packet_id, 'a/b', 1, b'data', False)
+                yield from sql_plugin.save_session(s)
+            self.assertEqual(list(sql_plugin._saved), ['cached_1'])
+            # Digests of the first session were dropped: it is written whole, without its acknowledged message
+            del sessions[0].inflight_out[1]
+            yield from sql_plugin.save_session(sessions[0])
+            self.assertEqual(list(sql_plugin._saved), ['cached_0'])
+            yield from sql_plugin.on_broker_post_shutdown()
+
+        self.loop.run_until_complete(test_coro())
+        conn = sqlite3.connect(self.dbfile)
+        rows = conn.execute("SELECT client_id, packet_id FROM session_message ORDER BY client_id, packet_id").fetchall()
+        self.assertEqual(rows, [('cached_0', 2), ('cached_1', 1), ('cached_1', 2)])
+
+    def test_group_commit(self):
+        sql_plugin = self._create_plugin(**{'commit-delay': 1, 'commit-size': 10})
+
+        @asyncio.coroutine
+        def test_coro():
+            start = self.loop.time()
+            yield from asyncio.wait([sql_plugin.save_session(self._session('group_%d' % i)) for i in range(10)],
+                                    loop=self.loop)
+            # Commit size reached before commit delay
+            self.assertLess(self.loop.time() - start, 1)
+            yield from sql_plugin.on_broker_post_shutdown()
+
+        self.loop.run_until_complete(test_coro())
+        conn = sqlite3.connect(self.dbfile)
+        row = conn.execute("SELECT count(*) FROM session where client_id like 'group_%'").fetchone()
+        self.assertEqual(row[0], 10)
+
     # def test_save_session(self):
     #     dbfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test.db")
     #     context = BaseContext()
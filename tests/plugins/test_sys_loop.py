@@ -0,0 +1,76 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+
+import unittest
+import logging
+import asyncio
+import time
+from hbmqtt.plugins.sys.loop import LoopMonitor
+
+formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=formatter)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLoopMonitor(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_lag_samples(self):
+        monitor = LoopMonitor(self.loop, interval=0.01, threshold=0.5)
+        monitor.start()
+        self.loop.run_until_complete(asyncio.sleep(0.2, loop=self.loop))
+        monitor.stop()
+        self.assertIsNotNone(monitor.percentile(50))
+        self.assertLessEqual(monitor.percentile(50), monitor.percentile(100))
+        self.assertEqual(monitor.offenders, [])
+
+    def test_stall_captured(self):
+        clock = Clock()
+        # The watchdog thread doesn't run during the test: stalls are checked by the blocking callback
+        monitor = LoopMonitor(self.loop, interval=0.01, threshold=100, clock=clock)
+        monitor.start()
+
+        def blocking_callback():
+            clock.now += 50
+            monitor._check()
+            clock.now += 450
+            monitor._check()
+
+        self.loop.call_later(0.05, blocking_callback)
+        self.loop.run_until_complete(asyncio.sleep(0.2, loop=self.loop))
+        monitor.stop()
+        self.assertEqual(monitor.stall_count, 1)
+        stall = monitor.offenders[0]
+        # Time since the previous tick, less the sampling interval
+        self.assertAlmostEqual(stall.duration, 499.99)
+        self.assertIn('blocking_callback', stall.stack)
+
+    def test_stall_race(self):
+        clock = Clock()
+        monitor = LoopMonitor(self.loop, interval=0.01, threshold=100, clock=clock)
+        monitor.start()
+
+        def late_callback():
+            # The watchdog sees a stale heartbeat, but the loop runs the next tick before the threshold, once the
+            # sampling interval is left out
+            monitor._heartbeat = -200
+            monitor._check()
+            clock.now = -99.995
+
+        self.loop.call_later(0.05, late_callback)
+        self.loop.run_until_complete(asyncio.sleep(0.2, loop=self.loop))
+        monitor.stop()
+        self.assertEqual(monitor.stall_count, 0)
+        self.assertEqual(monitor.offenders, [])
@@ -0,0 +1,79 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+
+import unittest
+import logging
+import asyncio
+from hbmqtt.plugins.manager import BaseContext
+from hbmqtt.plugins.sys.top import SpaceSaving, BrokerTopPlugin
+from hbmqtt.mqtt.publish import PublishPacket
+from hbmqtt.session import Session
+from hbmqtt.adapters import BufferReader
+
+formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=formatter)
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def test_exact_under_capacity(self):
+        summary = SpaceSaving(10)
+        for key, count in (('a', 5), ('b', 3), ('c', 1)):
+            for i in range(count):
+                summary.add(key)
+        self.assertEqual(summary.top(2), [('a', 5, 0), ('b', 3, 0)])
+        self.assertEqual(summary.total, 9)
+
+    def test_bounded_memory(self):
+        summary = SpaceSaving(5)
+        for i in range(1000):
+            summary.add('noise/%d' % i)
+            summary.add('heavy')
+        self.assertEqual(len(summary), 5)
+        self.assertEqual(summary.top(1)[0][0], 'heavy')
+        self.assertEqual(summary.top(1)[0][1], 1000)
+
+    def test_weight(self):
+        summary = SpaceSaving(2)
+        summary.add('a', 100)
+        summary.add('b', 10)
+        summary.add('c', 1)
+        top = summary.top(2)
+        self.assertEqual(top[0], ('a', 100, 0))
+        # 'c' replaced 'b' and inherited its count as error
+        self.assertEqual(top[1], ('c', 11, 10))
+
+    def test_clear(self):
+        summary = SpaceSaving(2)
+        summary.add('a')
+        summary.clear()
+        self.assertEqual(len(summary), 0)
+        self.assertEqual(summary.top(1), [])
+
+
+class TestBrokerTopPlugin(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_count_publish(self):
+        context = BaseContext()
+        context.logger = logging.getLogger(__name__)
+        context.loop = self.loop
+        context.config = {'sys_interval': 10, 'top': {'size': 2, 'capacity': 4}}
+        plugin = BrokerTopPlugin(context)
+        self.loop.run_until_complete(plugin.on_broker_post_start())
+        session = Session(self.loop)
+        session.client_id = 'publisher'
+        data = PublishPacket.build('a/b', b'data', None, False, 0, False).to_bytes()
+        for i in range(3):
+            packet = self.loop.run_until_complete(PublishPacket.from_stream(BufferReader(data)))
+            self.loop.run_until_complete(plugin.on_mqtt_packet_received(packet=packet, session=session))
+        top = plugin.get_top('topics', 'messages')
+        self.assertEqual(len(top), 1)
+        self.assertEqual(top[0]['name'], 'a/b')
+        self.assertEqual(top[0]['count'], 3)
+        self.assertEqual(plugin.get_top('clients', 'bytes')[0]['count'], 3 * len(data))
+        self.loop.run_until_complete(plugin.on_broker_pre_shutdown())
@@ -0,0 +1,90 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+from hbmqtt.admission import AdmissionControl, TokenBucket, \
+    REJECT_LISTENER_RATE, REJECT_IP_RATE, REJECT_AUTH_PENALTY
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, 3, 0)
+        self.assertEqual([bucket.consume(0) for i in range(4)], [True, True, True, False])
+        self.assertTrue(bucket.consume(0.5))
+        self.assertFalse(bucket.consume(0.5))
+        # Refill is capped to burst
+        self.assertEqual([bucket.consume(100) for i in range(4)], [True, True, True, False])
+
+    def test_no_limit(self):
+        admission = AdmissionControl(clock=self.clock)
+        for i in range(1000):
+            self.assertIsNone(admission.admit('10.0.0.1'))
+        self.assertEqual(admission.admitted, 1000)
+        # Addresses aren't tracked without per IP limit
+        self.assertEqual(len(admission._addresses), 0)
+
+    def test_listener_rate(self):
+        admission = AdmissionControl(rate=10, burst=2, clock=self.clock)
+        self.assertIsNone(admission.admit('10.0.0.1'))
+        self.assertIsNone(admission.admit('10.0.0.2'))
+        self.assertEqual(admission.admit('10.0.0.3'), REJECT_LISTENER_RATE)
+        self.clock.now = 0.1
+        self.assertIsNone(admission.admit('10.0.0.3'))
+        self.assertEqual(admission.rejected[REJECT_LISTENER_RATE], 1)
+
+    def test_ip_rate(self):
+        admission = AdmissionControl(ip_rate=1, ip_burst=2, clock=self.clock)
+        self.assertIsNone(admission.admit('10.0.0.1'))
+        self.assertIsNone(admission.admit('10.0.0.1'))
+        self.assertEqual(admission.admit('10.0.0.1'), REJECT_IP_RATE)
+        self.assertIsNone(admission.admit('10.0.0.2'))
+        self.clock.now = 1
+        self.assertIsNone(admission.admit('10.0.0.1'))
+        self.assertEqual(admission.rejected[REJECT_IP_RATE], 1)
+
+    def test_auth_penalty(self):
+        admission = AdmissionControl(penalty=1, max_penalty=3, clock=self.clock)
+        admission.auth_failed('10.0.0.1')
+        self.assertEqual(admission.admit('10.0.0.1'), REJECT_AUTH_PENALTY)
+        self.assertIsNone(admission.admit('10.0.0.2'))
+        self.clock.now = 1
+        self.assertIsNone(admission.admit('10.0.0.1'))
+        # Penalty doubles on consecutive failures, up to the maximum
+        expected = [2, 3, 3]
+        for delay in expected:
+            admission.auth_failed('10.0.0.1')
+            self.clock.now += delay - 0.5
+            self.assertEqual(admission.admit('10.0.0.1'), REJECT_AUTH_PENALTY)
+            self.clock.now += 0.5
+            self.assertIsNone(admission.admit('10.0.0.1'))
+        admission.auth_succeeded('10.0.0.1')
+        admission.auth_failed('10.0.0.1')
+        self.clock.now += 1
+        self.assertIsNone(admission.admit('10.0.0.1'))
+
+    def test_auth_penalty_many_failures(self):
+        admission = AdmissionControl(penalty=0.5, max_penalty=300, clock=self.clock)
+        for i in range(5000):
+            admission.auth_failed('10.0.0.1')
+        self.clock.now = 299
+        self.assertEqual(admission.admit('10.0.0.1'), REJECT_AUTH_PENALTY)
+        self.clock.now = 300
+        self.assertIsNone(admission.admit('10.0.0.1'))
+
+    def test_max_addresses(self):
+        admission = AdmissionControl(ip_rate=1, ip_burst=1, max_addresses=2, clock=self.clock)
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+            self.assertIsNone(admission.admit(ip))
+        self.assertNotIn('10.0.0.1', admission._addresses)
+        self.assertEqual(len(admission._addresses), 2)
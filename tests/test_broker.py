@@ -2,13 +2,18 @@
 #
 # See the file license.txt for copying permission.
 import unittest
+import os
+import shutil
+import tempfile
 from unittest.mock import patch, call, MagicMock
 from hbmqtt.broker import *
 from hbmqtt.mqtt.constants import *
 from hbmqtt.client import MQTTClient, ConnectException
 from hbmqtt.mqtt import ConnectPacket, ConnackPacket, PublishPacket, PubrecPacket, \
-    PubrelPacket, PubcompPacket, DisconnectPacket
+    PubrelPacket, PubcompPacket, DisconnectPacket, SubscribePacket, PubackPacket
 from hbmqtt.mqtt.connect import ConnectVariableHeader, ConnectPayload
+from hbmqtt.session import OutgoingApplicationMessage
+from hbmqtt.wal import InflightLog
 
 formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=formatter)
@@ -177,6 +182,79 @@ class BrokerTest(unittest.TestCase):
         if future.exception():
             raise future.exception()
 
+    @patch('hbmqtt.broker.PluginManager')
+    def test_client_takeover(self, MockPluginManager):
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(test_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                client1 = MQTTClient(client_id="takeover", config={'auto_reconnect': False})
+                yield from client1.connect('mqtt://localhost/', cleansession=False)
+                yield from client1.subscribe([('a/b', QOS_1)])
+                session, handler = broker._sessions['takeover']
+                client2 = MQTTClient(client_id="takeover", config={'auto_reconnect': False})
+                start = self.loop.time()
+                yield from client2.connect('mqtt://localhost/', cleansession=False)
+                self.assertLess(self.loop.time() - start, 0.5)
+                # Session kept and attached to the new connection
+                self.assertIs(broker._sessions['takeover'][0], session)
+                self.assertIsNot(broker._sessions['takeover'][1], handler)
+                self.assertEqual(broker._client_subscriptions['takeover'], {'a/b': QOS_1})
+                yield from asyncio.sleep(0.1)
+                self.assertEqual(session.transitions.state, 'connected')
+                yield from client2.publish('a/b', b'data', QOS_1)
+                message = yield from client2.deliver_message(timeout=1)
+                self.assertEqual(message.data, b'data')
+                yield from client2.disconnect()
+                yield from asyncio.sleep(0.1)
+                self.assertEqual(session.transitions.state, 'disconnected')
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
+    @patch('hbmqtt.broker.PluginManager')
+    def test_session_expiry(self, MockPluginManager):
+        expiry_config = dict(test_config)
+        expiry_config['session-expiry-interval'] = 0.2
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(expiry_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                client = MQTTClient(client_id="expiring", config={'auto_reconnect': False})
+                yield from client.connect('mqtt://localhost/', cleansession=False)
+                yield from client.subscribe([('a/b', QOS_1)])
+                yield from client.disconnect()
+                yield from asyncio.sleep(0.1)
+                # Reconnecting cancels expiry
+                yield from client.connect('mqtt://localhost/', cleansession=False)
+                yield from asyncio.sleep(0.2)
+                self.assertIn('expiring', broker._sessions)
+                yield from client.disconnect()
+                yield from asyncio.sleep(0.1)
+                self.assertIn('expiring', broker._sessions)
+                yield from asyncio.sleep(0.2)
+                self.assertNotIn('expiring', broker._sessions)
+                self.assertNotIn('expiring', broker._client_subscriptions)
+                self.assertNotIn('a/b', broker._subscriptions)
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
     @patch('hbmqtt.broker.PluginManager')
     def test_client_subscribe(self, MockPluginManager):
         @asyncio.coroutine
@@ -323,8 +401,9 @@ class BrokerTest(unittest.TestCase):
                 yield from asyncio.sleep(0.1)
                 yield from broker.shutdown()
                 self.assertTrue(broker.transitions.is_stopped())
+                # QoS 0 messages are routed as soon as they are received, notifying plugins without waiting
                 MockPluginManager.assert_has_calls(
-                    [call().fire_event(EVENT_BROKER_MESSAGE_RECEIVED,
+                    [call().schedule_event(EVENT_BROKER_MESSAGE_RECEIVED,
                                        client_id=pub_client.session.client_id,
                                        message=ret_message),
                     ], any_order=True)
@@ -467,7 +546,6 @@ class BrokerTest(unittest.TestCase):
                 yield from asyncio.sleep(0.1)
                 self.assertIn('/topic', broker._retained_messages)
                 retained_message = broker._retained_messages['/topic']
-                self.assertEquals(retained_message.source_session, pub_client.session)
                 self.assertEquals(retained_message.topic, '/topic')
                 self.assertEquals(retained_message.data, b'data')
                 self.assertEquals(retained_message.qos, QOS_0)
@@ -545,6 +623,434 @@ class BrokerTest(unittest.TestCase):
         if future.exception():
             raise future.exception()
 
+    @patch('hbmqtt.broker.PluginManager')
+    def test_broadcast_shards(self, MockPluginManager):
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                # Settings given as strings, as from environment variables
+                config = dict(test_config, **{'broadcast-shards': '4', 'broadcast-batch-size': '5'})
+                broker = Broker(config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                self.assertEqual(len(broker._broadcast_tasks), 4)
+                sub_client = MQTTClient()
+                yield from sub_client.connect('mqtt://localhost')
+                yield from sub_client.subscribe([('shards/#', QOS_0)])
+                topics = ['shards/%d' % i for i in range(8)]
+                for i in range(40):
+                    yield from broker.internal_message_broadcast(topics[i % 8], str(i).encode())
+                received = dict((topic, []) for topic in topics)
+                for i in range(40):
+                    message = yield from sub_client.deliver_message(timeout=2)
+                    received[message.topic].append(int(message.data))
+                # Order is kept per topic
+                for index, topic in enumerate(topics):
+                    self.assertEqual(received[topic], list(range(index, 40, 8)))
+                yield from sub_client.disconnect()
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
+    @asyncio.coroutine
+    def _raw_connect(self, client_id):
+        conn_reader, conn_writer = yield from asyncio.open_connection('localhost', 1883, loop=self.loop)
+        reader = StreamReaderAdapter(conn_reader)
+        vh = ConnectVariableHeader()
+        payload = ConnectPayload()
+        vh.keep_alive = 10
+        vh.clean_session_flag = True
+        payload.client_id = client_id
+        conn_writer.write(ConnectPacket(vh=vh, payload=payload).to_bytes())
+        yield from ConnackPacket.from_stream(reader)
+        return conn_writer
+
+    @asyncio.coroutine
+    def _check_publisher_order(self, config, topics):
+        broker = Broker(config, plugin_namespace="hbmqtt.test.plugins")
+        yield from broker.start()
+        sub_client = MQTTClient()
+        yield from sub_client.connect('mqtt://localhost')
+        yield from sub_client.subscribe([('t/#', QOS_0)])
+        broker.retain_message(None, 'r', b'r', QOS_1)
+        writer = yield from self._raw_connect('publisher')
+        # The first message of the publisher waits in the inbox while its loop sends the retained message of a
+        # subscription...
+        writer.write(SubscribePacket.build([('r', QOS_1)], 1).to_bytes() +
+                     PublishPacket.build(topics[0], b'0', None, False, QOS_0, False).to_bytes())
+        yield from asyncio.sleep(0.1, loop=self.loop)
+        # ... then is queued behind a backlog once the retained message is acknowledged...
+        for i in range(5000):
+            broker._queue_broadcast(None, topics[0], b'')
+        writer.write(PubackPacket.build(1).to_bytes())
+        # ... and the next ones must not overtake it
+        for i in range(1, 20):
+            yield from asyncio.sleep(0.002, loop=self.loop)
+            writer.write(PublishPacket.build(topics[i % len(topics)], str(i).encode(), None, False, QOS_0,
+                                             False).to_bytes())
+        received = []
+        while len(received) < 20:
+            message = yield from sub_client.deliver_message(timeout=10)
+            if message.data:
+                received.append(int(message.data))
+        self.assertEqual(received, list(range(20)))
+        writer.close()
+        yield from sub_client.disconnect()
+        yield from asyncio.sleep(0.1)
+        yield from broker.shutdown()
+
+    def test_publisher_order(self):
+        self.loop.run_until_complete(self._check_publisher_order(test_config, ['t/0']))
+
+    def test_publisher_order_shards(self):
+        config = dict(test_config, **{'broadcast-shards': 4})
+        self.loop.run_until_complete(self._check_publisher_order(config, ['t/%d' % i for i in range(8)]))
+
+    def test_session_persistence(self):
+        dbfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_persistence.db")
+        persistence_config = dict(test_config)
+        persistence_config['persistence'] = {'file': dbfile, 'flush-interval': 0.05}
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(persistence_config)
+                yield from broker.start()
+                sub_client = MQTTClient(client_id='persistent', config={'auto_reconnect': False})
+                yield from sub_client.connect('mqtt://localhost', cleansession=False)
+                ret = yield from sub_client.subscribe([('/persistent/#', QOS_1)])
+                self.assertEquals(ret, [QOS_1])
+                yield from sub_client.disconnect()
+                yield from asyncio.sleep(0.1)
+                # Queued while the client is offline
+                yield from self._client_publish('/persistent/queued', b'queued', QOS_1)
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+
+                broker = Broker(persistence_config)
+                yield from broker.start()
+                # Only subscribed until the client connects
+                self.assertEqual(broker._unloaded_sessions, {'persistent'})
+                sub_client = MQTTClient(client_id='persistent', config={'auto_reconnect': False})
+                yield from sub_client.connect('mqtt://localhost', cleansession=False)
+                self.assertIn('persistent', broker._sessions)
+                message = yield from sub_client.deliver_message()
+                self.assertEquals(message.topic, '/persistent/queued')
+                self.assertEquals(message.data, b'queued')
+                # Subscription restored
+                yield from self._client_publish('/persistent/live', b'live', QOS_1)
+                message = yield from sub_client.deliver_message()
+                self.assertEquals(message.topic, '/persistent/live')
+                yield from sub_client.disconnect()
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+                # Let the persistence plugin close its database
+                yield from asyncio.sleep(0.1)
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        try:
+            self.loop.run_until_complete(test_coro())
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(dbfile + suffix):
+                    os.remove(dbfile + suffix)
+        if future.exception():
+            raise future.exception()
+
+    def test_session_persistence_restart(self):
+        dbfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_persistence.db")
+        persistence_config = dict(test_config)
+        persistence_config['persistence'] = {'file': dbfile, 'flush-interval': 0.05}
+
+        @asyncio.coroutine
+        def test_coro():
+            broker = Broker(persistence_config)
+            yield from broker.start()
+            sub_client = MQTTClient(client_id='persistent', config={'auto_reconnect': False})
+            yield from sub_client.connect('mqtt://localhost', cleansession=False)
+            yield from sub_client.subscribe([('/persistent/#', QOS_1)])
+            yield from sub_client.disconnect()
+            yield from asyncio.sleep(0.1)
+            yield from self._client_publish('/persistent/queued', b'1', QOS_1)
+            yield from asyncio.sleep(0.1)
+            yield from broker.shutdown()
+
+            # Published to the offline session after a restart, then saved with it
+            broker = Broker(persistence_config)
+            yield from broker.start()
+            yield from self._client_publish('/persistent/queued', b'2', QOS_1)
+            yield from asyncio.sleep(0.1)
+            self.assertEqual(broker._unloaded_sessions, set())
+            self.assertEqual(broker._sessions['persistent'][0].retained_messages_count, 2)
+            yield from broker.shutdown()
+
+            broker = Broker(persistence_config)
+            yield from broker.start()
+            yield from self._client_publish('/persistent/queued', b'3', QOS_1)
+            sub_client = MQTTClient(client_id='persistent', config={'auto_reconnect': False})
+            yield from sub_client.connect('mqtt://localhost', cleansession=False)
+            received = []
+            for i in range(3):
+                message = yield from sub_client.deliver_message(timeout=2)
+                received.append(message.data)
+            self.assertEqual(received, [b'1', b'2', b'3'])
+            yield from sub_client.disconnect()
+            yield from asyncio.sleep(0.1)
+            yield from broker.shutdown()
+            # Let the persistence plugin close its database
+            yield from asyncio.sleep(0.1)
+
+        try:
+            self.loop.run_until_complete(test_coro())
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(dbfile + suffix):
+                    os.remove(dbfile + suffix)
+
+    @patch('hbmqtt.broker.PluginManager')
+    def test_retained_store(self, MockPluginManager):
+        store_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_retained")
+        store_config = dict(test_config)
+        store_config['retained-store'] = {'file': store_file}
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(store_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                yield from self._client_publish('/kept', b'kept', QOS_0, retain=True)
+                yield from self._client_publish('/cleared', b'cleared', QOS_0, retain=True)
+                yield from self._client_publish('/cleared', b'', QOS_0, retain=True)
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+
+                broker = Broker(store_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                self.assertEqual(list(broker._retained_messages), ['/kept'])
+                self.assertEqual(broker._retained_messages['/kept'].data, b'kept')
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        try:
+            self.loop.run_until_complete(test_coro())
+        finally:
+            for suffix in ('', '.log'):
+                if os.path.exists(store_file + suffix):
+                    os.remove(store_file + suffix)
+        if future.exception():
+            raise future.exception()
+
+    @patch('hbmqtt.broker.PluginManager')
+    def test_inflight_log_recovery(self, MockPluginManager):
+        directory = tempfile.mkdtemp()
+        log_config = dict(test_config)
+        log_config['inflight-log'] = {'directory': directory}
+        # In flight when the previous broker stopped
+        inflight_log = InflightLog(directory)
+        inflight_log.open()
+        message = OutgoingApplicationMessage(1, '/inflight', QOS_1, b'inflight', False)
+        message.publish_packet = message.build_publish_packet()
+        inflight_log.put('wal-client', message)
+        inflight_log.close()
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(log_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                client = MQTTClient(client_id='wal-client', config={'auto_reconnect': False})
+                yield from client.connect('mqtt://localhost', cleansession=False)
+                message = yield from client.deliver_message()
+                self.assertEqual(message.topic, '/inflight')
+                self.assertEqual(message.data, b'inflight')
+                yield from asyncio.sleep(0.1)
+                self.assertEqual(broker._sessions['wal-client'][0].inflight_out, {})
+                yield from client.disconnect()
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+                # Acknowledged: not recovered again
+                inflight_log = InflightLog(directory)
+                self.assertEqual(inflight_log.open(), {})
+                inflight_log.close()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        try:
+            self.loop.run_until_complete(test_coro())
+        finally:
+            shutil.rmtree(directory)
+        if future.exception():
+            raise future.exception()
+
+    def test_topic_acl(self):
+        acl_config = dict(test_config)
+        acl_config['topic-check'] = {
+            'enabled': True,
+            'plugins': ['topic_acl'],
+            'acl-file': os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "acl"),
+        }
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(acl_config)
+                yield from broker.start()
+                client = MQTTClient()
+                yield from client.connect('mqtt://localhost')
+                ret = yield from client.subscribe([('public/#', QOS_0), ('alice/#', QOS_0)])
+                self.assertEqual(ret, [QOS_0, 0x80])
+                # Anonymous clients can't publish
+                yield from client.publish('public/news', b'data', QOS_0, retain=True)
+                yield from asyncio.sleep(0.1)
+                self.assertNotIn('public/news', broker._retained_messages)
+                yield from client.disconnect()
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
+    @patch('hbmqtt.broker.PluginManager')
+    def test_connection_rate(self, MockPluginManager):
+        rate_config = dict(test_config)
+        rate_config['listeners'] = {
+            'default': dict(test_config['listeners']['default'], **{
+                'ip-connection-rate': 0.001,
+                'ip-connection-burst': 1})
+        }
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(rate_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                client = MQTTClient()
+                yield from client.connect('mqtt://localhost/')
+                # Second connection is closed without reading anything
+                reader, writer = yield from asyncio.open_connection('localhost', 1883, loop=self.loop)
+                data = yield from asyncio.wait_for(reader.read(), 1, loop=self.loop)
+                self.assertEqual(data, b'')
+                writer.close()
+                admission = broker._servers['default'].admission
+                self.assertEqual(admission.rejected['ip_rate'], 1)
+                self.assertEqual(admission.admitted, 1)
+                yield from client.disconnect()
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
+    @patch('hbmqtt.broker.PluginManager')
+    def test_connect_timeout(self, MockPluginManager):
+        timeout_config = dict(test_config)
+        timeout_config['listeners'] = {
+            'default': dict(test_config['listeners']['default'], **{
+                'connect-timeout': 0.2,
+                'max-handshakes': 1})
+        }
+
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(timeout_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                server = broker._servers['default']
+                idle_reader, idle_writer = yield from asyncio.open_connection('localhost', 1883, loop=self.loop)
+                yield from asyncio.sleep(0.05)
+                self.assertEqual(server.handshakes, 1)
+                # Handshakes limit reached
+                reader, writer = yield from asyncio.open_connection('localhost', 1883, loop=self.loop)
+                data = yield from asyncio.wait_for(reader.read(), 1, loop=self.loop)
+                self.assertEqual(data, b'')
+                writer.close()
+                # Idle connection closed once CONNECT deadline is reached
+                data = yield from asyncio.wait_for(idle_reader.read(), 1, loop=self.loop)
+                self.assertEqual(data, b'')
+                idle_writer.close()
+                self.assertEqual(server.handshakes, 0)
+                self.assertEqual(server.conn_count, 0)
+                self.assertEqual(server.handshake_stats['timeouts'], 1)
+                self.assertEqual(server.handshake_stats['rejected'], 1)
+                client = MQTTClient()
+                yield from client.connect('mqtt://localhost/')
+                self.assertEqual(server.handshake_stats['count'], 1)
+                yield from client.disconnect()
+                yield from asyncio.sleep(0.1)
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
+    @patch('hbmqtt.broker.PluginManager')
+    def test_connect_timeout_connections_full(self, MockPluginManager):
+        timeout_config = dict(test_config)
+        timeout_config['listeners'] = {
+            'default': dict(test_config['listeners']['default'], **{
+                'max_connections': 1,
+                'connect-timeout': 0.2,
+                'max-handshakes': 1})
+        }
+
+        @asyncio.coroutine
+        def test_coro():
+            broker = Broker(timeout_config, plugin_namespace="hbmqtt.test.plugins")
+            yield from broker.start()
+            server = broker._servers['default']
+            client = MQTTClient()
+            yield from client.connect('mqtt://localhost/')
+            self.assertEqual(server.conn_count, 1)
+            # Idle connection closed once CONNECT deadline is reached, though no connection slot is available
+            idle_reader, idle_writer = yield from asyncio.open_connection('localhost', 1883, loop=self.loop)
+            yield from asyncio.sleep(0.05)
+            self.assertEqual(server.handshakes, 1)
+            data = yield from asyncio.wait_for(idle_reader.read(), 1, loop=self.loop)
+            self.assertEqual(data, b'')
+            idle_writer.close()
+            self.assertEqual(server.handshakes, 0)
+            self.assertEqual(server.handshake_stats['timeouts'], 1)
+            # A connection waiting for a slot doesn't count as a handshake in progress
+            waiting = ensure_future(self._raw_connect('waiting'), loop=self.loop)
+            yield from asyncio.sleep(0.3)
+            self.assertFalse(waiting.done())
+            self.assertEqual(server.handshakes, 0)
+            yield from client.disconnect()
+            writer = yield from asyncio.wait_for(waiting, 1, loop=self.loop)
+            writer.close()
+            yield from asyncio.sleep(0.1)
+            yield from broker.shutdown()
+
+        self.loop.run_until_complete(test_coro())
+
     @patch('hbmqtt.broker.PluginManager')
     def test_client_subscribe_invalid(self, MockPluginManager):
         @asyncio.coroutine
@@ -0,0 +1,85 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+import os
+import stat
+import tempfile
+from hbmqtt.adapters import BufferReader, BufferWriter
+from hbmqtt.capture import CaptureFile, read_capture, packet_length, redact_connect, CAPTURE_OPEN, CAPTURE_IN, \
+    CAPTURE_OUT, CAPTURE_CLOSE
+from hbmqtt.mqtt.connect import ConnectPacket, ConnectVariableHeader, ConnectPayload
+from hbmqtt.mqtt.publish import PublishPacket
+from hbmqtt.mqtt.puback import PubackPacket
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        fd, self.path = tempfile.mkstemp(suffix='.cap')
+        os.close(fd)
+
+    def tearDown(self):
+        self.loop.close()
+        os.remove(self.path)
+
+    def test_packet_length(self):
+        self.assertIsNone(packet_length(b'\x30'))
+        self.assertEqual(packet_length(b'\x30\x02ab'), 4)
+        self.assertIsNone(packet_length(b'\x30\xc1'))
+        self.assertEqual(packet_length(b'\x30\xc1\x02'), 3 + 321)
+
+    def test_capture_tap(self):
+        publish = PublishPacket.build('a/b', b'x' * 200, 1, False, 1, False).to_bytes()
+        puback = PubackPacket.build(1).to_bytes()
+        capture = CaptureFile(self.path)
+        reader, writer = capture.tap(BufferReader(publish + publish), BufferWriter())
+
+        @asyncio.coroutine
+        def read_write():
+            # Protocol handler reads packets in small chunks
+            while (yield from reader.read(3)):
+                pass
+            writer.write(puback)
+            yield from writer.close()
+
+        self.loop.run_until_complete(read_write())
+        capture.close()
+        records = list(read_capture(self.path))
+        self.assertEqual([r.direction for r in records],
+                         [CAPTURE_OPEN, CAPTURE_IN, CAPTURE_IN, CAPTURE_OUT, CAPTURE_CLOSE])
+        self.assertEqual(records[0].data, b'BufferWriter:0')
+        self.assertEqual(records[1].data, publish)
+        self.assertEqual(records[2].data, publish)
+        self.assertEqual(records[3].data, puback)
+        self.assertTrue(all(r.connection == 1 for r in records))
+        self.assertLessEqual(records[0].timestamp, records[-1].timestamp)
+
+    def _connect_packet(self, password):
+        vh = ConnectVariableHeader()
+        payload = ConnectPayload(client_id='client', will_topic='will', will_message=b'bye', username='user',
+                                 password=password)
+        vh.will_flag = True
+        vh.username_flag = True
+        vh.password_flag = password is not None
+        return ConnectPacket(vh=vh, payload=payload).to_bytes()
+
+    def test_redact_connect(self):
+        redacted = redact_connect(self._connect_packet('secret'))
+        self.assertNotIn(b'secret', redacted)
+        self.assertEqual(redacted, self._connect_packet(None))
+        packet = self.loop.run_until_complete(ConnectPacket.from_stream(BufferReader(redacted)))
+        self.assertEqual((packet.client_id, packet.username, packet.password), ('client', 'user', None))
+        self.assertEqual(packet.will_message, b'bye')
+        # Invalid packets are recorded without content
+        self.assertEqual(redact_connect(self._connect_packet('secret')[:-1]), b'\x10\x00')
+
+    def test_capture_connect(self):
+        capture = CaptureFile(self.path)
+        reader, writer = capture.tap(BufferReader(self._connect_packet('secret')), BufferWriter())
+        self.loop.run_until_complete(reader.read())
+        capture.close()
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        records = list(read_capture(self.path))
+        self.assertEqual(records[1].data, self._connect_packet(None))
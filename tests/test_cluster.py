@@ -0,0 +1,129 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+import shutil
+import tempfile
+from hbmqtt.broker import Broker
+from hbmqtt.client import MQTTClient
+from hbmqtt.cluster import encode_frame, read_frame, worker_config, FRAME_PUBLISH, FRAME_SUBSCRIBE
+from hbmqtt.mqtt.constants import QOS_1
+
+
+def broker_config(port):
+    return {
+        'listeners': {
+            'default': {
+                'type': 'tcp',
+                'bind': '127.0.0.1:%d' % port,
+            },
+        },
+        'sys_interval': 0,
+        'auth': {
+            'allow-anonymous': True,
+        }
+    }
+
+
+class ClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.socket_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.socket_dir)
+
+    def test_frames(self):
+        @asyncio.coroutine
+        def test_coro():
+            reader = asyncio.StreamReader(loop=self.loop)
+            reader.feed_data(encode_frame(FRAME_SUBSCRIBE, 'a/#') + encode_frame(FRAME_PUBLISH, 'a/é', b'data', 1))
+            self.assertEqual((yield from read_frame(reader)), (FRAME_SUBSCRIBE, 'a/#', b'', 0))
+            self.assertEqual((yield from read_frame(reader)), (FRAME_PUBLISH, 'a/é', b'data', 1))
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_worker_config(self):
+        config = dict(broker_config(1883), **{
+            'retained-store': {'file': '/data/retained'},
+            'inflight-log': {'directory': '/data/inflight'},
+            'persistence': {'file': '/data/sessions.db'},
+        })
+        config = worker_config(config, 1, 2, '/run/hbmqtt')
+        self.assertTrue(config['listeners']['default']['reuse-port'])
+        self.assertEqual(config['cluster'], {'workers': 2, 'worker': 1, 'socket-dir': '/run/hbmqtt'})
+        self.assertEqual(config['retained-store']['file'], '/data/retained.1')
+        self.assertEqual(config['inflight-log']['directory'], '/data/inflight/worker-1')
+        self.assertEqual(config['persistence']['file'], '/data/sessions.db.1')
+
+    @asyncio.coroutine
+    def _start_workers(self, **listener):
+        configs = [broker_config(1883 + i) for i in range(2)]
+        for config in configs:
+            config['listeners']['default'].update(listener)
+        brokers = [Broker(worker_config(configs[i], i, 2, self.socket_dir), loop=self.loop,
+                          plugin_namespace="hbmqtt.test.plugins") for i in range(2)]
+        for broker in brokers:
+            yield from broker.start()
+        while any(len(broker._links._peer_writers) < 1 or len(broker._links._peer_filters) < 1
+                  for broker in brokers):
+            yield from asyncio.sleep(0.01, loop=self.loop)
+        return brokers
+
+    def test_forward(self):
+        @asyncio.coroutine
+        def test_coro():
+            brokers = yield from self._start_workers()
+            subscriber = MQTTClient(client_id='subscriber', loop=self.loop)
+            yield from subscriber.connect('mqtt://127.0.0.1:1883/')
+            yield from subscriber.subscribe([('a/#', QOS_1)])
+            while 'a/#' not in brokers[1]._links._peer_filters[0]:
+                yield from asyncio.sleep(0.01, loop=self.loop)
+            publisher = MQTTClient(client_id='publisher', loop=self.loop)
+            yield from publisher.connect('mqtt://127.0.0.1:1884/')
+            yield from publisher.publish('a/b', b'data', QOS_1, retain=True)
+            message = yield from subscriber.deliver_message(timeout=2)
+            self.assertEqual(message.topic, 'a/b')
+            self.assertEqual(message.data, b'data')
+            yield from publisher.disconnect()
+            yield from subscriber.disconnect()
+
+            # Retained message is set by its owner and replicated
+            owner = brokers[0]._links.owner('a/b')
+            while any('a/b' not in broker._retained_messages for broker in brokers):
+                yield from asyncio.sleep(0.01, loop=self.loop)
+            self.assertNotIn('a/b', brokers[owner]._links.replicas)
+            self.assertIn('a/b', brokers[1 - owner]._links.replicas)
+
+            # Interest is withdrawn with the last subscription
+            brokers[0].delete_session('subscriber')
+            while brokers[1]._links._peer_filters[0]:
+                yield from asyncio.sleep(0.01, loop=self.loop)
+            for broker in brokers:
+                yield from broker.shutdown()
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_handoff(self):
+        @asyncio.coroutine
+        def test_coro():
+            brokers = yield from self._start_workers(**{'connection-rate': 100})
+            client_id = next('client-%d' % i for i in range(100) if brokers[0]._links.owner('client-%d' % i) == 0)
+            client = MQTTClient(client_id=client_id, loop=self.loop)
+            # Connect to the worker not owning the session
+            yield from client.connect('mqtt://127.0.0.1:1884/', cleansession=False)
+            yield from client.subscribe([('a/#', QOS_1)])
+            self.assertIn(client_id, brokers[0]._sessions)
+            self.assertNotIn(client_id, brokers[1]._sessions)
+            self.assertEqual(brokers[0]._client_subscriptions[client_id], {'a/#': QOS_1})
+            # The connection is only admitted by the worker which accepted it
+            self.assertEqual(brokers[0]._servers['default'].admission.admitted, 0)
+            self.assertEqual(brokers[1]._servers['default'].admission.admitted, 1)
+            yield from client.disconnect()
+            for broker in brokers:
+                yield from broker.shutdown()
+
+        self.loop.run_until_complete(test_coro())
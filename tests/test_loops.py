@@ -0,0 +1,124 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+from hbmqtt.broker import Broker
+from hbmqtt.client import MQTTClient
+from hbmqtt.loops import RoutingTable, loop_config
+from hbmqtt.mqtt.constants import QOS_1
+
+test_config = {
+    'listeners': {
+        'default': {
+            'type': 'tcp',
+            'bind': '127.0.0.1:1883',
+        },
+    },
+    'sys_interval': 0,
+    'loop-threads': 2,
+    'auth': {
+        'allow-anonymous': True,
+    }
+}
+
+
+class RoutingTableTest(unittest.TestCase):
+    def test_snapshot(self):
+        table = RoutingTable()
+        table.add('a/#', 0)
+        table.add('a/#', 1)
+        table.add('b', 1)
+        version, filters = table.snapshot()
+        self.assertEqual(dict(filters), {'a/#': {0, 1}, 'b': {1}})
+        self.assertIs(table.snapshot()[1], filters)
+        table.remove('a/#', 0)
+        table.remove('b', 1)
+        self.assertGreater(table.snapshot()[0], version)
+        self.assertEqual(dict(table.snapshot()[1]), {'a/#': {1}})
+
+
+class LoopConfigTest(unittest.TestCase):
+    def test_loop_config(self):
+        config = dict(test_config, **{
+            'retained-store': {'file': '/data/retained'},
+            'persistence': {'file': '/data/sessions.db'},
+        })
+        config = loop_config(config, 1)
+        self.assertEqual(config['loop-threads'], 1)
+        self.assertEqual(config['retained-store']['file'], '/data/retained.1')
+        self.assertEqual(config['persistence']['file'], '/data/sessions.db.1')
+
+
+class LoopGroupTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    @asyncio.coroutine
+    def _wait(self, condition):
+        while not condition():
+            yield from asyncio.sleep(0.01, loop=self.loop)
+
+    def test_forward(self):
+        @asyncio.coroutine
+        def test_coro():
+            broker = Broker(test_config, loop=self.loop, plugin_namespace="hbmqtt.test.plugins")
+            yield from broker.start()
+            links = broker._links.group.links
+            # Connections are assigned to the loop serving the fewest connections
+            subscriber = MQTTClient(client_id='subscriber', loop=self.loop)
+            yield from subscriber.connect('mqtt://127.0.0.1:1883/')
+            yield from subscriber.subscribe([('a/#', QOS_1)])
+            publisher = MQTTClient(client_id='publisher', loop=self.loop)
+            yield from publisher.connect('mqtt://127.0.0.1:1883/')
+            self.assertEqual([link.connections for link in links], [1, 1])
+            self.assertIn('subscriber', links[0]._broker._sessions)
+            self.assertIn('publisher', links[1]._broker._sessions)
+
+            yield from publisher.publish('a/b', b'data', QOS_1, retain=True)
+            message = yield from subscriber.deliver_message(timeout=2)
+            self.assertEqual(message.topic, 'a/b')
+            self.assertEqual(message.data, b'data')
+
+            # Retained message is set by its owner and replicated
+            owner = links[0].owner('a/b')
+            yield from self._wait(lambda: all('a/b' in link._broker._retained_messages for link in links))
+            self.assertNotIn('a/b', links[owner].replicas)
+            self.assertIn('a/b', links[1 - owner].replicas)
+
+            yield from subscriber.unsubscribe(['a/#'])
+            self.assertEqual(broker._links.group.table.snapshot()[1], ())
+            yield from publisher.disconnect()
+            yield from subscriber.disconnect()
+            yield from broker.shutdown()
+            self.assertEqual(links[1:], [None])
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_handoff(self):
+        @asyncio.coroutine
+        def test_coro():
+            config = dict(test_config, listeners={'default': dict(test_config['listeners']['default'],
+                                                                  **{'connection-rate': 100})})
+            broker = Broker(config, loop=self.loop, plugin_namespace="hbmqtt.test.plugins")
+            yield from broker.start()
+            links = broker._links.group.links
+            client_id = next('client-%d' % i for i in range(100) if links[0].owner('client-%d' % i) == 1)
+            client = MQTTClient(client_id=client_id, loop=self.loop)
+            # First connection is accepted by the loop not owning the session
+            yield from client.connect('mqtt://127.0.0.1:1883/', cleansession=False)
+            yield from client.subscribe([('a/#', QOS_1)])
+            self.assertNotIn(client_id, links[0]._broker._sessions)
+            self.assertIn(client_id, links[1]._broker._sessions)
+            self.assertEqual([link.connections for link in links], [0, 1])
+            # The connection is only admitted by the loop which accepted it
+            self.assertEqual(links[0]._broker._servers['default'].admission.admitted, 1)
+            self.assertEqual(links[1]._broker._servers['default'].admission.admitted, 0)
+            yield from client.disconnect()
+            yield from broker.shutdown()
+
+        self.loop.run_until_complete(test_coro())
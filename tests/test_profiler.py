@@ -0,0 +1,48 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import os
+import tempfile
+import time
+from hbmqtt.profiler import SamplingProfiler
+
+
+def busy_function(duration):
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        pass
+
+
+class SamplingProfilerTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.output = tempfile.mkstemp(suffix='.collapsed')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.output)
+
+    def test_collapsed_output(self):
+        profiler = SamplingProfiler(self.output, frequency=200)
+        profiler.start()
+        busy_function(0.3)
+        profiler.stop()
+        self.assertGreater(profiler.sample_count, 0)
+        with open(self.output) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        total = 0
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            total += int(count)
+        self.assertEqual(total, profiler.sample_count)
+        self.assertTrue(any('busy_function' in line for line in lines))
+
+    def test_duration(self):
+        profiler = SamplingProfiler(self.output, frequency=100, duration=0.1)
+        profiler.start()
+        busy_function(0.3)
+        count = profiler.sample_count
+        self.assertLessEqual(count, 15)
+        profiler.stop()
+        self.assertTrue(os.path.getsize(self.output) > 0)
@@ -0,0 +1,114 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+import os
+import tempfile
+import shutil
+import threading
+from unittest.mock import patch
+from hbmqtt.retained import RetainedStore, read_records, OP_RETAIN
+
+
+class RetainedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'retained')
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def _open_store(self):
+        store = RetainedStore(self.path)
+        messages = store.load()
+        store.open()
+        return store, messages
+
+    def test_log_replay(self):
+        store, messages = self._open_store()
+        self.assertEqual(messages, {})
+        store.retain('a/b', b'1', 1)
+        store.retain('a/c', b'2', 0)
+        store.retain('a/b', b'3', 2)
+        store.clear('a/c')
+        store.close()
+        store, messages = self._open_store()
+        store.close()
+        self.assertEqual(messages, {'a/b': (b'3', 2)})
+
+    def test_truncated_log(self):
+        store, messages = self._open_store()
+        store.retain('a', b'data', 0)
+        store.retain('b', b'data', 0)
+        store.close()
+        with open(self.path + '.log', 'r+b') as f:
+            f.truncate(os.path.getsize(self.path + '.log') - 2)
+        store, messages = self._open_store()
+        store.close()
+        self.assertEqual(messages, {'a': (b'data', 0)})
+
+    def test_compact(self):
+        store, messages = self._open_store()
+        for i in range(10):
+            store.retain('topic', b'%d' % i, 1)
+        store.retain('other', b'other', 0)
+        self.assertTrue(store.needs_compaction(min_size=0))
+
+        @asyncio.coroutine
+        def compact():
+            coro = store.compact([('topic', b'9', 1), ('other', b'other', 0)], loop=self.loop)
+            task = asyncio.Task(coro, loop=self.loop)
+            # Appended while the snapshot is written
+            yield from asyncio.sleep(0, loop=self.loop)
+            store.clear('other')
+            yield from task
+        self.loop.run_until_complete(compact())
+        store.close()
+        self.assertEqual([r[:2] for r in read_records(self.path)], [(OP_RETAIN, 'topic'), (OP_RETAIN, 'other')])
+        self.assertFalse(os.path.exists(self.path + '.log.new'))
+        store, messages = self._open_store()
+        store.close()
+        self.assertEqual(messages, {'topic': (b'9', 1)})
+
+    def test_interrupted_compaction(self):
+        store, messages = self._open_store()
+        store.retain('a', b'old', 0)
+        store.close()
+        store = RetainedStore(self.path)
+        store._log = store._open_log(self.path + '.log.new')
+        store.retain('a', b'new', 0)
+        store.close()
+        store, messages = self._open_store()
+        store.close()
+        self.assertEqual(messages, {'a': (b'new', 0)})
+        self.assertFalse(os.path.exists(self.path + '.log.new'))
+        store, messages = self._open_store()
+        store.close()
+        self.assertEqual(messages, {'a': (b'new', 0)})
+
+    def test_sync_in_executor(self):
+        store = RetainedStore(self.path, fsync=True)
+        store.load()
+        store.open()
+        threads = []
+
+        def fsync(fd):
+            threads.append(threading.get_ident())
+
+        @asyncio.coroutine
+        def sync():
+            store.retain('a', b'data', 0)
+            yield from store.sync(loop=self.loop)
+            yield from store.compact([('a', b'data', 0)], loop=self.loop)
+        with patch('hbmqtt.retained.os.fsync', side_effect=fsync):
+            self.loop.run_until_complete(sync())
+        store.close()
+        # Synced log, replaced log, snapshot and new log, none of them on the loop thread
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(threading.get_ident(), threads)
+        store, messages = self._open_store()
+        store.close()
+        self.assertEqual(messages, {'a': (b'data', 0)})
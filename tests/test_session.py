@@ -0,0 +1,91 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+import pickle
+from hbmqtt.session import Session, IncomingApplicationMessage, OutgoingApplicationMessage, ApplicationMessage, \
+    SESSION_FORMAT_VERSION
+from hbmqtt.mqtt.pubrec import PubrecPacket
+from hbmqtt.errors import CodecException
+
+
+class SessionCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_session_roundtrip(self):
+        s = Session(self.loop)
+        s.client_id = 'client'
+        s.clean_session = False
+        s.username = 'user'
+        s.keep_alive = 10
+        s.will_flag = True
+        s.will_topic = 'will/topic'
+        s.will_message = b'bye'
+        s.will_qos = 1
+        s.will_retain = True
+        s._packet_id = 42
+        data = s.to_bytes([('a/#', 1), ('b/+/c', 2)])
+        self.assertEqual(data[0], SESSION_FORMAT_VERSION)
+        decoded, subscriptions = Session.from_bytes(data, loop=self.loop)
+        self.assertEqual(subscriptions, [('a/#', 1), ('b/+/c', 2)])
+        for attr in ('client_id', 'clean_session', 'username', 'keep_alive', 'will_flag', 'will_topic',
+                     'will_message', 'will_qos', 'will_retain', '_packet_id'):
+            self.assertEqual(getattr(decoded, attr), getattr(s, attr))
+        self.assertIsNone(decoded.password)
+
+    def test_session_pickle(self):
+        asyncio.set_event_loop(self.loop)
+        s = Session(self.loop)
+        s.client_id = 'client'
+        s.transitions.connect()
+        s.inflight_out[1] = OutgoingApplicationMessage(1, 'a/b', 1, b'data', False)
+        s.inflight_out[1].publish_packet = s.inflight_out[1].build_publish_packet()
+        restored = pickle.loads(pickle.dumps(s))
+        self.assertEqual(restored.client_id, 'client')
+        self.assertTrue(restored.transitions.is_connected())
+        self.assertEqual(restored.inflight_out[1].publish_packet.data, b'data')
+        self.assertTrue(restored.retained_messages.empty())
+        asyncio.set_event_loop(None)
+
+    def test_session_lazy_containers(self):
+        s = Session(self.loop)
+        s.next_packet_id
+        self.assertEqual((s.inflight_in_count, s.inflight_out_count, s.retained_messages_count), (0, 0, 0))
+        self.assertIsNone(s._inflight_in)
+        self.assertIsNone(s._inflight_out)
+        self.assertIsNone(s._retained_messages)
+        self.assertIsNone(s._delivered_message_queue)
+        s.retained_messages.put_nowait('message')
+        self.assertEqual(s.retained_messages_count, 1)
+
+    def test_session_invalid(self):
+        self.assertRaises(CodecException, Session.from_bytes, b'\\x80\\x03garbage')
+        s = Session(self.loop)
+        s.client_id = 'client'
+        self.assertRaises(CodecException, Session.from_bytes, s.to_bytes()[:-3])
+
+    def test_message_roundtrip(self):
+        message = IncomingApplicationMessage(12, 'a/b', 2, b'\\x00payload', True)
+        message.publish_packet = message.build_publish_packet()
+        message.pubrec_packet = PubrecPacket.build(12)
+        data = message.to_bytes()
+        decoded, offset = ApplicationMessage.from_bytes(data)
+        self.assertEqual(offset, len(data))
+        self.assertIsInstance(decoded, IncomingApplicationMessage)
+        self.assertEqual((decoded.packet_id, decoded.topic, decoded.qos, decoded.data, decoded.retain),
+                         (12, 'a/b', 2, b'\\x00payload', True))
+        self.assertIsNotNone(decoded.publish_packet)
+        self.assertIsNotNone(decoded.pubrec_packet)
+        self.assertIsNone(decoded.pubrel_packet)
+
+    def test_message_qos0(self):
+        message = OutgoingApplicationMessage(None, 'a', 0, b'', False)
+        decoded, offset = ApplicationMessage.from_bytes(message.to_bytes())
+        self.assertIsInstance(decoded, OutgoingApplicationMessage)
+        self.assertIsNone(decoded.packet_id)
+        self.assertIsNone(decoded.publish_packet)
@@ -0,0 +1,44 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import pickle
+from hbmqtt.states import MachineError
+from hbmqtt.session import SessionStates
+from hbmqtt.broker import BrokerStates
+
+
+class StateMachineTest(unittest.TestCase):
+    def test_session_states(self):
+        states = SessionStates()
+        self.assertEqual(states.state, 'new')
+        self.assertTrue(states.is_new())
+        self.assertTrue(states.connect())
+        self.assertTrue(states.is_connected())
+        self.assertRaises(MachineError, states.connect)
+        self.assertEqual(states.state, 'connected')
+        states.disconnect()
+        states.disconnect()
+        self.assertTrue(states.is_disconnected())
+        self.assertFalse(states.is_connected())
+
+    def test_broker_states(self):
+        states = BrokerStates()
+        self.assertRaises(MachineError, states.shutdown)
+        states.start()
+        states.starting_success()
+        self.assertTrue(states.is_started())
+        states.shutdown()
+        states.stopping_success()
+        self.assertTrue(states.is_stopped())
+        states.start()
+        self.assertTrue(states.is_starting())
+
+    def test_shared_table(self):
+        self.assertFalse(hasattr(SessionStates(), '__dict__'))
+
+    def test_pickle(self):
+        states = SessionStates()
+        states.connect()
+        restored = pickle.loads(pickle.dumps(states))
+        self.assertTrue(restored.is_connected())
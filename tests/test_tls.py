@@ -0,0 +1,78 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+import os
+from hbmqtt.broker import Broker
+from hbmqtt.client import MQTTClient
+from hbmqtt.tls import encode_header, read_header
+from hbmqtt.mqtt.constants import QOS_1
+
+cert_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tls_test.crt')
+key_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tls_test.key')
+
+
+def broker_config(ssl_offload):
+    return {
+        'listeners': {
+            'default': {
+                'type': 'tcp',
+                'bind': '127.0.0.1:8883',
+                'ssl': 'on',
+                'certfile': cert_file,
+                'keyfile': key_file,
+                'cafile': cert_file,
+                'ssl-offload': ssl_offload,
+            },
+        },
+        'sys_interval': 0,
+        'auth': {
+            'allow-anonymous': True,
+        }
+    }
+
+
+class TLSOffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_header(self):
+        @asyncio.coroutine
+        def test_coro():
+            peercert = {'subject': ((('commonName', 'client'),),), 'version': 3}
+            reader = asyncio.StreamReader(loop=self.loop)
+            reader.feed_data(encode_header(('127.0.0.1', 1234, 0, 0), peercert) + encode_header(('::1', 1), None))
+            self.assertEqual((yield from read_header(reader)), (('127.0.0.1', 1234), peercert))
+            self.assertEqual((yield from read_header(reader)), (('::1', 1), None))
+
+        self.loop.run_until_complete(test_coro())
+
+    def _test_peercert(self, ssl_offload):
+        @asyncio.coroutine
+        def test_coro():
+            broker = Broker(broker_config(ssl_offload), loop=self.loop, plugin_namespace="hbmqtt.test.plugins")
+            yield from broker.start()
+            client = MQTTClient(client_id='client', config={'certfile': cert_file, 'keyfile': key_file},
+                                loop=self.loop)
+            yield from client.connect('mqtts://127.0.0.1:8883/', cafile=cert_file)
+            yield from client.subscribe([('a/#', QOS_1)])
+            yield from client.publish('a/b', b'data', QOS_1)
+            message = yield from client.deliver_message(timeout=2)
+            self.assertEqual(message.data, b'data')
+            session = broker._sessions['client'][0]
+            self.assertEqual(session.peercert['subject'], ((('commonName', 'localhost'),),))
+            yield from client.disconnect()
+            yield from broker.shutdown()
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_peercert(self):
+        self._test_peercert(0)
+
+    def test_offload(self):
+        self._test_peercert(2)
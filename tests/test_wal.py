@@ -0,0 +1,89 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+import os
+import tempfile
+import shutil
+from hbmqtt.wal import InflightLog
+from hbmqtt.session import OutgoingApplicationMessage, IncomingApplicationMessage, OUTGOING, INCOMING
+from hbmqtt.mqtt.pubrel import PubrelPacket
+
+
+class InflightLogTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def _message(self, packet_id, qos=1, data=b'data'):
+        message = OutgoingApplicationMessage(packet_id, 'a/b', qos, data, False)
+        message.publish_packet = message.build_publish_packet()
+        return message
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.wal'))
+
+    def test_recover(self):
+        log = InflightLog(self.directory)
+        self.assertEqual(log.open(), {})
+        log.put('c1', self._message(1))
+        log.put('c1', self._message(2))
+        log.put('c2', IncomingApplicationMessage(1, 'x', 2, b'in', False))
+        log.delete('c1', OUTGOING, 1)
+        message = self._message(3, qos=2)
+        log.put('c1', message)
+        message.pubrel_packet = PubrelPacket.build(3)
+        log.put('c1', message)
+        log.close()
+
+        log = InflightLog(self.directory)
+        recovered = log.open()
+        self.assertEqual([m.packet_id for m in recovered['c1']], [2, 3])
+        self.assertIsNotNone(recovered['c1'][1].pubrel_packet)
+        self.assertEqual(recovered['c2'][0].direction, INCOMING)
+        log.discard('c1')
+        log.close()
+        log = InflightLog(self.directory)
+        self.assertEqual(list(log.open()), ['c2'])
+        log.close()
+
+    def test_torn_record(self):
+        log = InflightLog(self.directory, segment_size=4096)
+        log.open()
+        log.put('c1', self._message(1))
+        log.put('c1', self._message(2))
+        segment = log._segments[-1]
+        # Corrupt last record payload
+        segment.buffer[segment.offset - 1] ^= 0xff
+        log.close()
+        log = InflightLog(self.directory, segment_size=4096)
+        recovered = log.open()
+        self.assertEqual([m.packet_id for m in recovered['c1']], [1])
+        # Writes resume after the last valid record
+        log.put('c1', self._message(3))
+        log.close()
+        log = InflightLog(self.directory, segment_size=4096)
+        self.assertEqual([m.packet_id for m in log.open()['c1']], [1, 3])
+        log.close()
+
+    def test_segments_retired(self):
+        log = InflightLog(self.directory, segment_size=1024, max_segments=3)
+        log.open()
+        # Stays in flight while many others are acknowledged
+        log.put('slow', self._message(1))
+        for i in range(200):
+            log.put('fast', self._message(i % 100 + 1, data=b'x' * 50))
+            log.delete('fast', OUTGOING, i % 100 + 1)
+        self.loop.run_until_complete(log.sync(loop=self.loop))
+        self.assertLessEqual(len(self._segments()), 3)
+        log.close()
+        log = InflightLog(self.directory, segment_size=1024, max_segments=3)
+        recovered = log.open()
+        self.assertEqual(list(recovered), ['slow'])
+        self.assertEqual(recovered['slow'][0].packet_id, 1)
+        log.close()